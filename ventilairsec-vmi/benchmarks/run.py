@@ -0,0 +1,523 @@
+"""
+Benchmarks - Ingest and API throughput of the addon, without radio hardware
+
+Usage:
+    python benchmarks/run.py [--telegrams N] [--rate R] [--output result.json]
+    python benchmarks/run.py --phase ingest --capture field.esp3 --config config.json
+    python benchmarks/run.py --phase startup [--startup-runs 5]
+    python benchmarks/run.py compare baseline.json result.json [--fail-above 10]
+
+The ingest phase feeds synthetic ESP3 telegrams through
+EnOceanHandler._process_packet (thread transport, python-enocean packets) or
+_process_frame (asyncio transport), DataParser.parse and
+Database.insert_reading or the ingest queue. The query phase fills a
+database with history and replays a weighted mix of API requests through
+the Flask test client. The startup phase launches main.py as a new process,
+the way the addon restarts, and times how long its API takes to answer and
+its components to become ready. Results are printed as JSON, to keep and compare
+between releases. Recorded traffic (capture.py) can replace the synthetic
+telegrams, and synthetic telegrams can be saved as a capture.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from datetime import datetime
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'rootfs', 'app')
+sys.path.insert(0, os.path.normpath(APP_PATH))
+
+import capture  # noqa: E402
+import esp3  # noqa: E402
+import instrumentation  # noqa: E402
+from data_parser import DataParser  # noqa: E402
+from database import Database  # noqa: E402
+from enocean_handler import EnOceanHandler  # noqa: E402
+from ingest_queue import IngestQueue  # noqa: E402
+from records import RawTelegram  # noqa: E402
+
+from telegrams import TelegramGenerator  # noqa: E402
+
+# Format of the result file, bumped when its layout changes
+RESULT_VERSION = 1
+
+# Weighted API mix: (weight, name, URL template)
+QUERY_MIX = (
+    (5, 'current', '/api/current'),
+    (3, 'history_24h', '/api/history/{device}?hours=24'),
+    (3, 'metric_raw_6h', '/api/reading/{device}/{metric}?hours=6'),
+    (2, 'metric_7d', '/api/reading/{device}/{metric}?hours=168'),
+    (2, 'stats_7d', '/api/stats/{device}/{metric}?hours=168'),
+    (2, 'series_24h', '/api/series?series={device}:{metric},{device2}:{metric2}&hours=24'),
+    (1, 'history_page', '/api/history/{device}?hours=168&limit=500')
+)
+
+
+def rss_mb():
+    """Current and peak resident set size in MiB"""
+    current = peak = None
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    current = int(line.split()[1]) / 1024
+                elif line.startswith('VmHWM:'):
+                    peak = int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if peak is None:
+        # ru_maxrss is KiB on Linux, bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    return {'current': current, 'peak': peak}
+
+
+def latency_summary(samples):
+    """Percentiles in milliseconds of durations in seconds"""
+    if not samples:
+        return {'count': 0, 'p50_ms': None, 'p99_ms': None, 'max_ms': None}
+    ordered = sorted(samples)
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+    return {
+        'count': len(ordered),
+        'p50_ms': round(pick(0.50), 4),
+        'p99_ms': round(pick(0.99), 4),
+        'max_ms': round(ordered[-1] * 1000, 4)
+    }
+
+
+def build_inputs(frames, transport):
+    """
+    Prepare what the transceiver would hand to the handler, outside the timing
+
+    Args:
+        frames: ESP3 frames as sent on the serial port
+        transport: Handler transport
+
+    Returns:
+        List of python-enocean packets (thread) or radio esp3.Frame (asyncio)
+    """
+    if transport == 'thread':
+        from enocean.protocol.packet import Packet, RadioPacket
+        packets = []
+        for frame in frames:
+            _, _, packet = Packet.parse_msg(bytearray(frame))
+            if isinstance(packet, RadioPacket):
+                packets.append(packet)
+        return packets
+
+    decoder = esp3.FrameDecoder()
+    decoded = []
+    for frame in frames:
+        decoded.extend(decoder.feed(frame))
+    return [frame for frame in decoded if frame.packet_type == esp3.RADIO_ERP1]
+
+
+def load_frames(args, generator):
+    """Frames of the ingest phase, from a capture or the generator, saved with --record"""
+    if args.capture:
+        frames = [frame for _, frame in capture.read_capture(args.capture)]
+    else:
+        frames = list(generator.frames(args.telegrams))
+
+    if args.record:
+        writer = capture.CaptureWriter(args.record)
+        started = time.time()
+        for index, frame in enumerate(frames):
+            writer.write(frame, started + index / args.rate if args.rate else None)
+        writer.close()
+    return frames
+
+
+def run_ingest(args, db_path):
+    """Time the receive path, one telegram at a time"""
+    generator = TelegramGenerator(
+        devices_per_profile=args.devices,
+        unknown_ratio=args.unknown_ratio,
+        teach_in_ratio=args.teach_in_ratio,
+        seed=args.seed
+    )
+    devices = generator.config()
+    if args.config:
+        with open(args.config) as f:
+            devices = json.load(f).get('devices', {})
+    config = {'devices': devices, 'enocean': {'transport': args.transport}}
+
+    db = Database(db_path, {})
+    db.initialize()
+    parser = DataParser(config)
+    queue = None
+    if args.sink == 'queue':
+        queue = IngestQueue(db, batch_size=args.batch_size, flush_interval_ms=100, max_size=100000)
+        queue.start()
+
+    stored = [0]
+
+    def on_telegram(telegram):
+        reading = parser.parse(telegram)
+        if reading is None:
+            return
+        if queue:
+            queue.put(reading)
+        elif db.insert_reading(reading):
+            stored[0] += 1
+
+    handler = EnOceanHandler('benchmark', config, callback=on_telegram)
+    process = handler._process_packet if args.transport == 'thread' else handler._process_frame
+    inputs = build_inputs(load_frames(args, generator), args.transport)
+
+    latencies = []
+    interval = 1.0 / args.rate if args.rate else 0
+    started = time.perf_counter()
+    for index, item in enumerate(inputs):
+        if interval:
+            delay = started + index * interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        begin = time.perf_counter()
+        process(item)
+        latencies.append(time.perf_counter() - begin)
+    if queue:
+        queue.stop(timeout=60)
+    elapsed = time.perf_counter() - started
+
+    stats = queue.get_stats() if queue else None
+    result = {
+        'telegrams': len(inputs),
+        'readings_stored': stats['written'] if stats else stored[0],
+        'seconds': round(elapsed, 4),
+        'telegrams_per_second': round(len(inputs) / elapsed, 1) if elapsed else None,
+        'latency': latency_summary(latencies),
+        'pipeline': instrumentation.summarize(instrumentation.PIPELINE.snapshot())
+    }
+    db.close()
+    return result
+
+
+def populate(db, generator, parser, days, interval, batch_size=2000):
+    """Insert days of history, one telegram per device every interval seconds"""
+    now = int(time.time())
+    batch = []
+    count = 0
+    for timestamp in range(now - days * 86400, now, interval):
+        for device in generator.devices:
+            device.step(generator.rng)
+            reading = parser.parse(RawTelegram(
+                device.address, device.rorg, device.radio_data(), timestamp=timestamp
+            ))
+            if reading is None:
+                continue
+            batch.append(reading)
+            if len(batch) >= batch_size:
+                db.insert_readings(batch)
+                count += len(batch)
+                batch = []
+    if batch:
+        db.insert_readings(batch)
+        count += len(batch)
+    return count
+
+
+def run_queries(args, db_path):
+    """Replay the API mix against a database filled with history"""
+    try:
+        import main
+    except ImportError as e:
+        return {'skipped': f"Flask application unavailable: {e}"}
+    from response_cache import ResponseCache
+
+    generator = TelegramGenerator(devices_per_profile=args.devices, seed=args.seed)
+    config = {'devices': generator.config()}
+
+    db = Database(db_path, {})
+    db.initialize()
+    parser = DataParser(config)
+    started = time.perf_counter()
+    readings = populate(db, generator, parser, args.history_days, args.history_interval)
+    populate_seconds = time.perf_counter() - started
+
+    main.config = config
+    main.db = db
+    main.response_cache = ResponseCache(
+        main.ingest_sequence, max_entries=0 if args.no_cache else 256
+    )
+    client = main.app.test_client()
+
+    targets = [
+        (device.device_id, [field.name for field in device.profile.fields])
+        for device in generator.devices if device.profile.fields
+    ]
+    rng = random.Random(args.seed)
+    weights = [weight for weight, _, _ in QUERY_MIX]
+    latencies = {name: [] for _, name, _ in QUERY_MIX}
+    errors = 0
+
+    started = time.perf_counter()
+    for _ in range(args.queries):
+        _, name, template = rng.choices(QUERY_MIX, weights)[0]
+        (device, metrics), (device2, metrics2) = rng.choice(targets), rng.choice(targets)
+        url = template.format(
+            device=device, metric=rng.choice(metrics),
+            device2=device2, metric2=rng.choice(metrics2)
+        )
+        begin = time.perf_counter()
+        response = client.get(url)
+        response.get_data()
+        latencies[name].append(time.perf_counter() - begin)
+        if response.status_code != 200:
+            errors += 1
+    elapsed = time.perf_counter() - started
+
+    all_latencies = [value for samples in latencies.values() for value in samples]
+    result = {
+        'readings': readings,
+        'populate_seconds': round(populate_seconds, 2),
+        'database_bytes': os.path.getsize(db.db_path),
+        'queries': len(all_latencies),
+        'errors': errors,
+        'seconds': round(elapsed, 4),
+        'queries_per_second': round(len(all_latencies) / elapsed, 1) if elapsed else None,
+        'latency': latency_summary(all_latencies),
+        'by_query': {name: latency_summary(samples) for name, samples in latencies.items()}
+    }
+    db.close()
+    return result
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def time_startup(config_path, db_path, port, timeout=30):
+    """
+    Launch the addon and time its startup
+
+    Returns:
+        (seconds until /api/health answers, seconds until it reports ready,
+        readiness components), None for what did not happen within timeout
+    """
+    url = f'http://127.0.0.1:{port}/api/health'
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(APP_PATH, 'main.py'),
+         '--config', config_path, '--db', db_path, '--logs', db_path],
+        cwd=APP_PATH, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    api = ready = components = None
+    try:
+        while time.perf_counter() - started < timeout and process.poll() is None:
+            try:
+                with urllib.request.urlopen(url, timeout=1) as response:
+                    health = json.load(response)
+            except OSError:
+                time.sleep(0.005)
+                continue
+            if api is None:
+                api = time.perf_counter() - started
+            components = health.get('readiness', {}).get('components')
+            if health.get('ready'):
+                ready = time.perf_counter() - started
+                break
+            time.sleep(0.005)
+    finally:
+        # SIGINT runs the addon's shutdown, as a restart would
+        process.send_signal(signal.SIGINT)
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+    return api, ready, components
+
+
+def run_startup(args, db_path):
+    """Time fresh starts of the addon, first on an empty database then on one with history"""
+    generator = TelegramGenerator(devices_per_profile=args.devices, seed=args.seed)
+
+    # Replayed telegrams stand in for the transceiver, one per second so it stays connected
+    capture_path = os.path.join(db_path, 'startup.esp3')
+    writer = capture.CaptureWriter(capture_path)
+    for index, frame in enumerate(generator.frames(300)):
+        writer.write(frame, writer.started + index)
+    writer.close()
+
+    port = free_port()
+    config_path = os.path.join(db_path, 'config.json')
+    with open(config_path, 'w') as f:
+        json.dump({
+            'web_port': port,
+            'log_level': 'warning',
+            'server': {'mode': 'werkzeug'},
+            'enocean': {
+                'gateways': [{'name': 'bench', 'port': capture_path, 'transport': 'replay'}]
+            },
+            'devices': generator.config()
+        }, f)
+
+    cold_api, cold_ready, _ = time_startup(config_path, db_path, port)
+
+    # Restarts find the history of a running installation
+    db = Database(db_path, {})
+    db.initialize()
+    readings = populate(db, generator, DataParser({'devices': generator.config()}),
+                        args.history_days, args.history_interval)
+    db.close()
+
+    runs = [time_startup(config_path, db_path, port) for _ in range(args.startup_runs)]
+    api_times = [api for api, _, _ in runs if api is not None]
+    ready_times = [ready for _, ready, _ in runs if ready is not None]
+    rounded = lambda value: round(value, 4) if value is not None else None
+    return {
+        'runs': len(runs),
+        'failed': len(runs) - len(ready_times),
+        'readings': readings,
+        'cold_api_seconds': rounded(cold_api),
+        'cold_ready_seconds': rounded(cold_ready),
+        'api_seconds': rounded(statistics.median(api_times)) if api_times else None,
+        'ready_seconds': rounded(statistics.median(ready_times)) if ready_times else None,
+        'components': runs[-1][2] if runs else None
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, timeout=5
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run(args):
+    """Run the selected phases and return the result document"""
+    rss_start = rss_mb()['current']
+    result = {
+        'version': RESULT_VERSION,
+        'timestamp': datetime.now().isoformat(),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': {key: value for key, value in vars(args).items() if key != 'command'}
+    }
+
+    with tempfile.TemporaryDirectory(prefix='vmi-bench-') as tmp:
+        for phase, function in (('ingest', run_ingest), ('queries', run_queries), ('startup', run_startup)):
+            if args.phase in ('all', phase):
+                path = os.path.join(tmp, phase)
+                os.makedirs(path)
+                result[phase] = function(args, path)
+
+    rss = rss_mb()
+    result['rss_mb'] = {
+        'start': rss_start,
+        'end': rss['current'],
+        'peak': rss['peak']
+    }
+    return result
+
+
+# Metrics compared between two results: (path, higher is better)
+COMPARED = (
+    (('ingest', 'telegrams_per_second'), True),
+    (('ingest', 'latency', 'p50_ms'), False),
+    (('ingest', 'latency', 'p99_ms'), False),
+    (('queries', 'queries_per_second'), True),
+    (('queries', 'latency', 'p50_ms'), False),
+    (('queries', 'latency', 'p99_ms'), False),
+    (('startup', 'api_seconds'), False),
+    (('startup', 'ready_seconds'), False),
+    (('rss_mb', 'peak'), False)
+)
+
+
+def compare(baseline, current, fail_above=None):
+    """
+    Print the change of the main metrics between two results
+
+    Returns:
+        Number of metrics worse than fail_above percent
+    """
+    regressions = 0
+    for path, higher_is_better in COMPARED:
+        before, after = baseline, current
+        for key in path:
+            before = before.get(key) if isinstance(before, dict) else None
+            after = after.get(key) if isinstance(after, dict) else None
+        if not before or after is None:
+            continue
+        change = (after - before) / before * 100
+        worse = -change if higher_is_better else change
+        flag = ''
+        if fail_above is not None and worse > fail_above:
+            regressions += 1
+            flag = '  REGRESSION'
+        print(f"{'.'.join(path):32} {before:>12.3f} {after:>12.3f} {change:+8.1f}%{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Ventilairsec VMI benchmarks')
+    subparsers = parser.add_subparsers(dest='command')
+
+    comparison = subparsers.add_parser('compare', help='Compare two result files')
+    comparison.add_argument('baseline')
+    comparison.add_argument('current')
+    comparison.add_argument('--fail-above', type=float, default=None,
+                            help='Exit with status 1 if a metric is this many percent worse')
+
+    parser.add_argument('--phase', choices=('all', 'ingest', 'queries', 'startup'), default='all')
+    parser.add_argument('--transport', choices=('thread', 'asyncio'), default='asyncio')
+    parser.add_argument('--sink', choices=('direct', 'queue'), default='direct',
+                        help='insert_reading per telegram, or the batched ingest queue')
+    parser.add_argument('--batch-size', type=int, default=50)
+    parser.add_argument('--devices', type=int, default=4, help='Simulated devices per profile')
+    parser.add_argument('--telegrams', type=int, default=5000)
+    parser.add_argument('--rate', type=float, default=0, help='Telegrams per second, 0 for as fast as possible')
+    parser.add_argument('--unknown-ratio', type=float, default=0.05)
+    parser.add_argument('--teach-in-ratio', type=float, default=0.01)
+    parser.add_argument('--history-days', type=int, default=7)
+    parser.add_argument('--history-interval', type=int, default=120, help='Seconds between telegrams of a device')
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--no-cache', action='store_true', help='Disable the response cache')
+    parser.add_argument('--startup-runs', type=int, default=5, help='Restarts timed by the startup phase')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--capture', help='Ingest the frames of this capture file instead of synthetic ones')
+    parser.add_argument('--config', help='Take the devices from this config.json, for captured traffic')
+    parser.add_argument('--record', help='Save the ingested frames to this capture file')
+    parser.add_argument('--output', help='Write the result to this file as well')
+    args = parser.parse_args()
+
+    if args.command == 'compare':
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        sys.exit(1 if compare(baseline, current, args.fail_above) else 0)
+
+    import logging
+    logging.basicConfig(level=logging.WARNING)
+
+    result = run(args)
+    text = json.dumps(result, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
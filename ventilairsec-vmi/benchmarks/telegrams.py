@@ -0,0 +1,143 @@
+"""
+Telegrams - Synthetic EnOcean traffic for the benchmarks
+
+Builds radio telegrams for every profile of eep_profiles.PROFILES, with
+values following a bounded random walk per device so consecutive telegrams
+look like a real sensor, and encodes them as ESP3 frames as the transceiver
+sends them on the serial port.
+"""
+
+import random
+
+import esp3
+from eep_profiles import PROFILES
+
+# RORG of the telegrams carrying each family of profiles
+RORG_4BS = 0xA5
+RORG_MSC = 0xD1
+
+# First sender address of the synthetic devices
+FIRST_ADDRESS = 0x01A00000
+
+
+class SyntheticDevice:
+    """One simulated transmitter and the state of its values"""
+
+    def __init__(self, address, eep, rng):
+        self.address = address
+        self.eep = eep
+        self.profile = PROFILES[eep]
+        self.rorg = RORG_4BS if eep.startswith('a5-') else RORG_MSC
+
+        # 4BS payloads are DB3..DB0, other profiles as long as their fields need
+        payload_length = max(
+            [4 if self.rorg == RORG_4BS else 6]
+            + [field.offset + field.length - 1 for field in self.profile.fields]
+        )
+        self.payload_length = payload_length
+        self.raw_values = {
+            field.name: rng.randrange(1 << field.width) for field in self.profile.fields
+        }
+
+    @property
+    def device_id(self):
+        return f'0x{self.address:08X}'
+
+    def step(self, rng):
+        """Move every value by a small random amount, within its range"""
+        for field in self.profile.fields:
+            top = (1 << field.width) - 1
+            value = self.raw_values[field.name] + rng.randint(-2, 2)
+            self.raw_values[field.name] = min(max(value, 0), top)
+
+    def radio_data(self, teach_in=False):
+        """
+        Packet data as delivered by the transceiver
+
+        Returns:
+            List of ints: RORG, payload, sender address (4 bytes), status
+        """
+        data = [self.rorg] + [0] * self.payload_length
+        data += list(self.address.to_bytes(4, 'big')) + [0x00]
+
+        for field in self.profile.fields:
+            end = field.offset + field.length
+            current = int.from_bytes(bytes(data[field.offset:end]), 'big')
+            mask = ((1 << field.width) - 1) << field.shift
+            current = (current & ~mask) | (self.raw_values[field.name] << field.shift)
+            data[field.offset:end] = current.to_bytes(field.length, 'big')
+            if field.requires:
+                data[field.requires[0]] |= field.requires[1]
+
+        if self.profile.teach_in:
+            offset, mask = self.profile.teach_in
+            if teach_in:
+                data[offset] &= ~mask
+            else:
+                data[offset] |= mask
+        return data
+
+
+class TelegramGenerator:
+    """Stream of synthetic telegrams from simulated devices"""
+
+    def __init__(self, devices_per_profile=2, profiles=None, unknown_ratio=0.0,
+                 teach_in_ratio=0.0, seed=0):
+        """
+        Initialize generator
+
+        Args:
+            devices_per_profile: Simulated devices of each profile
+            profiles: EEP keys to simulate, every registered profile if None
+            unknown_ratio: Share of telegrams from devices missing in the configuration
+            teach_in_ratio: Share of teach-in telegrams
+            seed: Random seed, identical seeds give identical streams
+        """
+        self.rng = random.Random(seed)
+        self.unknown_ratio = unknown_ratio
+        self.teach_in_ratio = teach_in_ratio
+
+        address = FIRST_ADDRESS
+        self.devices = []
+        for eep in profiles or sorted(PROFILES):
+            for _ in range(devices_per_profile):
+                self.devices.append(SyntheticDevice(address, eep, self.rng))
+                address += 1
+        self.stranger = SyntheticDevice(0x0FFFFFFF, 'a5-09-04', self.rng)
+
+    def config(self):
+        """'devices' configuration section declaring the simulated devices"""
+        return {
+            'sensors': [
+                {'id': device.device_id, 'name': f'{device.eep} {index}', 'type': device.eep}
+                for index, device in enumerate(self.devices)
+            ]
+        }
+
+    def next_telegram(self):
+        """
+        Data of the next telegram
+
+        Returns:
+            Tuple (device, radio data)
+        """
+        rng = self.rng
+        if self.unknown_ratio and rng.random() < self.unknown_ratio:
+            device = self.stranger
+        else:
+            device = rng.choice(self.devices)
+        device.step(rng)
+        teach_in = bool(self.teach_in_ratio) and rng.random() < self.teach_in_ratio
+        return device, device.radio_data(teach_in=teach_in)
+
+    def frame(self, data):
+        """ESP3 RADIO_ERP1 frame of radio data, with a plausible signal strength"""
+        # Optional: subtelegram count, destination (broadcast), dBm, security level
+        optional = bytes((0x01, 0xFF, 0xFF, 0xFF, 0xFF, self.rng.randint(40, 95), 0x00))
+        return esp3.encode_frame(esp3.RADIO_ERP1, bytes(data), optional)
+
+    def frames(self, count):
+        """Generate count ESP3 frames"""
+        for _ in range(count):
+            _, data = self.next_telegram()
+            yield self.frame(data)
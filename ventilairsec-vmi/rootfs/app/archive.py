@@ -0,0 +1,231 @@
+"""
+Archive - Columnar Parquet files for readings moved out of SQLite
+
+Layout: <path>/<device address>/<YYYY-MM>.parquet, one file per device and
+UTC month, with the columns timestamp (epoch seconds), metric (dictionary
+encoded) and value, sorted by timestamp then metric. index.json records up
+to which time each device has been archived.
+"""
+
+import importlib.util
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+# Imported by the first Archive, pyarrow takes longer to import than the rest of the app
+pa = pq = None
+PYARROW_AVAILABLE = importlib.util.find_spec('pyarrow') is not None
+
+logger = logging.getLogger(__name__)
+
+
+def _import_pyarrow():
+    global pa, pq
+    if pa is None:
+        import pyarrow
+        import pyarrow.parquet
+        pa, pq = pyarrow, pyarrow.parquet
+
+
+def month_of(epoch):
+    """UTC month key ('YYYY-MM') of an epoch second"""
+    return time.strftime('%Y-%m', time.gmtime(epoch))
+
+
+def month_bounds(month):
+    """First epoch second of a month key and of the following month"""
+    year, number = (int(part) for part in month.split('-'))
+    start = datetime(year, number, 1, tzinfo=timezone.utc)
+    end = datetime(year + number // 12, number % 12 + 1, 1, tzinfo=timezone.utc)
+    return int(start.timestamp()), int(end.timestamp())
+
+
+class Archive:
+    """Partitioned Parquet store of cold readings"""
+
+    def __init__(self, path, compression='zstd'):
+        """
+        Initialize archive
+
+        Args:
+            path: Archive directory
+            compression: Parquet codec
+
+        Raises:
+            RuntimeError: If pyarrow is not installed
+        """
+        if not PYARROW_AVAILABLE:
+            raise RuntimeError("pyarrow is required for the archive tier")
+        _import_pyarrow()
+
+        self.path = path
+        self.compression = compression
+        self.schema = pa.schema([
+            ('timestamp', pa.int64()),
+            ('metric', pa.dictionary(pa.int32(), pa.string())),
+            ('value', pa.float64())
+        ])
+        self._lock = threading.Lock()
+
+        os.makedirs(path, exist_ok=True)
+        self._index_path = os.path.join(path, 'index.json')
+        self._index = {}
+        self._index_mtime = None
+        self._load_index()
+
+    @classmethod
+    def from_config(cls, config, data_path):
+        """
+        Build an archive from the 'archive' configuration section
+
+        Returns:
+            Archive, or None if disabled
+
+        Raises:
+            RuntimeError: Archive enabled but pyarrow is missing, rather than
+                letting retention delete the readings it should keep
+        """
+        options = config.get('archive', {})
+        if not options.get('enabled'):
+            return None
+        if not PYARROW_AVAILABLE:
+            raise RuntimeError("Archive enabled but pyarrow is not installed, install it or disable archive.enabled")
+
+        return cls(
+            options.get('path') or os.path.join(data_path, 'archive'),
+            compression=options.get('compression', 'zstd')
+        )
+
+    def _file(self, device_id, month):
+        return os.path.join(self.path, device_id, f'{month}.parquet')
+
+    def _load_index(self):
+        """
+        Reload index.json if another process rewrote it
+
+        The pipeline process archives while gunicorn workers, forked
+        earlier, answer queries: a stat per lookup keeps them current.
+        """
+        try:
+            mtime = os.stat(self._index_path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime != self._index_mtime:
+            with open(self._index_path, 'r') as f:
+                self._index = json.load(f)
+            self._index_mtime = mtime
+
+    def archived_until(self, device_id):
+        """Epoch second before which a device's readings live in the archive, None if never archived"""
+        self._load_index()
+        return self._index.get(device_id)
+
+    def set_archived_until(self, device_id, epoch):
+        """Record the archive boundary of a device"""
+        with self._lock:
+            self._load_index()
+            index = dict(self._index)
+            index[device_id] = max(epoch, index.get(device_id) or 0)
+            tmp_path = self._index_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(index, f)
+            os.replace(tmp_path, self._index_path)
+            self._index = index
+            self._index_mtime = os.stat(self._index_path).st_mtime_ns
+
+    def write_month(self, device_id, month, rows):
+        """
+        Merge rows into a device's month file
+
+        Existing points with the same timestamp and metric are replaced, so
+        archiving the same rows twice (after a crash between writing the
+        file and deleting the rows) leaves no duplicates.
+
+        Args:
+            device_id: Device address
+            month: Month key
+            rows: List of (timestamp, metric, value)
+
+        Returns:
+            Number of points in the file
+        """
+        path = self._file(device_id, month)
+        with self._lock:
+            points = {}
+            if os.path.exists(path):
+                existing = pq.read_table(path).to_pydict()
+                points.update(
+                    ((timestamp, metric), value) for timestamp, metric, value in
+                    zip(existing['timestamp'], existing['metric'], existing['value'])
+                )
+            points.update(((timestamp, metric), value) for timestamp, metric, value in rows)
+
+            keys = sorted(points)
+            table = pa.table({
+                'timestamp': pa.array([key[0] for key in keys], pa.int64()),
+                'metric': pa.array([key[1] for key in keys], pa.string()).dictionary_encode(),
+                'value': pa.array([points[key] for key in keys], pa.float64())
+            }).cast(self.schema)
+
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = path + '.tmp'
+            pq.write_table(table, tmp_path, compression=self.compression)
+            with open(tmp_path, 'rb') as f:
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+            return len(keys)
+
+    def iter_months(self, device_id, metric=None, start=None, end=None, descending=False):
+        """
+        Archived points of a device, one month file at a time
+
+        Args:
+            device_id: Device address
+            metric: Only this metric, all if None
+            start: First epoch second, None for no bound
+            end: Epoch second to stop before, None for no bound
+            descending: Newest month first
+
+        Yields:
+            pyarrow Table (timestamp, metric, value) of one month, sorted by
+            timestamp then metric
+        """
+        directory = os.path.join(self.path, device_id)
+        if not os.path.isdir(directory):
+            return
+
+        filters = []
+        if metric is not None:
+            filters.append(('metric', '=', metric))
+        if start is not None:
+            filters.append(('timestamp', '>=', start))
+        if end is not None:
+            filters.append(('timestamp', '<', end))
+
+        names = sorted(name for name in os.listdir(directory) if name.endswith('.parquet'))
+        for name in reversed(names) if descending else names:
+            first, after_last = month_bounds(name[:-len('.parquet')])
+            if (start is not None and after_last <= start) or (end is not None and first >= end):
+                continue
+            table = pq.read_table(os.path.join(directory, name), filters=filters or None)
+            if table.num_rows:
+                yield table
+
+    def get_stats(self):
+        """Get archive statistics"""
+        self._load_index()
+        files = 0
+        size = 0
+        for root, _, names in os.walk(self.path):
+            for name in names:
+                if name.endswith('.parquet'):
+                    files += 1
+                    size += os.path.getsize(os.path.join(root, name))
+        return {
+            'files': files,
+            'size_bytes': size,
+            'devices': len(self._index)
+        }
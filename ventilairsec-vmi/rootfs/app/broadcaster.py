@@ -0,0 +1,190 @@
+"""
+Broadcaster - Fan out decoded readings to live stream subscribers
+"""
+
+import json
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+    """One stream client: its filters and a bounded buffer of pending events"""
+
+    def __init__(self, devices=None, metrics=None, buffer_size=100):
+        """
+        Initialize subscription
+
+        Args:
+            devices: Device IDs to receive, None for all
+            metrics: Metric names to receive, None for all
+            buffer_size: Events kept for a slow client before the oldest are dropped
+        """
+        self.devices = frozenset(devices) if devices else None
+        self.metrics = frozenset(metrics) if metrics else None
+        self.events = deque(maxlen=buffer_size)
+        self.dropped = 0
+        self.closed = False
+        self._reported = 0
+        self._condition = threading.Condition()
+
+    def push(self, event):
+        """Add an encoded event, dropping the oldest if the buffer is full"""
+        with self._condition:
+            if len(self.events) == self.events.maxlen:
+                self.dropped += 1
+            self.events.append(event)
+            self._condition.notify()
+
+    def get(self, timeout=None):
+        """
+        Wait for events
+
+        Args:
+            timeout: Seconds to wait, None to wait forever
+
+        Returns:
+            List of (event_id, data) received since the last call, empty on
+            timeout or when the subscription is closed
+        """
+        with self._condition:
+            if not self.events and not self.closed:
+                self._condition.wait(timeout)
+            events = list(self.events)
+            self.events.clear()
+            return events
+
+    def take_dropped(self):
+        """Number of events dropped since the last call"""
+        with self._condition:
+            dropped = self.dropped - self._reported
+            self._reported = self.dropped
+            return dropped
+
+    def close(self):
+        """Wake up the client so it can leave"""
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+
+class Broadcaster:
+    """Encode every reading once and hand it to all matching subscribers"""
+
+    def __init__(self, buffer_size=100, max_clients=20, heartbeat=15):
+        """
+        Initialize broadcaster
+
+        Args:
+            buffer_size: Events buffered per client
+            max_clients: Maximum number of simultaneous subscribers
+            heartbeat: Seconds between keep-alives on an idle stream
+        """
+        self.buffer_size = buffer_size
+        self.max_clients = max_clients
+        self.heartbeat = heartbeat
+
+        self._subscribers = ()
+        self._lock = threading.Lock()
+        self._sequence = 0
+        self.published = 0
+
+    @classmethod
+    def from_config(cls, config):
+        """Build a broadcaster from the 'stream' configuration section"""
+        options = config.get('stream', {})
+        return cls(
+            buffer_size=options.get('buffer_size', 100),
+            max_clients=options.get('max_clients', 20),
+            heartbeat=options.get('heartbeat', 15)
+        )
+
+    def subscribe(self, devices=None, metrics=None):
+        """
+        Register a client
+
+        Returns:
+            Subscription
+
+        Raises:
+            RuntimeError: If max_clients subscribers are already connected
+        """
+        subscription = Subscription(devices, metrics, self.buffer_size)
+        with self._lock:
+            if len(self._subscribers) >= self.max_clients:
+                raise RuntimeError(f"Too many stream clients (max {self.max_clients})")
+            # Copy on write: publish() iterates without taking the lock
+            self._subscribers = self._subscribers + (subscription,)
+        logger.info(f"Stream client connected ({len(self._subscribers)} connected)")
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Remove a client"""
+        subscription.close()
+        with self._lock:
+            self._subscribers = tuple(s for s in self._subscribers if s is not subscription)
+        logger.info(f"Stream client disconnected ({len(self._subscribers)} connected)")
+
+    def publish(self, reading):
+        """
+        Send a reading to every subscriber whose filters match
+
+        Args:
+            reading: Reading
+        """
+        subscribers = self._subscribers
+        if not subscribers:
+            return
+
+        self._sequence += 1
+        self.published += 1
+        event_id = self._sequence
+        encoded = {}
+
+        for subscription in subscribers:
+            if subscription.devices is not None and reading.device_id not in subscription.devices:
+                continue
+
+            # One encoding per distinct metric filter, shared by its clients
+            data = encoded.get(subscription.metrics)
+            if data is None and subscription.metrics not in encoded:
+                data = self._encode(reading, subscription.metrics)
+                encoded[subscription.metrics] = data
+            if data is not None:
+                subscription.push((event_id, data))
+
+    def _encode(self, reading, metrics=None):
+        """JSON payload of a reading, None if the filter leaves no metric"""
+        values = {
+            name: value for name, value in reading.values
+            if metrics is None or name in metrics
+        }
+        if not values:
+            return None
+
+        return json.dumps({
+            'device_id': reading.device_id,
+            'device_name': reading.device_name,
+            'device_type': reading.device_type,
+            'timestamp': reading.iso_timestamp,
+            'metrics': values,
+            'units': {name: reading.units.get(name) for name in values}
+        })
+
+    def close(self):
+        """Disconnect every client"""
+        for subscription in self._subscribers:
+            subscription.close()
+
+    def get_stats(self):
+        """Get broadcaster statistics"""
+        subscribers = self._subscribers
+        return {
+            'clients': len(subscribers),
+            'max_clients': self.max_clients,
+            'published': self.published,
+            'buffered': sum(len(s.events) for s in subscribers),
+            'dropped': sum(s.dropped for s in subscribers)
+        }
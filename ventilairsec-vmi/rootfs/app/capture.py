@@ -0,0 +1,367 @@
+"""
+Capture - Record and replay raw ESP3 traffic
+
+A capture file holds the frames a transceiver sent, as received, with the
+time they were received:
+
+    header:  b'ESP3CAP', format version (1 byte), start time (float64 epoch seconds)
+    record:  varint microseconds since the previous record, varint length, ESP3 frame
+
+EnOceanHandler records to capture files with the 'capture_path' option,
+and its 'replay' transport feeds one back through the same pipeline, in
+real time or as fast as possible. Run as a script, this module summarizes a
+capture, or serves it on a pseudo-terminal standing in for the transceiver
+so the serial transports run without radio hardware:
+
+    python3 capture.py info /data/captures/ttyAMA0-20240101-120000.esp3
+    python3 capture.py pty /data/captures/ttyAMA0-20240101-120000.esp3 [--speed 10]
+"""
+
+import argparse
+import json
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+import esp3
+
+try:
+    import pty
+    import tty
+except ImportError:
+    pty = tty = None
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'ESP3CAP'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('>7sBd')
+
+# Bytes read from a capture file at a time
+READ_CHUNK_SIZE = 64 * 1024
+
+# Base ID the pty stand-in answers CO_RD_IDBASE with
+STAND_IN_BASE_ID = b'\xff\x80\x00\x00'
+
+
+def _write_varint(out, number):
+    while number > 0x7F:
+        out.append((number & 0x7F) | 0x80)
+        number >>= 7
+    out.append(number)
+
+
+def _read_varint(data, position):
+    number = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        number |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return number, position
+        shift += 7
+
+
+class CaptureWriter:
+    """Append-only capture file of received frames"""
+
+    def __init__(self, path, flush_interval=1.0):
+        """
+        Initialize writer, creating the file
+
+        Args:
+            path: Capture file path, its directory is created if needed
+            flush_interval: Seconds between flushes of the file buffer
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.path = path
+        self.flush_interval = flush_interval
+        self.started = time.time()
+        self.frames = 0
+
+        self._file = open(path, 'wb')
+        self._file.write(HEADER.pack(MAGIC, FORMAT_VERSION, self.started))
+        self._offset = 0
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def in_directory(cls, directory, name):
+        """Writer on a new file of a directory, named after the gateway and the current time"""
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        return cls(os.path.join(directory, f'{name}-{stamp}.esp3'))
+
+    def write(self, frame, timestamp=None):
+        """
+        Record a frame
+
+        Args:
+            frame: Complete ESP3 frame, sync byte included
+            timestamp: Reception time, now if None
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        record = bytearray()
+        with self._lock:
+            if self._file is None:
+                return
+            # Microseconds since the start, never going back so deltas stay unsigned
+            offset = max(round((timestamp - self.started) * 1e6), self._offset)
+            _write_varint(record, offset - self._offset)
+            _write_varint(record, len(frame))
+            record += frame
+            self._file.write(record)
+            self._offset = offset
+            self.frames += 1
+
+            now = time.monotonic()
+            if now - self._last_flush >= self.flush_interval:
+                self._file.flush()
+                self._last_flush = now
+
+    def close(self):
+        """Flush and close the file"""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        logger.info(f"Capture {self.path} closed after {self.frames} frames")
+
+
+def read_capture(path, chunk_size=READ_CHUNK_SIZE):
+    """
+    Read a capture file
+
+    The file is read chunk_size bytes at a time, so memory does not grow
+    with the length of the capture. A record cut short, as left by a crash,
+    ends the capture.
+
+    Args:
+        path: Capture file path
+        chunk_size: Bytes read at a time
+
+    Yields:
+        (reception time, frame bytes)
+
+    Raises:
+        ValueError: If the file is not a capture of a known format
+    """
+    with open(path, 'rb') as f:
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size:
+            raise ValueError(f"{path} is not an ESP3 capture")
+        magic, version, started = HEADER.unpack(header)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f"{path} is not an ESP3 capture of format {FORMAT_VERSION}")
+
+        # Unparsed bytes, a record spanning two chunks waits here for the next one
+        data = bytearray()
+        offset = 0
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            data += chunk
+
+            position = 0
+            while position < len(data):
+                try:
+                    delta, start = _read_varint(data, position)
+                    length, start = _read_varint(data, start)
+                except IndexError:
+                    break
+                if start + length > len(data):
+                    break
+                offset += delta
+                yield started + offset / 1e6, bytes(data[start:start + length])
+                position = start + length
+            del data[:position]
+
+
+def paced(records, speed=1.0, stop=None):
+    """
+    Yield capture records at their recorded pace
+
+    Args:
+        records: Iterable of (reception time, frame)
+        speed: Replay speed factor, 1 for real time, 0 for as fast as possible
+        stop: threading.Event ending the replay early when set
+    """
+    first = started = None
+    for timestamp, frame in records:
+        if speed:
+            if first is None:
+                first, started = timestamp, time.monotonic()
+            delay = started + (timestamp - first) / speed - time.monotonic()
+            if delay > 0 and stop is not None:
+                stop.wait(delay)
+            elif delay > 0:
+                time.sleep(delay)
+        if stop is not None and stop.is_set():
+            return
+        yield timestamp, frame
+
+
+class PtyStandIn:
+    """Pseudo-terminal serving a capture the way a transceiver would"""
+
+    def __init__(self, path, speed=1.0, base_id=STAND_IN_BASE_ID):
+        """
+        Initialize stand-in
+
+        Args:
+            path: Capture file to serve
+            speed: Replay speed factor, 0 for as fast as possible
+            base_id: 4 bytes answered to CO_RD_IDBASE
+        """
+        self.path = path
+        self.speed = speed
+        self.base_id = base_id
+        self.port = None
+        self.sent = 0
+        self.finished = threading.Event()
+        self.connected = threading.Event()
+
+        self._master = None
+        self._slave = None
+        self._stop = threading.Event()
+        self._write_lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        """
+        Open the pseudo-terminal and start serving, the handler opens self.port
+
+        The replay starts once the handler asks for the base ID, opening the
+        port flushes what was written before.
+
+        Raises:
+            RuntimeError: If pseudo-terminals are not available on this platform
+        """
+        if pty is None:
+            raise RuntimeError("Pseudo-terminals are not available on this platform")
+
+        self._master, self._slave = pty.openpty()
+        # Raw from the start, the line discipline must not touch frames sent before the handler opens the port
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+
+        self._threads = [
+            threading.Thread(target=self._replay, name='pty-replay', daemon=True),
+            threading.Thread(target=self._answer, name='pty-commands', daemon=True)
+        ]
+        for thread in self._threads:
+            thread.start()
+        logger.info(f"Serving {self.path} on {self.port}")
+        return self.port
+
+    def stop(self):
+        """Stop serving and close the pseudo-terminal"""
+        self._stop.set()
+        self.connected.set()
+        for thread in self._threads:
+            thread.join(timeout=2)
+        for fd in (self._master, self._slave):
+            if fd is not None:
+                os.close(fd)
+        self._master = self._slave = None
+
+    def _write(self, frame):
+        with self._write_lock:
+            os.write(self._master, frame)
+
+    def _replay(self):
+        """Write the captured frames to the terminal"""
+        while not self.connected.wait(0.2):
+            if self._stop.is_set():
+                return
+        for _, frame in paced(read_capture(self.path), self.speed, self._stop):
+            self._write(frame)
+            self.sent += 1
+        self.finished.set()
+        logger.info(f"Replayed {self.sent} frames from {self.path}")
+
+    def _answer(self):
+        """Answer the commands the handler sends while starting"""
+        decoder = esp3.FrameDecoder()
+        while not self._stop.is_set():
+            readable, _, _ = select.select([self._master], [], [], 0.2)
+            if not readable:
+                continue
+            try:
+                chunk = os.read(self._master, 4096)
+            except OSError:
+                return
+            for frame in decoder.feed(chunk):
+                if frame.packet_type != esp3.COMMON_COMMAND or not frame.data:
+                    continue
+                if frame.data[0] == esp3.CO_RD_IDBASE:
+                    # Return code and base ID, remaining write cycles as optional data
+                    response = esp3.encode_frame(esp3.RESPONSE, bytes((esp3.RET_OK,)) + self.base_id, b'\x0a')
+                else:
+                    response = esp3.encode_frame(esp3.RESPONSE, b'\x02')  # RET_NOT_SUPPORTED
+                self._write(response)
+                self.connected.set()
+
+
+def summarize(path):
+    """Frame counts by packet type and time span of a capture"""
+    decoder = esp3.FrameDecoder()
+    types = {}
+    first = last = None
+    count = 0
+    for timestamp, frame in read_capture(path):
+        first = timestamp if first is None else first
+        last = timestamp
+        count += 1
+        for decoded in decoder.feed(frame):
+            name = f'0x{decoded.packet_type:02X}'
+            types[name] = types.get(name, 0) + 1
+    return {
+        'path': path,
+        'frames': count,
+        'packet_types': types,
+        'crc_errors': decoder.crc_errors,
+        'start': first,
+        'seconds': round(last - first, 3) if count else 0,
+        'bytes': os.path.getsize(path)
+    }
+
+
+def main():
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description='Inspect or serve ESP3 capture files')
+    commands = parser.add_subparsers(dest='command', required=True)
+    info = commands.add_parser('info', help='Summarize a capture')
+    info.add_argument('capture')
+    serve = commands.add_parser('pty', help='Serve a capture on a pseudo-terminal')
+    serve.add_argument('capture')
+    serve.add_argument('--speed', type=float, default=1.0, help='Replay speed factor, 0 for as fast as possible')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    if args.command == 'info':
+        print(json.dumps(summarize(args.capture), indent=2))
+        return 0
+
+    stand_in = PtyStandIn(args.capture, speed=args.speed)
+    print(stand_in.start(), flush=True)
+    try:
+        # Keep the terminal open after the replay, closing it would look like an unplugged transceiver
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        stand_in.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,291 @@
+"""
+Change Filter - Change-only storage of readings
+
+ChangeFilter keeps the last stored point of every (device, metric) in memory
+and decides which values become rows of the readings table:
+
+- deadband: a value is stored when it differs from the last stored one by
+  more than the metric's deadband, so holding each stored value until the
+  next one gives back the series within the deadband (exactly with 0)
+- swinging_door: a value is stored when no straight line from the last
+  stored point passes within the deadband of every value since, so linear
+  interpolation between stored points gives back the series
+
+Either way a point is stored at least every heartbeat seconds while the
+device transmits, and points the swinging door holds are written a heartbeat
+after their door opened even if the device stopped. Telegrams repeating the previous payload of their device
+are not stored either. Rollups and latest values still get every value,
+only the raw rows are thinned.
+"""
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ChangeFilter:
+    """Per device and metric state deciding which readings are stored"""
+
+    MODES = ('deadband', 'swinging_door')
+
+    def __init__(self, mode='deadband', deadband=0.0, deadbands=None, heartbeat=900):
+        """
+        Initialize change filter
+
+        Args:
+            mode: One of MODES
+            deadband: Tolerated deviation of a stored series, in metric units
+            deadbands: Dictionary of metric name to deadband, overriding the default
+            heartbeat: Seconds after which a value is stored even if unchanged
+
+        Raises:
+            ValueError: If the mode is unknown or a deadband is negative
+        """
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown change filter mode '{mode}', expected " + ' or '.join(self.MODES))
+        self.mode = mode
+        self.deadband = float(deadband)
+        self.deadbands = {name: float(value) for name, value in (deadbands or {}).items()}
+        if self.deadband < 0 or any(value < 0 for value in self.deadbands.values()):
+            raise ValueError("Deadbands cannot be negative")
+        self.heartbeat = heartbeat
+
+        # (device key, metric key) -> deadband: [timestamp, value] of the last stored point;
+        # swinging door: [timestamp, value, lowest slope, highest slope, pending timestamp, pending value]
+        self._state = {}
+        # device key -> (timestamp, payload) of the last stored telegram
+        self._telegrams = {}
+
+        self.values_seen = 0
+        self.values_stored = 0
+        self.telegrams_seen = 0
+        self.telegrams_stored = 0
+
+        # Previous state of what the open transaction changed, see begin()
+        self._undo = None
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Build a change filter from the 'change_filter' configuration section
+
+        Returns:
+            ChangeFilter, or None if disabled
+        """
+        options = config.get('change_filter', {})
+        if not options.get('enabled'):
+            return None
+        return cls(
+            mode=options.get('mode', 'deadband'),
+            deadband=options.get('deadband', 0.0),
+            deadbands=options.get('deadbands'),
+            heartbeat=options.get('heartbeat', 900)
+        )
+
+    @property
+    def max_gap(self):
+        """
+        Longest time between two stored points of a transmitting device
+
+        A point is stored with the first telegram past the heartbeat, so the
+        gap may exceed it by one transmission interval.
+        """
+        return 2 * self.heartbeat
+
+    def begin(self):
+        """
+        Start a transaction
+
+        The state must match the readings table: decisions taken until
+        commit() are undone by rollback() when the database transaction
+        writing their rows fails.
+        """
+        self._undo = {
+            'counters': (self.values_seen, self.values_stored, self.telegrams_seen, self.telegrams_stored)
+        }
+
+    def commit(self):
+        """Keep the decisions of the transaction, once its rows are committed"""
+        self._undo = None
+
+    def rollback(self):
+        """Restore the state as it was at begin()"""
+        undo, self._undo = self._undo, None
+        if undo is None:
+            return
+        self.values_seen, self.values_stored, self.telegrams_seen, self.telegrams_stored = undo.pop('counters')
+        for (name, key), previous in undo.items():
+            states = getattr(self, name)
+            if previous is None:
+                states.pop(key, None)
+            else:
+                states[key] = previous
+
+    def _save(self, name, key):
+        """Record the state of a key before the transaction first changes it"""
+        if self._undo is not None and (name, key) not in self._undo:
+            previous = getattr(self, name).get(key)
+            self._undo[(name, key)] = list(previous) if isinstance(previous, list) else previous
+
+    def keep_telegram(self, device_key, timestamp, payload):
+        """Whether a raw telegram is stored, False for a repeat of the previous one"""
+        self.telegrams_seen += 1
+        previous = self._telegrams.get(device_key)
+        if (previous is not None and previous[1] == payload
+                and 0 <= timestamp - previous[0] < self.heartbeat):
+            return False
+        self._save('_telegrams', device_key)
+        self._telegrams[device_key] = (timestamp, payload)
+        self.telegrams_stored += 1
+        return True
+
+    def filter(self, device_key, metric_key, name, timestamp, value):
+        """
+        Decide what to store for a new value
+
+        Args:
+            device_key: Device surrogate key
+            metric_key: Metric surrogate key
+            name: Metric name, to find its deadband
+            timestamp: Epoch second of the value
+            value: Decoded value, may be None
+
+        Returns:
+            List of readings rows (device key, timestamp, metric key, value)
+            to store; the swinging door stores earlier points it was holding
+        """
+        self.values_seen += 1
+        band = self.deadbands.get(name, self.deadband)
+        key = (device_key, metric_key)
+        self._save('_state', key)
+        if self.mode == 'deadband':
+            points = self._deadband(key, timestamp, value, band)
+        else:
+            points = self._swinging_door(key, timestamp, value, band)
+        self.values_stored += len(points)
+        return [(device_key, point[0], metric_key, point[1]) for point in points]
+
+    def _deadband(self, key, timestamp, value, band):
+        state = self._state.get(key)
+        if state is not None:
+            stored_timestamp, stored_value = state
+            if timestamp < stored_timestamp:
+                # Late value: store it, the newer stored point stays the reference
+                return [(timestamp, value)]
+            if timestamp - stored_timestamp < self.heartbeat and (
+                value == stored_value
+                or (value is not None and stored_value is not None and abs(value - stored_value) <= band)
+            ):
+                return []
+        self._state[key] = [timestamp, value]
+        return [(timestamp, value)]
+
+    def _swinging_door(self, key, timestamp, value, band):
+        state = self._state.get(key)
+        if state is None or value is None or state[1] is None:
+            self._state[key] = [timestamp, value, float('-inf'), float('inf'), None, None]
+            return [(timestamp, value)]
+
+        origin_timestamp, origin_value, low, high, pending_timestamp, pending_value = state
+        # Stored points are measured values, not points of the door line, which
+        # doubles the deviation of the door: half of it keeps the series within band
+        band /= 2
+        if timestamp <= (pending_timestamp if pending_timestamp is not None else origin_timestamp):
+            # Same second or late, the held point already stands for it
+            return []
+
+        if timestamp - origin_timestamp >= self.heartbeat:
+            points = [] if pending_timestamp is None else [(pending_timestamp, pending_value)]
+            self._state[key] = [timestamp, value, float('-inf'), float('inf'), None, None]
+            return points + [(timestamp, value)]
+
+        elapsed = timestamp - origin_timestamp
+        low = max(low, (value - band - origin_value) / elapsed)
+        high = min(high, (value + band - origin_value) / elapsed)
+        if low <= high:
+            # Still within the door, hold the point
+            state[2:] = [low, high, timestamp, value]
+            return []
+
+        # Door closed: store the last point that fitted and open a new door from it
+        elapsed = timestamp - pending_timestamp
+        self._state[key] = [
+            pending_timestamp, pending_value,
+            (value - band - pending_value) / elapsed, (value + band - pending_value) / elapsed,
+            timestamp, value
+        ]
+        return [(pending_timestamp, pending_value)]
+
+    def pending_rows(self, before=None):
+        """
+        Rows of the points the swinging door is still holding
+
+        Written at shutdown, so the end of each series is not lost, and a
+        heartbeat after their door opened, so a crash does not lose the
+        last points of a device that stopped transmitting; the doors
+        restart from those points.
+
+        Args:
+            before: Only points of doors opened before this epoch second,
+                all if None
+        """
+        rows = []
+        for key, state in self._state.items():
+            if len(state) > 2 and state[4] is not None and (before is None or state[0] < before):
+                self._save('_state', key)
+                rows.append((key[0], state[4], key[1], state[5]))
+                state[:] = [state[4], state[5], float('-inf'), float('inf'), None, None]
+        self.values_stored += len(rows)
+        return rows
+
+    def reconstruct(self, timestamps, values, carry=None):
+        """
+        Fill the gaps of a stored series on a shared time axis
+
+        Args:
+            timestamps: Ascending epoch seconds
+            values: Stored value per timestamp, None where the series has no point
+            carry: (timestamp, value) of the last stored point before the axis
+
+        Returns:
+            List of values, holding (deadband) or interpolating (swinging door)
+            between stored points no more than max_gap apart
+        """
+        known = [(timestamp, value) for timestamp, value in zip(timestamps, values) if value is not None]
+        if carry is not None and carry[1] is not None:
+            known.insert(0, carry)
+        if not known:
+            return list(values)
+
+        filled = []
+        index = 0
+        for timestamp, value in zip(timestamps, values):
+            if value is not None:
+                filled.append(value)
+                continue
+            while index + 1 < len(known) and known[index + 1][0] <= timestamp:
+                index += 1
+            before = known[index]
+            if before[0] > timestamp or timestamp - before[0] > self.max_gap:
+                filled.append(None)
+                continue
+            after = known[index + 1] if index + 1 < len(known) else None
+            if self.mode == 'swinging_door' and after is not None and after[0] - before[0] <= self.max_gap:
+                share = (timestamp - before[0]) / (after[0] - before[0])
+                filled.append(before[1] + (after[1] - before[1]) * share)
+            else:
+                filled.append(before[1])
+        return filled
+
+    def get_stats(self):
+        """Get change filter statistics"""
+        return {
+            'mode': self.mode,
+            'heartbeat': self.heartbeat,
+            'series': len(self._state),
+            'values_seen': self.values_seen,
+            'values_stored': self.values_stored,
+            'telegrams_seen': self.telegrams_seen,
+            'telegrams_stored': self.telegrams_stored,
+            'ratio': round(self.values_stored / self.values_seen, 4) if self.values_seen else None
+        }
@@ -0,0 +1,476 @@
+"""
+Command Scheduler - Outbound telegrams, paced and confirmed
+
+Commands wait in a priority queue (user actions before periodic polls) and
+a single thread sends them, so HTTP handlers and automations never write to
+the radio themselves. A new command replaces a pending one of the same kind
+to the same device, sends are spaced and budgeted against the EnOcean duty
+cycle, and a command expecting an acknowledgement is sent again until a
+telegram from its target arrives or its retries run out. Only a telegram
+received after the command actually went on air, and of the expected RORG
+if the command names one, acknowledges it; a send no gateway could make is
+retried after a backoff and is never acknowledged.
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+
+from records import format_device_id
+
+logger = logging.getLogger(__name__)
+
+# Lower is sent first
+PRIORITIES = {'boost': 0, 'normal': 1, 'poll': 2}
+
+# Airtime estimate of a telegram: every ERP1 telegram goes out as 3
+# subtelegrams at 125 kbit/s, with about 7 bytes of preamble, header and CRC
+SUBTELEGRAMS = 3
+TELEGRAM_OVERHEAD = 7
+RADIO_BITRATE = 125000
+
+# Longest wait before resending a command no gateway could send
+MAX_BACKOFF = 60.0
+
+# States a command ends in
+FINAL_STATES = ('done', 'failed', 'superseded', 'cancelled', 'expired')
+
+
+def airtime(length):
+    """Seconds on air of a telegram carrying length bytes of payload"""
+    return SUBTELEGRAMS * (length + TELEGRAM_OVERHEAD) * 8 / RADIO_BITRATE
+
+
+class Command:
+    """One outbound telegram and its delivery state"""
+
+    __slots__ = ('id', 'receiver_id', 'data', 'rorg', 'priority', 'kind', 'ack', 'ack_rorg', 'retries',
+                 'attempts', 'state', 'error', 'created', 'expires', 'sent', 'ack_deadline',
+                 'retry_at', 'acknowledged', 'sequence')
+
+    def __init__(self, command_id, receiver_id, data, rorg, priority, kind, ack, retries, ttl, sequence,
+                 ack_rorg=None):
+        self.id = command_id
+        self.receiver_id = receiver_id
+        self.data = data
+        self.rorg = rorg
+        self.priority = priority
+        self.kind = kind
+        self.ack = ack
+        self.ack_rorg = ack_rorg
+        self.retries = retries
+        self.attempts = 0
+        self.state = 'queued'
+        self.error = None
+        self.created = time.time()
+        self.expires = time.monotonic() + ttl if ttl else None
+        # Epoch time of the last transmission, acknowledgements must follow it
+        self.sent = None
+        self.ack_deadline = None
+        self.retry_at = None
+        self.acknowledged = None
+        self.sequence = sequence
+
+    @property
+    def coalesce_key(self):
+        return (self.receiver_id, self.kind) if self.kind else None
+
+    def to_dict(self):
+        """Dictionary view for the API"""
+        return {
+            'id': self.id,
+            'device_id': self.receiver_id,
+            'data': bytes(self.data).hex(),
+            'rorg': f'{self.rorg:02X}',
+            'priority': self.priority,
+            'kind': self.kind,
+            'ack': self.ack,
+            'ack_rorg': f'{self.ack_rorg:02X}' if self.ack_rorg is not None else None,
+            'state': self.state,
+            'attempts': self.attempts,
+            'error': self.error,
+            'created': self.created,
+            'sent': self.sent,
+            'acknowledged': self.acknowledged
+        }
+
+
+class CommandScheduler:
+    """Priority queue of outbound commands drained by a sender thread"""
+
+    def __init__(self, send, duty_cycle=0.01, duty_window=3600, min_interval_ms=100,
+                 ack_timeout=2.0, retries=2, ttl=60, history=50):
+        """
+        Initialize scheduler
+
+        Args:
+            send: Callable (receiver_id, data, rorg) returning True once the
+                telegram is handed to a transceiver
+            duty_cycle: Share of duty_window the transmitter may be on air
+            duty_window: Seconds over which airtime is budgeted
+            min_interval_ms: Minimum time between two sends
+            ack_timeout: Seconds to wait for a telegram from the target before a retry
+            retries: Default number of retries of an unacknowledged command
+            ttl: Default seconds a command may wait before it is dropped, 0 for no limit
+            history: Finished commands kept for status queries
+        """
+        self.send = send
+        self.duty_budget = duty_cycle * duty_window
+        self.duty_window = duty_window
+        self.min_interval = max(0, min_interval_ms) / 1000.0
+        self.ack_timeout = ack_timeout
+        self.retries = retries
+        self.ttl = ttl
+        self.history = history
+
+        self._queue = []
+        self._sequence = itertools.count()
+        self._commands = OrderedDict()
+        self._pending = {}
+        # receiver_id -> commands sent and waiting for a telegram from it
+        self._awaiting = {}
+        # Commands no gateway could send, waiting for their retry_at
+        self._delayed = []
+        # (send time, airtime) within the duty window
+        self._airtime = deque()
+        self._airtime_used = 0.0
+        self._last_send = 0.0
+
+        self._condition = threading.Condition()
+        self._running = False
+        self._thread = None
+
+        self.stats = {state: 0 for state in FINAL_STATES}
+        self.stats.update({'submitted': 0, 'sent': 0, 'retried': 0})
+
+    @classmethod
+    def from_config(cls, send, config):
+        """Build a scheduler from the 'commands' section of the configuration"""
+        options = config.get('commands', {})
+        return cls(
+            send,
+            duty_cycle=options.get('duty_cycle', 0.01),
+            duty_window=options.get('duty_window', 3600),
+            min_interval_ms=options.get('min_interval_ms', 100),
+            ack_timeout=options.get('ack_timeout', 2.0),
+            retries=options.get('retries', 2),
+            ttl=options.get('ttl', 60),
+            history=options.get('history', 50)
+        )
+
+    def start(self):
+        """Start the sender thread"""
+        if self._running:
+            return
+
+        self._running = True
+        self._thread = threading.Thread(target=self._send_loop, name='command-scheduler', daemon=True)
+        self._thread.start()
+        logger.info(
+            f"Command scheduler started (min_interval={self.min_interval}s, "
+            f"duty budget={self.duty_budget}s per {self.duty_window}s)"
+        )
+
+    def stop(self, timeout=5):
+        """Stop the sender thread, pending commands are not sent"""
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+
+        if self._thread:
+            self._thread.join(timeout=timeout)
+            self._thread = None
+        logger.info("Command scheduler stopped")
+
+    def submit(self, receiver_id, data, rorg=0xA5, priority='normal', kind=None, ack=True,
+               retries=None, ttl=None, command_id=None, ack_rorg=None):
+        """
+        Queue a command
+
+        Args:
+            receiver_id: Target device ID
+            data: Payload bytes, or hex string
+            rorg: Radio organization byte, or hex string
+            priority: Key of PRIORITIES
+            kind: Commands of the same kind to the same device replace each
+                other, None never coalesces
+            ack: Wait for a telegram from the target and retry without one
+            ack_rorg: RORG the acknowledging telegram must have, any if None
+            retries: Retries without acknowledgement, the scheduler default if None
+            ttl: Seconds the command may wait, the scheduler default if None
+            command_id: Identifier, generated if None
+
+        Returns:
+            Command
+
+        Raises:
+            ValueError: If the device ID, payload, RORG or priority is invalid
+        """
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority '{priority}', expected " + ', '.join(PRIORITIES))
+        receiver_id = format_device_id(receiver_id)
+        if isinstance(data, str):
+            data = bytes.fromhex(data)
+        data = bytes(data)
+        if not data:
+            raise ValueError("Command payload is empty")
+        rorg = self._parse_rorg(rorg)
+        if ack_rorg is not None:
+            ack_rorg = self._parse_rorg(ack_rorg)
+
+        command = Command(
+            command_id or uuid.uuid4().hex[:12], receiver_id, data, rorg, priority, kind, bool(ack),
+            self.retries if retries is None else int(retries), self.ttl if ttl is None else ttl,
+            next(self._sequence), ack_rorg=ack_rorg
+        )
+
+        with self._condition:
+            key = command.coalesce_key
+            previous = self._pending.get(key) if key else None
+            if previous is not None and previous.state != 'sending':
+                # Not sent yet, or waiting for an acknowledgement: the new one stands for it
+                self._finish(previous, 'superseded')
+            if key:
+                self._pending[key] = command
+
+            self._commands[command.id] = command
+            heapq.heappush(self._queue, (PRIORITIES[priority], command.sequence, command))
+            self.stats['submitted'] += 1
+            self._trim_history()
+            self._condition.notify()
+
+        logger.debug(f"Queued command {command.id} to {receiver_id} ({priority})")
+        return command
+
+    @staticmethod
+    def _parse_rorg(rorg):
+        """RORG byte from an int or a hex string"""
+        rorg = int(rorg, 16) if isinstance(rorg, str) else int(rorg)
+        if not 0 <= rorg <= 0xFF:
+            raise ValueError(f"Invalid RORG {rorg}")
+        return rorg
+
+    def cancel(self, command_id):
+        """
+        Cancel a command that is not finished
+
+        Returns:
+            True if it was cancelled, False if unknown or already finished
+        """
+        with self._condition:
+            command = self._commands.get(command_id)
+            if command is None or command.state in FINAL_STATES:
+                return False
+            self._finish(command, 'cancelled')
+            self._condition.notify()
+            return True
+
+    def get(self, command_id):
+        """Dictionary view of a command, None if unknown"""
+        with self._condition:
+            command = self._commands.get(command_id)
+            return command.to_dict() if command else None
+
+    def recent(self):
+        """Dictionary views of the known commands, newest first"""
+        with self._condition:
+            return [command.to_dict() for command in reversed(self._commands.values())]
+
+    def observe(self, telegram):
+        """
+        Acknowledge the commands a received telegram answers
+
+        The telegram must come from the command's target, be received after
+        the command's last transmission and have its ack_rorg, if any.
+        """
+        if not self._awaiting:
+            return
+
+        with self._condition:
+            commands = self._awaiting.get(telegram.sender_id)
+            if not commands:
+                return
+            for command in list(commands):
+                if command.state != 'sent' or telegram.timestamp < command.sent:
+                    continue
+                if command.ack_rorg is not None and telegram.rorg != command.ack_rorg:
+                    continue
+                command.acknowledged = time.time()
+                self._finish(command, 'done')
+
+    def _finish(self, command, state, error=None):
+        """Move a command to a final state, with the condition held"""
+        command.state = state
+        command.error = error
+        self.stats[state] += 1
+        key = command.coalesce_key
+        if key and self._pending.get(key) is command:
+            del self._pending[key]
+        awaiting = self._awaiting.get(command.receiver_id)
+        if awaiting and command in awaiting:
+            awaiting.remove(command)
+            if not awaiting:
+                del self._awaiting[command.receiver_id]
+
+    def _trim_history(self):
+        """Forget the oldest finished commands beyond the history size"""
+        excess = len(self._commands) - self.history
+        if excess <= 0:
+            return
+        for command_id in [
+            command_id for command_id, command in self._commands.items()
+            if command.state in FINAL_STATES
+        ][:excess]:
+            del self._commands[command_id]
+
+    def _duty_ready_at(self, now, needed):
+        """Monotonic time at which needed seconds of airtime fit in the budget"""
+        while self._airtime and self._airtime[0][0] <= now - self.duty_window:
+            self._airtime_used -= self._airtime.popleft()[1]
+
+        used = self._airtime_used
+        for sent, seconds in self._airtime:
+            if used + needed <= self.duty_budget:
+                break
+            # Enough airtime frees up once this send leaves the window
+            used -= seconds
+            now = sent + self.duty_window
+        return now
+
+    def _check_acknowledgements(self, now):
+        """Retry or fail sent commands whose acknowledgement is overdue"""
+        for commands in list(self._awaiting.values()):
+            for command in list(commands):
+                if command.ack_deadline > now:
+                    continue
+                if command.attempts > command.retries:
+                    self._finish(command, 'failed', 'No acknowledgement')
+                    logger.warning(f"Command {command.id} to {command.receiver_id} not acknowledged")
+                    continue
+                commands.remove(command)
+                if not commands:
+                    self._awaiting.pop(command.receiver_id, None)
+                command.state = 'queued'
+                self.stats['retried'] += 1
+                heapq.heappush(self._queue, (PRIORITIES[command.priority], command.sequence, command))
+
+    def _release_retries(self, now):
+        """Queue again the commands whose backoff is over"""
+        delayed = []
+        for command in self._delayed:
+            if command.state != 'retrying':
+                # Superseded or cancelled meanwhile
+                continue
+            if command.retry_at > now:
+                delayed.append(command)
+                continue
+            command.state = 'queued'
+            heapq.heappush(self._queue, (PRIORITIES[command.priority], command.sequence, command))
+        self._delayed = delayed
+
+    def _next_wakeup(self, now):
+        """Seconds until the next acknowledgement deadline or retry, None if there is none"""
+        deadlines = [command.ack_deadline for commands in self._awaiting.values() for command in commands]
+        deadlines += [command.retry_at for command in self._delayed]
+        return max(0, min(deadlines) - now) if deadlines else None
+
+    def _send_loop(self):
+        """Send queued commands in priority order, as pacing allows"""
+        while True:
+            with self._condition:
+                if not self._running:
+                    return
+
+                now = time.monotonic()
+                self._check_acknowledgements(now)
+                self._release_retries(now)
+
+                # Drop what was superseded, cancelled or acknowledged while queued
+                while self._queue and self._queue[0][2].state != 'queued':
+                    heapq.heappop(self._queue)
+                if not self._queue:
+                    self._condition.wait(self._next_wakeup(now))
+                    continue
+
+                command = self._queue[0][2]
+                if command.expires is not None and command.expires <= now:
+                    heapq.heappop(self._queue)
+                    self._finish(command, 'expired', 'Not sent before its ttl')
+                    continue
+
+                seconds = airtime(len(command.data) + 6)
+                ready = max(self._last_send + self.min_interval, self._duty_ready_at(now, seconds))
+                if ready > now:
+                    # A higher priority command may arrive meanwhile
+                    wakeup = self._next_wakeup(now)
+                    self._condition.wait(ready - now if wakeup is None else min(ready - now, wakeup))
+                    continue
+
+                heapq.heappop(self._queue)
+                command.state = 'sending'
+                command.attempts += 1
+                self._airtime.append((now, seconds))
+                self._airtime_used += seconds
+
+            transmitted = time.time()
+            try:
+                sent = self.send(command.receiver_id, command.data, command.rorg)
+                error = None if sent else 'No gateway could send'
+            except Exception as e:
+                sent, error = False, str(e)
+
+            with self._condition:
+                self._last_send = time.monotonic()
+                if command.state != 'sending':
+                    # Cancelled while on air
+                    continue
+                key = command.coalesce_key
+                if key and self._pending.get(key) is not command:
+                    # A newer command of the same kind was queued while on air
+                    self._finish(command, 'superseded')
+                elif not sent:
+                    self._send_failed(command, error)
+                elif not command.ack:
+                    self.stats['sent'] += 1
+                    command.sent = transmitted
+                    self._finish(command, 'done')
+                else:
+                    self.stats['sent'] += 1
+                    command.sent = transmitted
+                    command.state = 'sent'
+                    command.error = None
+                    command.ack_deadline = time.monotonic() + self.ack_timeout
+                    self._awaiting.setdefault(command.receiver_id, []).append(command)
+
+    def _send_failed(self, command, error):
+        """Retry a command nothing was transmitted for after a backoff, or fail it"""
+        if command.attempts > command.retries:
+            self._finish(command, 'failed', error)
+            logger.warning(f"Command {command.id} to {command.receiver_id} failed: {error}")
+            return
+        command.state = 'retrying'
+        command.error = error
+        command.retry_at = time.monotonic() + min(self.ack_timeout * 2 ** (command.attempts - 1), MAX_BACKOFF)
+        self._delayed.append(command)
+        self.stats['retried'] += 1
+
+    def depth(self):
+        """Commands waiting to be sent"""
+        with self._condition:
+            return sum(1 for _, _, command in self._queue if command.state == 'queued')
+
+    def get_stats(self):
+        """Get scheduler statistics"""
+        with self._condition:
+            return {
+                **self.stats,
+                'queued': sum(1 for _, _, command in self._queue if command.state == 'queued'),
+                'awaiting_ack': sum(len(commands) for commands in self._awaiting.values()),
+                'retrying': sum(1 for command in self._delayed if command.state == 'retrying'),
+                'airtime_used': round(self._airtime_used, 4),
+                'airtime_budget': self.duty_budget
+            }
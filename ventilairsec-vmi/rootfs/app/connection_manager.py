@@ -0,0 +1,192 @@
+"""
+Connection Manager - One WAL writer connection and a pool of SQLite readers
+"""
+
+import logging
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionManager:
+    """Hand out SQLite connections so readers never wait on the writer"""
+
+    # Pragmas applied to every connection, overridable from the configuration
+    DEFAULT_PRAGMAS = {
+        'synchronous': 'NORMAL',
+        'cache_size': -8000,        # negative = KiB, so 8 MiB
+        'mmap_size': 64 * 1024 * 1024,
+        'temp_store': 'MEMORY'
+    }
+
+    # Accepted values for pragmas that take keywords
+    PRAGMA_KEYWORDS = {
+        'synchronous': ('OFF', 'NORMAL', 'FULL', 'EXTRA'),
+        'temp_store': ('DEFAULT', 'FILE', 'MEMORY')
+    }
+
+    def __init__(self, db_path, pragmas=None, reader_pool_size=4, timeout=10, setup=None):
+        """
+        Initialize connection manager
+
+        Args:
+            db_path: Path to the database file
+            pragmas: Dictionary overriding DEFAULT_PRAGMAS
+            reader_pool_size: Maximum number of read-only connections
+            timeout: Seconds to wait on a locked database or an empty pool
+            setup: Callable(connection) run on every new connection, e.g. to
+                register SQL functions
+        """
+        self.db_path = str(db_path)
+        self.pragmas = self._validate_pragmas({**self.DEFAULT_PRAGMAS, **(pragmas or {})})
+        self.reader_pool_size = max(1, int(reader_pool_size))
+        self.timeout = timeout
+        self.setup = setup
+
+        self._writer = None
+        self._write_lock = threading.RLock()
+        self._readers = queue.LifoQueue()
+        self._reader_count = 0
+        self._pool_lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, db_path, options, setup=None):
+        """Build a connection manager from the 'database' configuration section"""
+        pragmas = {key: options[key] for key in cls.DEFAULT_PRAGMAS if key in options}
+        return cls(
+            db_path,
+            pragmas=pragmas,
+            reader_pool_size=options.get('reader_pool_size', 4),
+            timeout=options.get('timeout', 10),
+            setup=setup
+        )
+
+    def _validate_pragmas(self, pragmas):
+        """Reject pragma values that cannot be safely inlined in SQL"""
+        validated = {}
+        for name, value in pragmas.items():
+            if name in self.PRAGMA_KEYWORDS:
+                value = str(value).upper()
+                if value not in self.PRAGMA_KEYWORDS[name]:
+                    raise ValueError(f"Invalid value for PRAGMA {name}: {value}")
+            else:
+                value = int(value)
+            validated[name] = value
+        return validated
+
+    def open(self):
+        """Open the writer connection and switch the database to WAL mode"""
+        self._writer = sqlite3.connect(
+            self.db_path,
+            check_same_thread=False,
+            timeout=self.timeout
+        )
+        self._writer.row_factory = sqlite3.Row
+
+        # Only takes effect on a new database or at the next VACUUM
+        self._writer.execute('PRAGMA auto_vacuum=INCREMENTAL')
+
+        mode = self._writer.execute('PRAGMA journal_mode=WAL').fetchone()[0]
+        if mode.lower() != 'wal':
+            logger.warning(f"Could not enable WAL mode, journal_mode is {mode}")
+
+        self._apply_pragmas(self._writer)
+        logger.debug(f"Writer connection opened with pragmas {self.pragmas}")
+
+    def _apply_pragmas(self, connection):
+        """Apply the configured pragmas and the setup callable to a connection"""
+        for name, value in self.pragmas.items():
+            connection.execute(f'PRAGMA {name}={value}')
+        if self.setup:
+            self.setup(connection)
+
+    def _create_reader(self):
+        """Open a new read-only connection"""
+        connection = sqlite3.connect(
+            f'file:{self.db_path}?mode=ro',
+            uri=True,
+            check_same_thread=False,
+            timeout=self.timeout
+        )
+        connection.row_factory = sqlite3.Row
+        self._apply_pragmas(connection)
+        return connection
+
+    @contextmanager
+    def writer(self):
+        """
+        Borrow the writer connection
+
+        Only one thread holds it at a time; readers are never blocked by it.
+        """
+        if self._writer is None:
+            raise RuntimeError("Connection manager is not open")
+
+        with self._write_lock:
+            yield self._writer
+
+    @contextmanager
+    def reader(self):
+        """Check a read-only connection out of the pool for the duration of a request"""
+        connection = None
+        try:
+            connection = self._readers.get_nowait()
+        except queue.Empty:
+            with self._pool_lock:
+                if self._reader_count < self.reader_pool_size:
+                    self._reader_count += 1
+                    create = True
+                else:
+                    create = False
+
+            if create:
+                try:
+                    connection = self._create_reader()
+                except Exception:
+                    with self._pool_lock:
+                        self._reader_count -= 1
+                    raise
+            else:
+                try:
+                    connection = self._readers.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise TimeoutError("No database reader available")
+
+        try:
+            yield connection
+        finally:
+            if connection.in_transaction:
+                connection.rollback()
+            self._readers.put(connection)
+
+    def get_stats(self):
+        """
+        Get pool statistics
+
+        Returns:
+            Dictionary with reader pool usage
+        """
+        idle = self._readers.qsize()
+        return {
+            'readers_open': self._reader_count,
+            'readers_idle': idle,
+            'readers_busy': self._reader_count - idle,
+            'reader_pool_size': self.reader_pool_size
+        }
+
+    def close(self):
+        """Close every connection"""
+        while True:
+            try:
+                self._readers.get_nowait().close()
+            except queue.Empty:
+                break
+        self._reader_count = 0
+
+        if self._writer:
+            with self._write_lock:
+                self._writer.close()
+                self._writer = None
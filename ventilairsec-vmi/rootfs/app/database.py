@@ -3,26 +3,117 @@ Database Management - SQLite for data storage and history
 """
 
 import sqlite3
+import itertools
 import logging
 import json
+import time
 from datetime import datetime, timedelta
 from pathlib import Path
 
+from connection_manager import ConnectionManager
+from records import Reading
+import archive
+import migrations
+import instrumentation
+import rollups
+import sketches
+
 logger = logging.getLogger(__name__)
 
 
+def to_epoch(value):
+    """
+    Convert a timestamp to integer epoch seconds
+    
+    Args:
+        value: ISO string, datetime, or epoch seconds
+    
+    Returns:
+        Integer epoch seconds, or None if the value cannot be read
+    """
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, datetime):
+        return int(value.timestamp())
+    try:
+        return int(datetime.fromisoformat(str(value)).timestamp())
+    except ValueError:
+        return None
+
+
+def to_iso(epoch):
+    """Format integer epoch seconds the way the API always returned timestamps"""
+    if epoch is None:
+        return None
+    return datetime.fromtimestamp(epoch).isoformat()
+
+
 class Database:
     """SQLite database for storing sensor readings and history"""
     
-    def __init__(self, db_path):
+    # Storage format written by this version (PRAGMA user_version)
+    SCHEMA_VERSION = 3
+    
+    # Retention tiers: table, time column, and rollup resolution if any
+    RETENTION_TIERS = {
+        'raw': (('readings', 'timestamp', None), ('telegrams', 'timestamp', None)),
+        **{
+            name: (('rollups', 'bucket', seconds),)
+            for name, seconds in rollups.RESOLUTIONS.items()
+        }
+    }
+    
+    # Per-point values get_series can return, in rollup column order
+    SERIES_FIELDS = ('value', 'min', 'max', 'last', 'count')
+    
+    def __init__(self, db_path, options=None):
         """
         Initialize database
         
         Args:
             db_path: Path to database directory
+            options: 'database' configuration section (pragmas, reader pool size)
         """
         self.db_path = Path(db_path) / 'ventilairsec.db'
-        self.connection = None
+        self.options = options or {}
+        self.connections = None
+        
+        # Parquet archive of cold readings, see attach_archive()
+        self.archive = None
+        
+        # Change-only storage of readings, see attach_change_filter()
+        self.change_filter = None
+        
+        # Surrogate keys, only touched while holding the writer connection
+        self._device_keys = {}
+        self._metric_keys = {}
+        self._metric_units = {}
+        
+        # PRAGMA data_version of the writer connection, see changed_elsewhere()
+        self._data_version = None
+    
+    def attach_archive(self, archive):
+        """
+        Move readings past raw retention to an archive instead of deleting them
+        
+        Args:
+            archive: archive.Archive, whose points are then unioned into raw
+                history and statistics queries
+        """
+        self.archive = archive
+    
+    def attach_change_filter(self, change_filter):
+        """
+        Store readings only when their value changes
+        
+        Args:
+            change_filter: change_filter.ChangeFilter deciding which values
+                become readings rows; rollups and latest values still get
+                every value, and raw series are reconstructed from it
+        """
+        self.change_filter = change_filter
     
     def initialize(self):
         """Initialize database and create tables"""
@@ -35,114 +126,393 @@ class Database:
             raise
     
     def _create_connection(self):
-        """Create database connection"""
+        """Create the writer connection and the reader pool"""
         try:
-            self.connection = sqlite3.connect(
-                str(self.db_path),
-                check_same_thread=False,
-                timeout=10
+            self.connections = ConnectionManager.from_config(
+                self.db_path, self.options, setup=sketches.register
             )
-            self.connection.row_factory = sqlite3.Row
+            self.connections.open()
         except Exception as e:
             logger.error(f"Failed to connect to database: {e}")
             raise
     
     def _create_tables(self):
-        """Create database tables if they don't exist"""
+        """Create database tables if they don't exist, migrating older formats"""
         try:
-            cursor = self.connection.cursor()
-            
-            # Readings table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS readings (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    device_id TEXT NOT NULL,
-                    device_type TEXT,
-                    device_name TEXT,
-                    metric_name TEXT,
-                    metric_value REAL,
-                    metric_unit TEXT,
-                    raw_data TEXT,
-                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    recorded_at DATETIME DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            
-            # Create index for faster queries
-            cursor.execute('''
-                CREATE INDEX IF NOT EXISTS idx_device_timestamp
-                ON readings(device_id, timestamp DESC)
-            ''')
-            
-            # Devices table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS devices (
-                    id TEXT PRIMARY KEY,
-                    name TEXT,
-                    type TEXT,
-                    last_seen DATETIME,
-                    status TEXT
-                )
-            ''')
-            
-            # Settings table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS settings (
-                    key TEXT PRIMARY KEY,
-                    value TEXT
-                )
-            ''')
+            with self.connections.writer() as connection:
+                version = connection.execute('PRAGMA user_version').fetchone()[0]
+                if version < self.SCHEMA_VERSION and migrations.has_v1_schema(connection):
+                    migrations.rename_v1_tables(connection)
+                
+                with connection:
+                    self._create_schema(connection.cursor())
+                
+                if not migrations.has_rollup_sketches(connection):
+                    migrations.add_rollup_sketches(connection, rollups.RESOLUTIONS.values())
+                
+                # Also resumes a migration that was interrupted
+                if migrations.has_v1_tables(connection):
+                    self._load_keys(connection)
+                    migrations.migrate_v1_to_v2(
+                        connection,
+                        self._device_key,
+                        self._metric_key,
+                        chunk_size=self.options.get('migration_chunk_size', 5000),
+                        vacuum=self.options.get('vacuum_after_migration', True)
+                    )
+                
+                self._backfill_latest_metrics(connection)
+                self._backfill_rollups(connection)
+                
+                connection.execute(f'PRAGMA user_version={self.SCHEMA_VERSION}')
+                self._load_keys(connection)
             
-            self.connection.commit()
             logger.debug("Database tables created successfully")
             
         except Exception as e:
             logger.error(f"Error creating tables: {e}")
             raise
     
+    def _create_schema(self, cursor):
+        """Create the storage format v2 tables"""
+        # Devices, interned to integer keys
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS devices (
+                id INTEGER PRIMARY KEY,
+                address TEXT NOT NULL UNIQUE,
+                name TEXT,
+                type TEXT,
+                last_seen INTEGER,
+                status TEXT
+            )
+        ''')
+        
+        # Metric names, interned to integer keys
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS metrics (
+                id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL UNIQUE,
+                unit TEXT
+            )
+        ''')
+        
+        # Raw payloads, once per telegram
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS telegrams (
+                id INTEGER PRIMARY KEY,
+                device_id INTEGER NOT NULL,
+                timestamp INTEGER NOT NULL,
+                raw_data BLOB
+            )
+        ''')
+        
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_telegrams_device_timestamp
+            ON telegrams(device_id, timestamp)
+        ''')
+        
+        # Readings table, clustered on (device_id, timestamp) so the
+        # primary key is the only index
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS readings (
+                device_id INTEGER NOT NULL,
+                timestamp INTEGER NOT NULL,
+                metric_id INTEGER NOT NULL,
+                value REAL,
+                PRIMARY KEY (device_id, timestamp, metric_id)
+            ) WITHOUT ROWID
+        ''')
+        
+        # Latest value of every metric, upserted on ingest
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS latest_metrics (
+                device_id INTEGER NOT NULL,
+                metric_id INTEGER NOT NULL,
+                timestamp INTEGER NOT NULL,
+                value REAL,
+                PRIMARY KEY (device_id, metric_id)
+            ) WITHOUT ROWID
+        ''')
+        
+        # Downsampled history
+        rollups.create_table(cursor)
+        
+        # Settings table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS settings (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        ''')
+    
+    def _backfill_latest_metrics(self, connection):
+        """Fill latest_metrics from readings when it was created on an existing database"""
+        if connection.execute('SELECT 1 FROM latest_metrics LIMIT 1').fetchone():
+            return
+        
+        with connection:
+            # SQLite takes the bare value column from the row holding MAX(timestamp)
+            cursor = connection.execute('''
+                INSERT INTO latest_metrics (device_id, metric_id, timestamp, value)
+                SELECT device_id, metric_id, MAX(timestamp), value
+                FROM readings
+                GROUP BY device_id, metric_id
+            ''')
+        
+        if cursor.rowcount > 0:
+            logger.info(f"Initialized latest values for {cursor.rowcount} metrics")
+    
+    def _backfill_rollups(self, connection):
+        """Build the rollups when the table was created on an existing database"""
+        if connection.execute('SELECT 1 FROM rollups LIMIT 1').fetchone():
+            return
+        if not connection.execute('SELECT 1 FROM readings LIMIT 1').fetchone():
+            return
+        
+        rollups.backfill(connection)
+    
+    def _load_keys(self, connection):
+        """Load the device and metric surrogate keys"""
+        self._device_keys = {
+            row['address']: row['id']
+            for row in connection.execute('SELECT id, address FROM devices')
+        }
+        self._metric_keys = {}
+        self._metric_units = {}
+        for row in connection.execute('SELECT id, name, unit FROM metrics'):
+            self._metric_keys[row['name']] = row['id']
+            self._metric_units[row['name']] = row['unit']
+    
+    def _refresh_keys(self):
+        """
+        Add the keys created since the maps were loaded
+        
+        Gunicorn workers load the maps when they start and never write:
+        devices and metrics the pipeline process creates later are read
+        from the database here. Entries are added in place, the writer may
+        be using the maps.
+        """
+        with self.connections.reader() as connection:
+            for row in connection.execute('SELECT id, address FROM devices'):
+                self._device_keys.setdefault(row['address'], row['id'])
+            for row in connection.execute('SELECT id, name, unit FROM metrics'):
+                self._metric_keys.setdefault(row['name'], row['id'])
+                self._metric_units.setdefault(row['name'], row['unit'])
+    
+    def _lookup_keys(self, device_id=None, metric_name=None):
+        """
+        Keys of a device and a metric for a query, reloaded on a miss
+        
+        Returns:
+            (device key, metric key), None where unknown
+        """
+        keys = (self._device_keys.get(device_id), self._metric_keys.get(metric_name))
+        if (device_id is not None and keys[0] is None) or (metric_name is not None and keys[1] is None):
+            self._refresh_keys()
+            keys = (self._device_keys.get(device_id), self._metric_keys.get(metric_name))
+        return keys
+    
+    def _device_key(self, cursor, address, name=None, device_type=None):
+        """Get the integer key of a device, creating it on first sight"""
+        key = self._device_keys.get(address)
+        if key is None:
+            cursor.execute('''
+                INSERT INTO devices (address, name, type, status)
+                VALUES (?, ?, ?, 'online')
+                ON CONFLICT(address) DO NOTHING
+            ''', (address, name, device_type))
+            key = cursor.execute(
+                'SELECT id FROM devices WHERE address = ?', (address,)
+            ).fetchone()[0]
+            self._device_keys[address] = key
+        return key
+    
+    def _metric_key(self, cursor, name, unit=None):
+        """Get the integer key of a metric name, creating it on first sight"""
+        key = self._metric_keys.get(name)
+        if key is None:
+            cursor.execute('''
+                INSERT INTO metrics (name, unit) VALUES (?, ?)
+                ON CONFLICT(name) DO NOTHING
+            ''', (name, unit))
+            key = cursor.execute(
+                'SELECT id FROM metrics WHERE name = ?', (name,)
+            ).fetchone()[0]
+            self._metric_keys[name] = key
+            self._metric_units[name] = unit
+        elif unit and self._metric_units.get(name) != unit:
+            cursor.execute('UPDATE metrics SET unit = ? WHERE id = ?', (unit, key))
+            self._metric_units[name] = unit
+        return key
+    
     def insert_reading(self, parsed_data):
         """
         Insert a new reading into the database
         
         Args:
-            parsed_data: Dictionary with parsed sensor data
+            parsed_data: Reading, or dictionary with parsed sensor data
+        """
+        if not parsed_data or not isinstance(parsed_data, (Reading, dict)):
+            return False
+        
+        return self.insert_readings([parsed_data])
+    
+    def insert_readings(self, batch):
+        """
+        Insert a batch of readings in a single transaction
+        
+        Args:
+            batch: List of Reading (dictionaries with parsed sensor data are
+                also accepted)
+        
+        Returns:
+            True if the batch was committed
         """
         try:
-            if not parsed_data or not isinstance(parsed_data, dict):
-                return False
+            now = int(datetime.now().timestamp())
             
-            device_id = parsed_data.get('device_id')
-            device_type = parsed_data.get('device_type')
-            device_name = parsed_data.get('device_name')
+            with self.connections.writer() as connection:
+                started = time.perf_counter()
+                change_filter = self.change_filter
+                if change_filter is not None:
+                    change_filter.begin()
+                try:
+                    with connection:
+                        result = self._insert_batch(connection.cursor(), batch, now)
+                except Exception:
+                    # Keys created in the rolled back transaction are gone,
+                    # and the filter must forget the rows it meant to store
+                    self._load_keys(connection)
+                    if change_filter is not None:
+                        change_filter.rollback()
+                    raise
+                if change_filter is not None:
+                    change_filter.commit()
+                instrumentation.DB_COMMIT_SECONDS.observe(time.perf_counter() - started)
+                return result
+                
+        except Exception as e:
+            instrumentation.ERRORS.inc(component='database')
+            logger.error(f"Error inserting readings: {e}")
+            return False
+    
+    def _insert_batch(self, cursor, batch, now):
+        """Write a batch of readings inside the caller's transaction"""
+        devices = {}
+        telegrams = []
+        # Values by readings primary key: a second telegram within the same
+        # second replaces the first, in the readings table and in the rollups
+        values = {}
+        change_filter = self.change_filter
+        
+        for reading in batch:
+            if isinstance(reading, dict):
+                reading = Reading.from_dict(reading)
+            elif not isinstance(reading, Reading):
+                continue
             
-            cursor = self.connection.cursor()
+            timestamp = to_epoch(reading.timestamp) or now
+            units = reading.units
             
-            # Update device status
-            cursor.execute('''
-                INSERT OR REPLACE INTO devices (id, name, type, last_seen, status)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (device_id, device_name, device_type, datetime.now(), 'online'))
+            device_key = self._device_key(cursor, reading.device_id, reading.device_name, reading.device_type)
             
-            # Insert metrics from data
-            timestamp = parsed_data.get('timestamp', datetime.now().isoformat())
-            raw_data = parsed_data.get('raw_data', '')
+            # Last one wins for the device status
+            devices[device_key] = (reading.device_name, reading.device_type, now, 'online', device_key)
             
-            # Extract and insert all numeric metrics
-            for key, value in parsed_data.items():
-                if key not in ['device_id', 'device_type', 'device_name', 'timestamp', 'raw_data']:
-                    if isinstance(value, (int, float)):
-                        cursor.execute('''
-                            INSERT INTO readings
-                            (device_id, device_type, device_name, metric_name, metric_value, timestamp, raw_data)
-                            VALUES (?, ?, ?, ?, ?, ?, ?)
-                        ''', (device_id, device_type, device_name, key, value, timestamp, raw_data))
+            if reading.raw:
+                payload = reading.raw_bytes
+                if change_filter is None or change_filter.keep_telegram(device_key, timestamp, payload):
+                    telegrams.append((device_key, timestamp, payload))
             
-            self.connection.commit()
-            return True
-            
-        except Exception as e:
-            logger.error(f"Error inserting reading: {e}")
+            for name, value in reading.values:
+                values[(device_key, timestamp, self._metric_key(cursor, name, units.get(name)))] = (name, value)
+        
+        if not devices:
             return False
+        
+        rows = [key + (value,) for key, (_, value) in values.items()]
+        if change_filter is None:
+            # Rows of the readings table
+            stored = rows
+        else:
+            stored = []
+            for (device_key, timestamp, metric_key), (name, value) in values.items():
+                stored.extend(change_filter.filter(device_key, metric_key, name, timestamp, value))
+            instrumentation.STORED_VALUES.inc(len(stored), result='stored')
+            instrumentation.STORED_VALUES.inc(len(rows) - len(stored), result='skipped')
+        
+        # Update device status
+        cursor.executemany('''
+            UPDATE devices SET name = ?, type = ?, last_seen = ?, status = ?
+            WHERE id = ?
+        ''', list(devices.values()))
+        
+        cursor.executemany('''
+            INSERT INTO telegrams (device_id, timestamp, raw_data)
+            VALUES (?, ?, ?)
+        ''', telegrams)
+        
+        cursor.executemany('''
+            INSERT OR REPLACE INTO readings (device_id, timestamp, metric_id, value)
+            VALUES (?, ?, ?, ?)
+        ''', stored)
+        
+        # Out-of-order rows never overwrite a newer value
+        cursor.executemany('''
+            INSERT INTO latest_metrics (device_id, timestamp, metric_id, value)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (device_id, metric_id) DO UPDATE
+            SET timestamp = excluded.timestamp, value = excluded.value
+            WHERE excluded.timestamp >= latest_metrics.timestamp
+        ''', rows)
+        
+        cursor.executemany(rollups.UPSERT_SQL, rollups.aggregate(rows))
+        
+        return True
+    
+    def flush_held_points(self):
+        """
+        Write the points the swinging door has held for a heartbeat
+        
+        Called periodically by the ingest writer, so a crash loses at most
+        about a heartbeat of each series.
+        
+        Returns:
+            Number of points written
+        """
+        change_filter = self.change_filter
+        if change_filter is None:
+            return 0
+        
+        with self.connections.writer() as connection:
+            change_filter.begin()
+            try:
+                rows = change_filter.pending_rows(before=time.time() - change_filter.heartbeat)
+                if rows:
+                    with connection:
+                        connection.executemany('''
+                            INSERT OR REPLACE INTO readings (device_id, timestamp, metric_id, value)
+                            VALUES (?, ?, ?, ?)
+                        ''', rows)
+            except Exception:
+                change_filter.rollback()
+                raise
+            change_filter.commit()
+        return len(rows)
+    
+    def changed_elsewhere(self):
+        """
+        Whether another connection committed since the previous call
+        
+        PRAGMA data_version of the writer connection only moves on commits
+        of other connections: redecode, or POST /api/cleanup served by a
+        gunicorn worker.
+        """
+        with self.connections.writer() as connection:
+            version = connection.execute('PRAGMA data_version').fetchone()[0]
+        changed = self._data_version is not None and version != self._data_version
+        self._data_version = version
+        return changed
     
     def get_latest_readings(self):
         """
@@ -152,92 +522,65 @@ class Database:
             Dictionary with latest readings per device
         """
         try:
-            cursor = self.connection.cursor()
-            
-            cursor.execute('''
-                SELECT DISTINCT device_id, device_name, device_type, 
-                       MAX(timestamp) as last_update
-                FROM readings
-                GROUP BY device_id
-            ''')
-            
-            devices = {}
-            for row in cursor.fetchall():
-                device_id = row['device_id']
-                device_name = row['device_name']
-                device_type = row['device_type']
-                last_update = row['last_update']
+            with self.connections.reader() as connection:
+                cursor = connection.cursor()
                 
-                # Get latest metrics for this device
                 cursor.execute('''
-                    SELECT metric_name, metric_value, metric_unit
-                    FROM readings
-                    WHERE device_id = ?
-                    ORDER BY timestamp DESC
-                    LIMIT 100
-                ''', (device_id,))
+                    SELECT d.address, d.name AS device_name, d.type,
+                           m.name AS metric_name, l.value, l.timestamp
+                    FROM latest_metrics l
+                    JOIN devices d ON d.id = l.device_id
+                    JOIN metrics m ON m.id = l.metric_id
+                ''')
                 
-                metrics = {}
-                for metric in cursor.fetchall():
-                    metric_name = metric['metric_name']
-                    metric_value = metric['metric_value']
+                devices = {}
+                for row in cursor.fetchall():
+                    device = devices.get(row['address'])
+                    if device is None:
+                        device = devices[row['address']] = {
+                            'name': row['device_name'],
+                            'type': row['type'],
+                            'last_update': row['timestamp'],
+                            'metrics': {}
+                        }
                     
-                    # Keep only the latest value for each metric
-                    if metric_name not in metrics:
-                        metrics[metric_name] = metric_value
+                    device['metrics'][row['metric_name']] = row['value']
+                    device['last_update'] = max(device['last_update'], row['timestamp'])
+                
+                for device in devices.values():
+                    device['last_update'] = to_iso(device['last_update'])
+                
+                return devices
                 
-                devices[device_id] = {
-                    'name': device_name,
-                    'type': device_type,
-                    'last_update': last_update,
-                    'metrics': metrics
-                }
-            
-            return devices
-            
         except Exception as e:
             logger.error(f"Error getting latest readings: {e}")
             return {}
     
-    def get_readings_history(self, device_id, hours=24):
+    def get_readings_history(self, device_id, hours=24, resolution=None):
         """
         Get historical readings for a device
         
         Args:
             device_id: Device identifier
             hours: Number of hours to retrieve
+            resolution: 'raw', a rollup resolution ('1m', '15m', '1h', '1d'),
+                or None to pick one from the window
         
         Returns:
-            List of readings
+            List of readings, newest first
         """
         try:
-            cursor = self.connection.cursor()
-            
-            start_time = datetime.now() - timedelta(hours=hours)
-            
-            cursor.execute('''
-                SELECT timestamp, metric_name, metric_value, metric_unit
-                FROM readings
-                WHERE device_id = ? AND timestamp >= ?
-                ORDER BY timestamp DESC
-            ''', (device_id, start_time.isoformat()))
-            
-            readings = []
-            for row in cursor.fetchall():
-                readings.append({
-                    'timestamp': row['timestamp'],
-                    'metric': row['metric_name'],
-                    'value': row['metric_value'],
-                    'unit': row['metric_unit']
-                })
-            
-            return readings
-            
+            return [
+                point for _, point in
+                self.iter_history(device_id, hours=hours, resolution=resolution, descending=True)
+            ]
+        except ValueError:
+            raise
         except Exception as e:
             logger.error(f"Error getting history: {e}")
             return []
     
-    def get_metric_history(self, device_id, metric_name, hours=24):
+    def get_metric_history(self, device_id, metric_name, hours=24, resolution=None):
         """
         Get historical data for a specific metric
         
@@ -245,34 +588,304 @@ class Database:
             device_id: Device identifier
             metric_name: Name of the metric
             hours: Number of hours to retrieve
+            resolution: 'raw', a rollup resolution ('1m', '15m', '1h', '1d'),
+                or None to pick one from the window
         
         Returns:
             List of metric values with timestamps
         """
         try:
-            cursor = self.connection.cursor()
+            return [
+                point for _, point in
+                self.iter_history(device_id, metric_name, hours=hours, resolution=resolution)
+            ]
+        except ValueError:
+            raise
+        except Exception as e:
+            logger.error(f"Error getting metric history: {e}")
+            return []
+    
+    def iter_history(self, device_id, metric_name=None, hours=24, resolution=None,
+                     after=None, limit=None, descending=False, chunk_size=2000):
+        """
+        Stream history points in keyset order
+        
+        Rows are read in chunks of chunk_size, each chunk with its own pooled
+        reader connection, so memory stays flat and a long export does not
+        hold a connection for its whole duration.
+        
+        Raw points are the readings rows as stored: with a change filter
+        they are the changes and heartbeats only, to be read as steps
+        (deadband) or joined by lines (swinging door); get_series
+        reconstructs the values in between.
+        
+        Args:
+            device_id: Device identifier
+            metric_name: Only this metric, all metrics of the device if None
+            hours: Number of hours to retrieve
+            resolution: 'raw', a rollup resolution, or None to pick one
+            after: Keyset cursor (epoch second, metric key or None); only
+                points strictly after it in the iteration order are returned
+            limit: Maximum number of points, None for all
+            descending: Newest first instead of oldest first
+            chunk_size: Rows fetched per query
+        
+        Returns:
+            Iterator of (cursor, point), cursor being the (timestamp, metric
+            key) to pass as after to resume behind this point
+        
+        Raises:
+            ValueError: If the resolution is unknown
+        """
+        resolution = rollups.choose_resolution(hours, resolution)
+        start = to_epoch(datetime.now() - timedelta(hours=hours))
+        
+        points = self._iter_stored_history(
+            device_id, metric_name, resolution, start, after, limit, descending, chunk_size
+        )
+        
+        # Archived readings are all older than the ones still in SQLite
+        archived_until = self.archive.archived_until(device_id) if self.archive else None
+        if resolution == rollups.RAW and archived_until is not None and start < archived_until:
+            archived = self._iter_archived_history(
+                device_id, metric_name, start, archived_until, after, descending
+            )
+            points = itertools.chain(points, archived) if descending else itertools.chain(archived, points)
+        
+        return itertools.islice(points, limit) if limit is not None else points
+    
+    def get_series(self, pairs, hours=24, resolution=None, fields=('value',)):
+        """
+        Read several device/metric series over one window, aligned on shared timestamps
+        
+        All series are read by a single query (readings or rollups joined on
+        the requested pairs), so a dashboard needs one round trip instead of
+        one per series.
+        
+        Args:
+            pairs: List of (device_id, metric_name)
+            hours: Number of hours to retrieve
+            resolution: 'raw', a rollup resolution, or None to pick one
+            fields: Per-point values to return, among SERIES_FIELDS; raw
+                readings only have 'value'
+        
+        Returns:
+            Dictionary with resolution, timestamps (epoch seconds, ascending)
+            and series, one per pair, holding an array per field with None
+            where the series has no point at that timestamp; with a change
+            filter, raw values between stored points are reconstructed
+        
+        Raises:
+            ValueError: If the resolution or a field is unknown
+        """
+        resolution = rollups.choose_resolution(hours, resolution)
+        unknown = set(fields) - set(self.SERIES_FIELDS)
+        if unknown:
+            raise ValueError(
+                f"Unknown fields {', '.join(sorted(unknown))}, expected "
+                + ', '.join(self.SERIES_FIELDS)
+            )
+        if resolution == rollups.RAW:
+            fields = ('value',)
+        start = to_epoch(datetime.now() - timedelta(hours=hours))
+        
+        keys = [self._lookup_keys(device_id, metric_name) for device_id, metric_name in pairs]
+        wanted = {key: index for index, key in enumerate(keys) if None not in key}
+        
+        rows = []
+        if wanted:
+            values = ', '.join('(?, ?)' for _ in wanted)
+            params = [part for key in wanted for part in key]
+            if resolution == rollups.RAW:
+                query = f'''
+                    WITH wanted(device_id, metric_id) AS (VALUES {values})
+                    SELECT r.timestamp, r.device_id, r.metric_id, r.value
+                    FROM wanted w
+                    JOIN readings r ON r.device_id = w.device_id AND r.metric_id = w.metric_id
+                    WHERE r.timestamp >= ?
+                '''
+                params.append(start)
+            else:
+                seconds = rollups.RESOLUTIONS[resolution]
+                query = f'''
+                    WITH wanted(device_id, metric_id) AS (VALUES {values})
+                    SELECT r.bucket, r.device_id, r.metric_id,
+                           r.sum / r.count, r.min, r.max, r.last, r.count
+                    FROM wanted w
+                    JOIN rollups r ON r.device_id = w.device_id AND r.metric_id = w.metric_id
+                    WHERE r.resolution = ? AND r.bucket >= ?
+                '''
+                params.extend((seconds, start - start % seconds))
             
-            start_time = datetime.now() - timedelta(hours=hours)
+            try:
+                with self.connections.reader() as connection:
+                    rows = connection.execute(query + ' ORDER BY 1', params).fetchall()
+                if resolution == rollups.RAW and self.archive is not None:
+                    rows = self._archived_series_rows(pairs, keys, wanted, start) + rows
+            except Exception as e:
+                logger.error(f"Error getting series: {e}")
+                rows = []
+        
+        # One shared time axis, a column per series and field
+        timestamps = []
+        columns = [{field: [] for field in fields} for _ in pairs]
+        positions = [self.SERIES_FIELDS.index(field) + 3 for field in fields]
+        for row in rows:
+            if not timestamps or timestamps[-1] != row[0]:
+                timestamps.append(row[0])
+                for series in columns:
+                    for array in series.values():
+                        array.append(None)
+            series = columns[wanted[(row[1], row[2])]]
+            for field, position in zip(fields, positions):
+                series[field][-1] = row[position]
+        
+        # Change-only storage leaves gaps where values did not change
+        if resolution == rollups.RAW and self.change_filter is not None and timestamps:
+            carried = self._carry_in(wanted, start)
+            for key, index in wanted.items():
+                columns[index]['value'] = self.change_filter.reconstruct(
+                    timestamps, columns[index]['value'], carried.get(key)
+                )
+        
+        return {
+            'resolution': resolution,
+            'timestamps': timestamps,
+            'series': [
+                {
+                    'device_id': device_id,
+                    'metric': metric_name,
+                    'unit': self._metric_units.get(metric_name),
+                    **columns[index]
+                }
+                for index, (device_id, metric_name) in enumerate(pairs)
+            ]
+        }
+    
+    def _carry_in(self, keys, start):
+        """Last stored point before start of each (device key, metric key), within the change filter's gap"""
+        carried = {}
+        try:
+            with self.connections.reader() as connection:
+                for device_key, metric_key in keys:
+                    row = connection.execute('''
+                        SELECT timestamp, value FROM readings
+                        WHERE device_id = ? AND metric_id = ? AND timestamp < ? AND timestamp >= ?
+                        ORDER BY timestamp DESC
+                        LIMIT 1
+                    ''', (device_key, metric_key, start, start - self.change_filter.max_gap)).fetchone()
+                    if row is not None:
+                        carried[(device_key, metric_key)] = (row['timestamp'], row['value'])
+        except Exception as e:
+            logger.error(f"Error reading series carry-in: {e}")
+        return carried
+    
+    def _archived_series_rows(self, pairs, keys, wanted, start):
+        """Archived raw rows of the requested series, in get_series row format"""
+        rows = []
+        for (device_id, metric_name), key in zip(pairs, keys):
+            archived_until = self.archive.archived_until(device_id)
+            if key not in wanted or archived_until is None or start >= archived_until:
+                continue
+            for table in self.archive.iter_months(device_id, metric_name, start, archived_until):
+                rows.extend(
+                    (timestamp, key[0], key[1], value)
+                    for timestamp, value in
+                    zip(table.column('timestamp').to_pylist(), table.column('value').to_pylist())
+                )
+        rows.sort(key=lambda row: row[0])
+        return rows
+    
+    def _iter_archived_history(self, device_id, metric_name, start, end, after, descending):
+        """Archived raw points in the order and format of _iter_stored_history"""
+        for table in self.archive.iter_months(device_id, metric_name, start, end, descending):
+            columns = table.to_pydict()
+            rows = sorted(
+                (
+                    (timestamp, self._lookup_keys(metric_name=name)[1] or 0, name, value)
+                    for timestamp, name, value in
+                    zip(columns['timestamp'], columns['metric'], columns['value'])
+                ),
+                reverse=descending
+            )
             
-            cursor.execute('''
-                SELECT timestamp, metric_value
-                FROM readings
-                WHERE device_id = ? AND metric_name = ? AND timestamp >= ?
-                ORDER BY timestamp ASC
-            ''', (device_id, metric_name, start_time.isoformat()))
+            for timestamp, metric_key, name, value in rows:
+                key = (timestamp, metric_key)
+                if after is not None:
+                    bound = after if after[1] is not None else (after[0], -1 if descending else float('inf'))
+                    if (key <= bound) if not descending else (key >= bound):
+                        continue
+                
+                point = {'timestamp': to_iso(timestamp)}
+                if metric_name is None:
+                    point['metric'] = name
+                    point['unit'] = self._metric_units.get(name)
+                point['value'] = value
+                yield key, point
+    
+    def _iter_stored_history(self, device_id, metric_name, resolution, start, after, limit,
+                             descending, chunk_size):
+        """History points kept in SQLite, see iter_history()"""
+        if resolution == rollups.RAW:
+            table, column, values = 'readings', 'timestamp', 'r.value'
+            params = {'start': start}
+            conditions = []
+        else:
+            seconds = rollups.RESOLUTIONS[resolution]
+            table, column, values = 'rollups', 'bucket', 'r.count, r.sum, r.min, r.max, r.last'
+            params = {'start': start - start % seconds, 'resolution': seconds}
+            conditions = ['r.resolution = :resolution']
+        
+        params['device'] = device_id
+        conditions.append('r.device_id = (SELECT id FROM devices WHERE address = :device)')
+        if metric_name is not None:
+            params['metric'] = metric_name
+            conditions.append('r.metric_id = (SELECT id FROM metrics WHERE name = :metric)')
+        conditions.append(f'r.{column} >= :start')
+        
+        order = 'DESC' if descending else 'ASC'
+        comparison = '<' if descending else '>'
+        query = f'''
+            SELECT r.{column} AS timestamp, r.metric_id, m.name, m.unit, {values}
+            FROM {table} r
+            JOIN metrics m ON m.id = r.metric_id
+            WHERE {' AND '.join(conditions)} {{keyset}}
+            ORDER BY r.{column} {order}, r.metric_id {order}
+            LIMIT :chunk
+        '''
+        
+        remaining = limit
+        cursor_key = after
+        while remaining is None or remaining > 0:
+            if cursor_key is None:
+                keyset = ''
+            elif cursor_key[1] is None:
+                keyset = f'AND r.{column} {comparison} :after_timestamp'
+            else:
+                keyset = f'AND (r.{column}, r.metric_id) {comparison} (:after_timestamp, :after_metric)'
+            if cursor_key is not None:
+                params['after_timestamp'], params['after_metric'] = cursor_key
+            params['chunk'] = chunk_size if remaining is None else min(chunk_size, remaining)
             
-            data = []
-            for row in cursor.fetchall():
-                data.append({
-                    'timestamp': row['timestamp'],
-                    'value': row['metric_value']
-                })
+            with self.connections.reader() as connection:
+                rows = connection.execute(query.format(keyset=keyset), params).fetchall()
             
-            return data
+            for row in rows:
+                point = {'timestamp': to_iso(row['timestamp'])}
+                if metric_name is None:
+                    point['metric'] = row['name']
+                    point['unit'] = row['unit']
+                if resolution == rollups.RAW:
+                    point['value'] = row['value']
+                else:
+                    point.update(rollups.row_to_point(row))
+                yield (row['timestamp'], row['metric_id']), point
             
-        except Exception as e:
-            logger.error(f"Error getting metric history: {e}")
-            return []
+            if len(rows) < params['chunk']:
+                return
+            cursor_key = (rows[-1]['timestamp'], rows[-1]['metric_id'])
+            if remaining is not None:
+                remaining -= len(rows)
     
     def cleanup_old_data(self, days=30):
         """
@@ -280,60 +893,400 @@ class Database:
         
         Args:
             days: Number of days to keep
+        
+        Returns:
+            Number of rows deleted
         """
         try:
-            cursor = self.connection.cursor()
-            
-            cutoff_date = datetime.now() - timedelta(days=days)
-            
-            cursor.execute(
-                'DELETE FROM readings WHERE timestamp < ?',
-                (cutoff_date.isoformat(),)
-            )
-            
-            self.connection.commit()
-            deleted_count = cursor.rowcount
+            cutoff = to_epoch(datetime.now() - timedelta(days=days))
+            deleted_count = self.purge('raw', cutoff)
             
             logger.info(f"Cleaned up {deleted_count} old readings")
+            return deleted_count
             
         except Exception as e:
             logger.error(f"Error cleaning up data: {e}")
+            return 0
+    
+    def purge(self, tier, cutoff, chunk_size=2000, pause=0.05):
+        """
+        Delete the rows of a retention tier older than cutoff
+        
+        Rows are deleted per device in transactions of about chunk_size rows,
+        releasing the writer connection and sleeping between chunks so
+        ingestion keeps flowing during a large purge.
+        
+        Args:
+            tier: Key of RETENTION_TIERS
+            cutoff: Epoch seconds, rows strictly older are deleted
+            chunk_size: Rows per transaction
+            pause: Seconds to yield between transactions
+        
+        Returns:
+            Number of rows deleted
+        """
+        total = 0
+        self._refresh_keys()
+        
+        for table, column, resolution in self.RETENTION_TIERS[tier]:
+            for device_key in list(self._device_keys.values()):
+                while True:
+                    with self.connections.writer() as connection, connection:
+                        deleted = self._purge_chunk(
+                            connection, table, column, resolution, device_key, cutoff, chunk_size
+                        )
+                    total += deleted
+                    
+                    if deleted < chunk_size:
+                        break
+                    time.sleep(pause)
+        
+        return total
     
-    def get_statistics(self, device_id, metric_name, hours=24):
+    def archive_readings(self, cutoff, chunk_size=2000, pause=0.05):
         """
-        Get statistics for a metric
+        Move readings older than cutoff to the archive
+        
+        Each device month is written to its Parquet file first and only then
+        deleted from SQLite in chunks, so an interruption leaves the rows in
+        both places (the next run merges them again) rather than nowhere.
+        
+        Args:
+            cutoff: Epoch seconds, rows strictly older are moved
+            chunk_size: Rows deleted per transaction
+            pause: Seconds to yield between transactions
+        
+        Returns:
+            Number of readings moved
+        """
+        if self.archive is None:
+            return 0
+        
+        moved = 0
+        self._refresh_keys()
+        for address, device_key in list(self._device_keys.items()):
+            while True:
+                with self.connections.reader() as connection:
+                    oldest = connection.execute(
+                        'SELECT MIN(timestamp) FROM readings WHERE device_id = ? AND timestamp < ?',
+                        (device_key, cutoff)
+                    ).fetchone()[0]
+                    if oldest is None:
+                        break
+                    
+                    month = archive.month_of(oldest)
+                    bound = min(archive.month_bounds(month)[1], cutoff)
+                    rows = connection.execute('''
+                        SELECT r.timestamp, m.name, r.value
+                        FROM readings r
+                        JOIN metrics m ON m.id = r.metric_id
+                        WHERE r.device_id = ? AND r.timestamp < ? AND r.value IS NOT NULL
+                    ''', (device_key, bound)).fetchall()
+                
+                self.archive.write_month(address, month, [tuple(row) for row in rows])
+                
+                while True:
+                    with self.connections.writer() as connection, connection:
+                        deleted = self._purge_chunk(
+                            connection, 'readings', 'timestamp', None, device_key, bound, chunk_size
+                        )
+                    moved += deleted
+                    if deleted < chunk_size:
+                        break
+                    time.sleep(pause)
+                
+                logger.info(f"Archived {len(rows)} readings of {address} for {month}")
+            
+            self.archive.set_archived_until(address, cutoff)
+        
+        return moved
+    
+    def _purge_chunk(self, connection, table, column, resolution, device_key, cutoff, chunk_size):
+        """Delete the oldest chunk_size rows of one device older than cutoff"""
+        where = f'device_id = ? AND {column} < ?'
+        params = [device_key, cutoff]
+        if resolution is not None:
+            where = 'resolution = ? AND ' + where
+            params.insert(0, resolution)
+        
+        # DELETE ... LIMIT is not always compiled in, so find the time
+        # boundary of the chunk through the (device_id, time) index instead
+        boundary = connection.execute(
+            f'SELECT {column} FROM {table} WHERE {where} ORDER BY {column} LIMIT 1 OFFSET ?',
+            params + [chunk_size - 1]
+        ).fetchone()
+        
+        if boundary is not None:
+            where = where.replace(f'{column} < ?', f'{column} <= ?')
+            params[-1] = boundary[0]
+        
+        return connection.execute(f'DELETE FROM {table} WHERE {where}', params).rowcount
+    
+    def get_storage_stats(self):
+        """
+        Get database file usage
+        
+        Returns:
+            Dictionary with page size, page count, free pages and auto_vacuum mode
+        """
+        with self.connections.writer() as connection:
+            page_size = connection.execute('PRAGMA page_size').fetchone()[0]
+            page_count = connection.execute('PRAGMA page_count').fetchone()[0]
+            freelist_count = connection.execute('PRAGMA freelist_count').fetchone()[0]
+            auto_vacuum = connection.execute('PRAGMA auto_vacuum').fetchone()[0]
+        
+        return {
+            'page_size': page_size,
+            'page_count': page_count,
+            'freelist_count': freelist_count,
+            'size_bytes': page_size * page_count,
+            'free_bytes': page_size * freelist_count,
+            'incremental_vacuum': auto_vacuum == 2
+        }
+    
+    def incremental_vacuum(self, pages_per_step=256, pause=0.05):
+        """
+        Give free pages back to the filesystem a few at a time
+        
+        Args:
+            pages_per_step: Pages released per writer lock hold
+            pause: Seconds to yield between steps
+        
+        Returns:
+            Number of bytes released, 0 if the database is not in incremental mode
+        """
+        before = self.get_storage_stats()
+        if not before['incremental_vacuum']:
+            return 0
+        
+        while True:
+            with self.connections.writer() as connection:
+                connection.execute(f'PRAGMA incremental_vacuum({int(pages_per_step)})').fetchall()
+                remaining = connection.execute('PRAGMA freelist_count').fetchone()[0]
+            if remaining == 0:
+                break
+            time.sleep(pause)
+        
+        # Shrink the file now rather than at the next automatic checkpoint
+        with self.connections.writer() as connection:
+            connection.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+        
+        after = self.get_storage_stats()
+        return before['size_bytes'] - after['size_bytes']
+    
+    def get_device_types(self):
+        """
+        Get the stored type of every device
+        
+        Returns:
+            Dictionary of device address to device type
+        """
+        with self.connections.reader() as connection:
+            return {
+                row['address']: row['type']
+                for row in connection.execute('SELECT address, type FROM devices')
+            }
+    
+    def iter_telegrams(self, device_id, start=None, chunk_size=5000):
+        """
+        Stream the raw payloads of a device in chunks
+        
+        Each chunk is a separate keyset query, so no read transaction stays
+        open while the caller writes corrections between chunks.
+        
+        Args:
+            device_id: Device identifier
+            start: Only telegrams at or after this epoch second
+            chunk_size: Telegrams per chunk
+        
+        Yields:
+            Lists of (timestamp, raw_data bytes)
+        """
+        last_id = 0
+        while True:
+            with self.connections.reader() as connection:
+                rows = connection.execute('''
+                    SELECT id, timestamp, raw_data
+                    FROM telegrams
+                    WHERE device_id = (SELECT id FROM devices WHERE address = ?)
+                      AND id > ? AND timestamp >= ?
+                    ORDER BY id
+                    LIMIT ?
+                ''', (device_id, last_id, start or 0, chunk_size)).fetchall()
+            
+            if not rows:
+                return
+            
+            last_id = rows[-1]['id']
+            yield [(row['timestamp'], row['raw_data']) for row in rows if row['raw_data']]
+    
+    def replace_metric_values(self, device_id, metric_rows, units=None):
+        """
+        Overwrite stored metric values in one transaction
+        
+        Rollups and latest values are not touched, call rebuild_aggregates
+        once all corrections are written.
+        
+        Args:
+            device_id: Device identifier
+            metric_rows: Iterable of (timestamp, metric_name, value)
+            units: Dictionary of metric name to unit
+        
+        Returns:
+            Number of rows written
+        
+        Raises:
+            RuntimeError: A change filter is attached, writing every value
+                would undo its thinning of the readings
+        """
+        if self.change_filter is not None:
+            raise RuntimeError("Metric values cannot be rewritten while the change filter is enabled")
+        
+        units = units or {}
+        
+        with self.connections.writer() as connection:
+            try:
+                with connection:
+                    cursor = connection.cursor()
+                    device_key = self._device_key(cursor, device_id)
+                    rows = [
+                        (device_key, timestamp, self._metric_key(cursor, name, units.get(name)), value)
+                        for timestamp, name, value in metric_rows
+                    ]
+                    cursor.executemany('''
+                        INSERT OR REPLACE INTO readings (device_id, timestamp, metric_id, value)
+                        VALUES (?, ?, ?, ?)
+                    ''', rows)
+                    return len(rows)
+            except Exception:
+                self._load_keys(connection)
+                raise
+    
+    def rebuild_aggregates(self, device_id, start=None, end=None):
+        """
+        Recompute rollups and latest values of a device from its readings
+        
+        Args:
+            device_id: Device identifier
+            start: First epoch second to rebuild, None for all history
+            end: Last epoch second to rebuild, None for all history
+        
+        Raises:
+            RuntimeError: If a change filter is attached: the readings then
+                hold only the changes, and counts and averages rebuilt from
+                them would replace the ones computed from every value
+        """
+        if self.change_filter is not None:
+            raise RuntimeError("Rollups cannot be rebuilt from change-filtered readings")
+        
+        device_key = self._lookup_keys(device_id)[0]
+        if device_key is None:
+            return
+        
+        with self.connections.writer() as connection:
+            rollups.rebuild(connection, device_key, start, end)
+            
+            with connection:
+                connection.execute('DELETE FROM latest_metrics WHERE device_id = ?', (device_key,))
+                connection.execute('''
+                    INSERT INTO latest_metrics (device_id, metric_id, timestamp, value)
+                    SELECT device_id, metric_id, MAX(timestamp), value
+                    FROM readings
+                    WHERE device_id = ?
+                    GROUP BY metric_id
+                ''', (device_key,))
+    
+    def get_statistics(self, device_id, metric_name, hours=24, start=None, end=None,
+                       percentiles=(50, 95)):
+        """
+        Get statistics for a metric over any window
+        
+        Answered from the rollups rather than the readings: the window is
+        covered by whole buckets, coarsest first (days, then hours, 15 and 1
+        minute buckets at the edges), and their counts, sums, extremes and
+        quantile sketches are merged. The cost depends on the number of
+        buckets, not of readings, and archived months are included since
+        rollups are kept when raw readings move to the archive. Edges whose
+        fine buckets retention already purged are widened to the coarser
+        buckets still kept.
         
         Args:
             device_id: Device identifier
             metric_name: Name of the metric
-            hours: Number of hours to analyze
+            hours: Window length when start is not given
+            start: First second (epoch or datetime), None for end - hours
+            end: Second to stop before, None for now
+            percentiles: Percentiles (0-100) estimated from the sketches
         
         Returns:
-            Dictionary with min, max, avg values
+            Dictionary with start and end of the window actually covered,
+            min, max, average, count and pNN values, None on error
         """
         try:
-            cursor = self.connection.cursor()
+            end = to_epoch(end) if end is not None else int(time.time())
+            start = to_epoch(start) if start is not None else end - int(hours * 3600)
+            # Whole minutes, the finest rollup
+            finest = min(rollups.RESOLUTIONS.values())
+            start -= start % finest
+            end = -(-end // finest) * finest
             
-            start_time = datetime.now() - timedelta(hours=hours)
+            stats = {
+                'start': to_iso(start),
+                'end': to_iso(end),
+                'min': None,
+                'max': None,
+                'average': None,
+                'count': 0,
+                **{f'p{percentile:g}': None for percentile in percentiles}
+            }
             
-            cursor.execute('''
-                SELECT 
-                    MIN(metric_value) as min_value,
-                    MAX(metric_value) as max_value,
-                    AVG(metric_value) as avg_value,
-                    COUNT(*) as count
-                FROM readings
-                WHERE device_id = ? AND metric_name = ? AND timestamp >= ?
-            ''', (device_id, metric_name, start_time.isoformat()))
+            device_key, metric_key = self._lookup_keys(device_id, metric_name)
+            if device_key is None or metric_key is None:
+                return stats
             
-            result = cursor.fetchone()
+            with self.connections.reader() as connection:
+                kept = rollups.horizons(connection, device_key, metric_key)
+            start, end = rollups.widen(start, end, kept)
+            stats['start'], stats['end'] = to_iso(start), to_iso(end)
+            ranges = rollups.cover(start, end)
+            if not ranges:
+                return stats
             
-            return {
-                'min': result['min_value'],
-                'max': result['max_value'],
-                'average': result['avg_value'],
-                'count': result['count']
-            }
+            query = ' UNION ALL '.join(
+                '''SELECT count, sum, min, max, sketch FROM rollups
+                   WHERE resolution = ? AND device_id = ? AND metric_id = ?
+                     AND bucket >= ? AND bucket < ?'''
+                for _ in ranges
+            )
+            params = [
+                value for seconds, first, last in ranges
+                for value in (seconds, device_key, metric_key, first, last)
+            ]
+            with self.connections.reader() as connection:
+                rows = connection.execute(query, params).fetchall()
+            
+            total = 0.0
+            sketch = sketches.QuantileSketch()
+            for row in rows:
+                stats['count'] += row['count']
+                total += row['sum']
+                if row['min'] is not None and (stats['min'] is None or row['min'] < stats['min']):
+                    stats['min'] = row['min']
+                if row['max'] is not None and (stats['max'] is None or row['max'] > stats['max']):
+                    stats['max'] = row['max']
+                if row['sketch'] is not None:
+                    sketch.merge(sketches.QuantileSketch.from_bytes(row['sketch']))
+            
+            if stats['count']:
+                stats['average'] = total / stats['count']
+            for percentile in percentiles:
+                value = sketch.quantile(percentile / 100)
+                if value is not None:
+                    # Bin values may lie a little outside the data
+                    value = min(max(value, stats['min']), stats['max'])
+                stats[f'p{percentile:g}'] = value
+            
+            return stats
             
         except Exception as e:
             logger.error(f"Error getting statistics: {e}")
@@ -342,8 +1295,17 @@ class Database:
     def close(self):
         """Close database connection"""
         try:
-            if self.connection:
-                self.connection.close()
-                logger.debug("Database connection closed")
+            if self.connections and self.change_filter:
+                # Points the swinging door still holds would be lost
+                pending = self.change_filter.pending_rows()
+                if pending:
+                    with self.connections.writer() as connection, connection:
+                        connection.executemany('''
+                            INSERT OR REPLACE INTO readings (device_id, timestamp, metric_id, value)
+                            VALUES (?, ?, ?, ?)
+                        ''', pending)
+            if self.connections:
+                self.connections.close()
+                logger.debug("Database connections closed")
         except Exception as e:
             logger.error(f"Error closing database: {e}")
@@ -0,0 +1,182 @@
+"""
+EEP Profiles - Declarative field specifications for supported EnOcean devices
+
+Offsets index the packet data as delivered by python-enocean, where data[0]
+is the RORG byte, so for 4BS telegrams DB3..DB0 are data[1]..data[4].
+"""
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Field:
+    """One value inside a telegram: where it sits and how to scale it"""
+
+    __slots__ = ('name', 'offset', 'length', 'shift', 'width', 'scale', 'add',
+                 'unit', 'digits', 'requires')
+
+    def __init__(self, name, offset, length=1, bits=None, scale=1.0, add=0.0,
+                 unit=None, digits=1, requires=None):
+        """
+        Initialize field
+
+        Args:
+            name: Metric name stored in the database
+            offset: Index of the first byte in the packet data
+            length: Number of bytes, read big-endian
+            bits: (shift, width) to extract a bit range, counted from the LSB
+            scale: Multiplier applied to the raw value
+            add: Offset added after scaling
+            unit: Unit stored with the metric
+            digits: Rounding of the scaled value, 0 gives an int
+            requires: (offset, mask) of a flag that must be set for the value to be valid
+        """
+        self.name = name
+        self.offset = offset
+        self.length = length
+        self.shift, self.width = bits if bits else (0, 8 * length)
+        self.scale = scale
+        self.add = add
+        self.unit = unit
+        self.digits = digits
+        self.requires = requires
+
+
+class Profile:
+    """An EEP: the list of fields of one device type"""
+
+    def __init__(self, eep, description, device_name, fields, teach_in=None):
+        """
+        Initialize profile
+
+        Args:
+            eep: Device type key used in the configuration (e.g. 'a5-09-04')
+            description: Human readable type, as listed in DataParser.DEVICE_TYPES
+            device_name: Name stored with parsed readings
+            fields: List of Field
+            teach_in: (offset, mask) of the LRN bit, clear on teach-in telegrams
+        """
+        self.eep = eep
+        self.description = description
+        self.device_name = device_name
+        self.fields = tuple(fields)
+        self.teach_in = teach_in
+        self.units = {field.name: field.unit for field in self.fields}
+
+    def compile(self):
+        """
+        Build the decoder for this profile
+
+        Field specs are flattened once into plain tuples, so decoding a
+        telegram is a single loop over precomputed integers.
+
+        Returns:
+            Callable taking packet data and returning a list of
+            (metric_name, value) pairs, or None for a teach-in telegram
+        """
+        specs = tuple(
+            (
+                field.name,
+                field.offset,
+                field.offset + field.length,
+                field.shift,
+                (1 << field.width) - 1,
+                field.scale,
+                field.add,
+                field.digits,
+                field.requires
+            )
+            for field in self.fields
+        )
+        teach_in = self.teach_in
+
+        def decode(data):
+            size = len(data)
+            if teach_in and size > teach_in[0] and not data[teach_in[0]] & teach_in[1]:
+                return None
+
+            values = []
+            for name, start, end, shift, mask, scale, add, digits, requires in specs:
+                if end > size:
+                    continue
+                if requires and not (size > requires[0] and data[requires[0]] & requires[1]):
+                    continue
+
+                if end - start == 1:
+                    raw = data[start]
+                else:
+                    raw = int.from_bytes(bytes(data[start:end]), 'big')
+                value = ((raw >> shift) & mask) * scale + add
+
+                if digits == 0:
+                    value = int(round(value))
+                elif digits is not None:
+                    value = round(value, digits)
+                values.append((name, value))
+            return values
+
+        return decode
+
+
+# 4BS telegrams: DB0 bit 3 is the LRN bit, 0 means teach-in
+_4BS_TEACH_IN = (4, 0x08)
+
+PROFILES = {}
+
+
+def register_profile(profile):
+    """Add or replace a profile in the registry"""
+    PROFILES[profile.eep] = profile
+    return profile
+
+
+register_profile(Profile(
+    'd1079-01-00', 'VMI Purevent', 'VMI Purevent',
+    [
+        # Proprietary telemetry, byte layout from the Jeedom plugin
+        Field('heating_power', 8, unit='%', digits=0),
+        Field('air_flow_output', 9, scale=2, unit='m3/h', digits=0),
+        Field('temperature_exterior', 10, scale=0.5, add=-100, unit='°C')
+    ]
+))
+
+register_profile(Profile(
+    'd1079-00-00', 'Assistant Ventilairsec', 'Assistant Ventilairsec',
+    []
+))
+
+register_profile(Profile(
+    'a5-09-04', 'Sensor CO2', 'CO2 Sensor',
+    [
+        # DB3: humidity 0..200 = 0..100 %, valid if DB0 bit 2 is set
+        Field('humidity', 1, scale=0.5, unit='%', requires=(4, 0x04)),
+        # DB2: concentration 0..255 = 0..2550 ppm
+        Field('co2_ppm', 2, scale=10, unit='ppm', digits=0),
+        # DB1: temperature 0..255 = 0..51 °C, valid if DB0 bit 1 is set
+        Field('temperature', 3, scale=0.2, unit='°C', requires=(4, 0x02))
+    ],
+    teach_in=_4BS_TEACH_IN
+))
+
+register_profile(Profile(
+    'a5-04-01', 'Sensor Temp/Humidity', 'Temp/Humidity Sensor',
+    [
+        # DB2: humidity 0..250 = 0..100 %
+        Field('humidity', 2, scale=100 / 250, unit='%'),
+        # DB1: temperature 0..250 = 0..+40 °C, valid if DB0 bit 1 is set
+        Field('temperature', 3, scale=40 / 250, unit='°C', requires=(4, 0x02))
+    ],
+    teach_in=_4BS_TEACH_IN
+))
+
+register_profile(Profile(
+    'a5-04-02', 'Sensor Temp/Humidity Extended', 'Temp/Humidity Sensor',
+    [
+        # DB2: humidity 0..250 = 0..100 %
+        Field('humidity', 2, scale=100 / 250, unit='%'),
+        # DB1: temperature 0..250 = -20..+60 °C
+        Field('temperature', 3, scale=80 / 250, add=-20, unit='°C')
+    ],
+    teach_in=_4BS_TEACH_IN
+))
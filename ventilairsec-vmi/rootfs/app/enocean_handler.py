@@ -1,62 +1,141 @@
 """
 EnOcean Handler - Communication with EnOcean GPIO module
+
+Two transports are available: 'thread' uses python-enocean's serial
+communicator and its reader thread, 'asyncio' reads ESP3 frames from a
+non-blocking serial descriptor on an event loop owned by the handler.
+A third one, 'replay', reads a capture file (capture.py) instead of a port.
+Several handlers can run side by side, one per gateway (gateways.py).
 """
 
+import asyncio
+import itertools
 import logging
+import os
+import queue
 import threading
 import time
-from queue import Queue
 
-from enocean.communicators.serialcommunicator import SerialCommunicator
-from enocean.protocol.packet import RadioPacket
-from enocean import utils
+import capture
+import esp3
+import instrumentation
+from records import RawTelegram
 
 logger = logging.getLogger(__name__)
 
+# python-enocean parses its EEP definitions when imported, only the thread transport needs it
+SerialCommunicator = Packet = None
+
+
+def _import_enocean():
+    global SerialCommunicator, Packet
+    if SerialCommunicator is None:
+        from enocean.communicators.serialcommunicator import SerialCommunicator as communicator
+        from enocean.protocol.packet import Packet as packet
+        SerialCommunicator, Packet = communicator, packet
+
+
+def _hex_id(values):
+    """Address bytes as 'FF:80:00:00'"""
+    return ':'.join(f'{value:02X}' for value in values)
+
 
 class EnOceanHandler:
     """Handle EnOcean communication via serial port"""
     
-    def __init__(self, port, config, callback=None):
+    TRANSPORTS = ('thread', 'asyncio', 'replay')
+    
+    # Seconds send_packet waits for the event loop to hand a frame to the port
+    SEND_TIMEOUT = 5.0
+    
+    def __init__(self, port, config, callback=None, name=None, options=None):
         """
         Initialize EnOcean handler
         
         Args:
-            port: Serial port (e.g., /dev/ttyAMA0)
+            port: Serial port (e.g., /dev/ttyAMA0), capture file for the replay transport
             config: Configuration dictionary
             callback: Callback function for received messages
+            name: Gateway name stamped on its telegrams, the port if None
+            options: Transport options, the 'enocean' section if None
         """
         self.port = port
         self.config = config
         self.callback = callback
+        self.name = name or port
         self.communicator = None
         self.running = False
         self.receive_thread = None
+        self.base_id = None
+        
+        if options is None:
+            options = config.get('enocean', {})
+        self.transport_mode = options.get('transport', 'thread')
+        self.baudrate = options.get('baudrate', 57600)
+        self.base_id_timeout = options.get('base_id_timeout', 2.0)
+        self.capture_path = options.get('capture_path')
+        self.replay_speed = options.get('replay_speed', 1.0)
+        self.replay_timestamps = options.get('replay_timestamps', 'original')
+        if self.transport_mode not in self.TRANSPORTS:
+            raise ValueError(
+                f"Unknown EnOcean transport '{self.transport_mode}', expected "
+                + ' or '.join(self.TRANSPORTS)
+            )
         
+        # Asyncio transport state
+        self.loop = None
+        self.transport = None
+        self._receive_task = None
+        
+        # Replay transport state
+        self._replay_stop = threading.Event()
+        
+        # Capture file of the received frames, if recording
+        self.capture = None
+        
+        # Telegrams handed to the callback
+        self.received = 0
+    
     def start(self):
         """Start EnOcean communication"""
+        if self.capture_path and self.transport_mode != 'replay':
+            self.capture = capture.CaptureWriter.in_directory(
+                self.capture_path, os.path.basename(self.name)
+            )
+            logger.info(f"Recording received frames to {self.capture.path}")
+        
+        if self.transport_mode == 'asyncio':
+            self._start_async()
+        elif self.transport_mode == 'replay':
+            self._start_replay()
+        else:
+            self._start_thread()
+    
+    def _start_thread(self):
+        """Start the python-enocean communicator and the receive thread"""
         try:
             logger.info(f"Initializing EnOcean on port {self.port}")
+            _import_enocean()
             
-            # Create serial communicator
-            self.communicator = SerialCommunicator(
-                port=self.port,
-                baudrate=57600,
-                timeout=1
-            )
+            # python-enocean always opens the port at 57600 baud
+            if self.baudrate != 57600:
+                logger.warning(f"The thread transport ignores baudrate {self.baudrate}, using 57600")
+            self.communicator = SerialCommunicator(port=self.port)
             
             # Start communicator
             self.communicator.start()
             self.running = True
             
-            # Get base ID
-            time.sleep(1)
-            if self.communicator.base_id:
-                base_id_hex = utils.to_hex_string(self.communicator.base_id)
+            # Get base ID, the property waits for the module's response
+            self.base_id = self.communicator.base_id
+            if self.base_id:
+                base_id_hex = _hex_id(self.base_id)
                 logger.info(f"EnOcean Base ID: {base_id_hex}")
             
             # Start receive thread
-            self.receive_thread = threading.Thread(target=self._receive_loop, daemon=True)
+            self.receive_thread = threading.Thread(
+                target=self._receive_loop, name=f'enocean-{self.name}', daemon=True
+            )
             self.receive_thread.start()
             
             logger.info("EnOcean handler started successfully")
@@ -66,12 +145,127 @@ class EnOceanHandler:
             self.running = False
             raise
     
+    def _start_async(self):
+        """Start the event loop thread, open the port and await the base ID"""
+        logger.info(f"Initializing EnOcean on port {self.port} (asyncio transport)")
+        
+        self.loop = asyncio.new_event_loop()
+        self.receive_thread = threading.Thread(
+            target=self._run_loop, name=f'enocean-{self.name}', daemon=True
+        )
+        self.receive_thread.start()
+        
+        try:
+            future = asyncio.run_coroutine_threadsafe(self._open_async(), self.loop)
+            future.result(timeout=self.base_id_timeout + 5)
+        except Exception as e:
+            logger.error(f"Failed to start EnOcean handler: {e}")
+            self.running = False
+            self._stop_loop()
+            raise
+        
+        logger.info("EnOcean handler started successfully")
+    
+    def _start_replay(self):
+        """Start feeding a capture file through the pipeline"""
+        logger.info(f"Replaying {self.port} at speed {self.replay_speed or 'max'}")
+        
+        records = capture.read_capture(self.port)
+        # Reading the first record checks the file is a capture
+        first = next(records, None)
+        if first is not None:
+            records = itertools.chain((first,), records)
+        
+        self._replay_stop.clear()
+        self.running = True
+        self.receive_thread = threading.Thread(
+            target=self._replay_loop, args=(records,), name=f'enocean-{self.name}', daemon=True
+        )
+        self.receive_thread.start()
+    
+    def _replay_loop(self, records):
+        """Decode the captured frames and process them like received ones"""
+        decoder = esp3.FrameDecoder()
+        original = self.replay_timestamps == 'original'
+        count = 0
+        
+        for timestamp, data in capture.paced(records, self.replay_speed, self._replay_stop):
+            for frame in decoder.feed(data):
+                if frame.packet_type == esp3.RADIO_ERP1:
+                    self._process_frame(frame, timestamp if original else None)
+                    count += 1
+        
+        self.running = False
+        logger.info(f"Replay of {self.port} finished after {count} telegrams")
+    
+    def _run_loop(self):
+        """Run the handler's event loop until stopped"""
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+    
+    async def _open_async(self):
+        """Open the transport, read the base ID and start receiving"""
+        self.transport = esp3.AsyncSerialTransport(self.port, baudrate=self.baudrate)
+        await self.transport.open()
+        self.running = True
+        
+        try:
+            self.base_id = list(await self.transport.read_base_id(timeout=self.base_id_timeout))
+            logger.info(f"EnOcean Base ID: {_hex_id(self.base_id)}")
+        except asyncio.TimeoutError:
+            logger.warning(f"No base ID response within {self.base_id_timeout}s")
+        
+        self._receive_task = self.loop.create_task(self._receive_async())
+    
+    async def _receive_async(self):
+        """Turn radio frames into telegrams as they are decoded"""
+        logger.info("Starting message receive loop")
+        
+        async for frame in self.transport.frames_received():
+            if self.capture:
+                self.capture.write(esp3.encode_frame(frame.packet_type, frame.data, frame.optional))
+            if frame.packet_type == esp3.RADIO_ERP1:
+                self._process_frame(frame)
+        
+        if self.running:
+            logger.error(f"EnOcean transport closed: {self.transport.closed_reason}")
+            self.running = False
+        logger.info("Message receive loop stopped")
+    
+    def _stop_loop(self):
+        """Close the transport and stop the event loop thread"""
+        if not self.loop or self.loop.is_closed():
+            return
+        
+        if self.transport:
+            self.loop.call_soon_threadsafe(self.transport.close, 'Handler stopped')
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        if self.receive_thread:
+            self.receive_thread.join(timeout=5)
+    
     def stop(self):
         """Stop EnOcean communication"""
         try:
             logger.info("Stopping EnOcean handler")
             self.running = False
             
+            if self.transport_mode == 'asyncio':
+                self._stop_loop()
+            elif self.transport_mode == 'replay':
+                self._replay_stop.set()
+                if self.receive_thread:
+                    self.receive_thread.join(timeout=5)
+            
+            if self.capture:
+                self.capture.close()
+            
+            if self.transport_mode != 'thread':
+                logger.info("EnOcean handler stopped")
+                return
+            
             if self.communicator:
                 self.communicator.stop()
             
@@ -85,7 +279,11 @@ class EnOceanHandler:
     
     def is_connected(self):
         """Check if EnOcean is connected"""
-        return self.running and self.communicator and self.communicator.is_alive()
+        if self.transport_mode == 'asyncio':
+            return bool(self.running and self.transport and self.transport.is_open)
+        if self.transport_mode == 'replay':
+            return bool(self.running and self.receive_thread and self.receive_thread.is_alive())
+        return bool(self.running and self.communicator and self.communicator.is_alive())
     
     def _receive_loop(self):
         """Loop to receive messages from EnOcean"""
@@ -97,44 +295,93 @@ class EnOceanHandler:
                 packet = self.communicator.receive.get(block=True, timeout=1)
                 
                 if packet:
+                    if self.capture:
+                        self.capture.write(bytes(packet.build()))
                     self._process_packet(packet)
                     
-            except Exception as e:
+            except queue.Empty:
                 # Queue timeout is normal, don't log it
-                if "Empty" not in str(type(e)):
-                    logger.debug(f"Receive loop exception: {e}")
                 continue
+            except Exception as e:
+                logger.debug(f"Receive loop exception: {e}")
         
         logger.info("Message receive loop stopped")
     
     def _process_packet(self, packet):
         """Process received EnOcean packet"""
         try:
-            if isinstance(packet, RadioPacket):
-                # Extract basic packet info
-                sender_id = utils.to_hex_string(packet.sender_id).replace(':', '').upper()
-                sender_id_int = int.from_bytes(packet.sender_id, 'big')
+            if packet.packet_type == esp3.RADIO_ERP1:
+                telegram = RawTelegram(
+                    int.from_bytes(bytes(packet.sender), 'big'),
+                    packet.rorg,
+                    packet.data,
+                    status=packet.status,
+                    repeater_level=packet.repeater_count,
+                    timestamp=time.time(),
+                    dbm=getattr(packet, 'dBm', None),
+                    gateway=self.name
+                )
+                self.received += 1
+                instrumentation.TELEGRAMS_RECEIVED.inc(transport='thread', gateway=self.name)
                 
-                logger.debug(f"Received packet from: {sender_id}")
-                
-                # Build data dictionary
-                data = {
-                    'sender_id': sender_id,
-                    'sender_id_int': sender_id_int,
-                    'rorg': packet.rorg,
-                    'data': packet.data,
-                    'status': packet.status,
-                    'repeater_level': packet.repeater_level,
-                    'timestamp': time.time()
-                }
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(f"Received packet from: {telegram.sender_id}")
                 
                 # Call callback if configured
                 if self.callback:
-                    self.callback(data)
+                    self.callback(telegram)
                     
         except Exception as e:
+            instrumentation.ERRORS.inc(component='enocean')
+            logger.error(f"Error processing packet: {e}")
+    
+    def _process_frame(self, frame, timestamp=None):
+        """
+        Process an ESP3 RADIO_ERP1 frame from the asyncio or replay transport
+        
+        Args:
+            frame: esp3.Frame
+            timestamp: Reception time, now if None
+        """
+        try:
+            data = frame.data
+            if len(data) < 6:
+                return
+            
+            # ERP1 data: RORG, payload, sender ID (4 bytes), status
+            status = data[-1]
+            optional = frame.optional
+            telegram = RawTelegram(
+                int.from_bytes(data[-5:-1], 'big'),
+                data[0],
+                data,
+                status=status,
+                repeater_level=status & 0x0F,
+                timestamp=timestamp or time.time(),
+                dbm=-optional[5] if len(optional) > 5 else None,
+                gateway=self.name
+            )
+            self.received += 1
+            instrumentation.TELEGRAMS_RECEIVED.inc(transport=self.transport_mode, gateway=self.name)
+            
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Received packet from: {telegram.sender_id}")
+            
+            if self.callback:
+                self.callback(telegram)
+                
+        except Exception as e:
+            instrumentation.ERRORS.inc(component='enocean')
             logger.error(f"Error processing packet: {e}")
     
+    def queue_depth(self):
+        """Number of received frames or packets not processed yet"""
+        if self.transport_mode == 'asyncio':
+            return self.transport.frames.qsize() if self.transport else 0
+        if self.transport_mode == 'replay':
+            return 0
+        return self.communicator.receive.qsize() if self.communicator else 0
+    
     def send_packet(self, receiver_id, data, rorg='F6'):
         """
         Send EnOcean packet
@@ -149,19 +396,45 @@ class EnOceanHandler:
                 logger.error("EnOcean not connected, cannot send packet")
                 return False
             
+            if self.transport_mode == 'replay':
+                logger.info(f"Replay transport, packet to {receiver_id} not sent")
+                return False
+            
             logger.info(f"Sending packet to {receiver_id}")
             
-            # Create and send packet
-            packet = RadioPacket(
-                rorg=rorg,
-                data=data,
-                receiver=bytes.fromhex(receiver_id.replace(':', '')),
-                learn=False
-            )
+            if self.transport_mode == 'asyncio':
+                future = asyncio.run_coroutine_threadsafe(
+                    self._send_async(self._encode_radio(receiver_id, data, rorg)), self.loop
+                )
+                return future.result(timeout=self.SEND_TIMEOUT)
             
-            self.communicator.send(packet)
-            return True
+            # Same frame as the asyncio transport, as a packet for python-enocean's transmit queue
+            _import_enocean()
+            _, _, packet = Packet.parse_msg(bytearray(self._encode_radio(receiver_id, data, rorg)))
+            return bool(packet) and self.communicator.send(packet)
             
         except Exception as e:
             logger.error(f"Error sending packet: {e}")
             return False
+    
+    async def _send_async(self, frame):
+        """Hand a frame to the transport, False if the port is closed or the write fails"""
+        if not self.transport.is_open:
+            logger.error(f"EnOcean transport closed, cannot send packet: {self.transport.closed_reason}")
+            return False
+        
+        self.transport.write(frame)
+        # A failed write closes the transport
+        return self.transport.is_open
+    
+    def _encode_radio(self, receiver_id, data, rorg):
+        """Build the ESP3 RADIO_ERP1 frame of an outgoing telegram"""
+        rorg = int(rorg, 16) if isinstance(rorg, str) else rorg
+        receiver = int(receiver_id.replace(':', ''), 16).to_bytes(4, 'big')
+        sender = bytes(self.base_id) if self.base_id else b'\xff\xff\xff\xff'
+        
+        # ERP1 data: RORG, payload, sender ID, status
+        erp1 = bytes((rorg,)) + bytes(data) + sender + b'\x00'
+        # Optional: subtelegram count, destination, dBm (send: 0xFF), security level
+        optional = b'\x03' + receiver + b'\xff\x00'
+        return esp3.encode_frame(esp3.RADIO_ERP1, erp1, optional)
@@ -0,0 +1,337 @@
+"""
+ESP3 - EnOcean Serial Protocol 3 framing and an asyncio serial transport
+
+The transport reads the serial port through a non-blocking file descriptor
+registered with the event loop, so frames are decoded as soon as bytes
+arrive instead of being handed over by reader and polling threads.
+"""
+
+import asyncio
+import logging
+import os
+
+try:
+    import termios
+except ImportError:
+    termios = None
+
+logger = logging.getLogger(__name__)
+
+SYNC_BYTE = 0x55
+HEADER_LENGTH = 4
+
+# Packet types
+RADIO_ERP1 = 0x01
+RESPONSE = 0x02
+EVENT = 0x04
+COMMON_COMMAND = 0x05
+
+# Common commands
+CO_RD_IDBASE = 0x08
+
+# Response return codes
+RET_OK = 0x00
+
+
+def _crc8_table():
+    """CRC8 table of the ESP3 polynomial x^8 + x^2 + x + 1"""
+    table = []
+    for value in range(256):
+        crc = value
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+        table.append(crc)
+    return bytes(table)
+
+
+CRC8_TABLE = _crc8_table()
+
+
+def crc8(data):
+    """ESP3 CRC8 of a byte sequence"""
+    crc = 0
+    for byte in data:
+        crc = CRC8_TABLE[crc ^ byte]
+    return crc
+
+
+def encode_frame(packet_type, data, optional=b''):
+    """
+    Build a complete ESP3 frame
+
+    Args:
+        packet_type: ESP3 packet type
+        data: Data field
+        optional: Optional data field
+
+    Returns:
+        Frame bytes, sync byte included
+    """
+    data = bytes(data)
+    optional = bytes(optional)
+    header = len(data).to_bytes(2, 'big') + bytes((len(optional), packet_type))
+    body = data + optional
+    return bytes((SYNC_BYTE,)) + header + bytes((crc8(header),)) + body + bytes((crc8(body),))
+
+
+class Frame:
+    """One decoded ESP3 frame"""
+
+    __slots__ = ('packet_type', 'data', 'optional')
+
+    def __init__(self, packet_type, data, optional):
+        self.packet_type = packet_type
+        self.data = data
+        self.optional = optional
+
+    def __repr__(self):
+        return f'Frame(type=0x{self.packet_type:02X}, data={self.data.hex()}, optional={self.optional.hex()})'
+
+
+class FrameDecoder:
+    """Incremental ESP3 decoder, fed with whatever the serial port returned"""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.crc_errors = 0
+
+    def feed(self, chunk):
+        """
+        Add received bytes and decode every complete frame
+
+        Args:
+            chunk: Bytes read from the serial port
+
+        Returns:
+            List of Frame
+        """
+        buffer = self.buffer
+        buffer.extend(chunk)
+        frames = []
+
+        while True:
+            start = buffer.find(SYNC_BYTE)
+            if start < 0:
+                buffer.clear()
+                break
+            if start:
+                del buffer[:start]
+
+            if len(buffer) < HEADER_LENGTH + 2:
+                break
+
+            header = buffer[1:1 + HEADER_LENGTH]
+            if crc8(header) != buffer[1 + HEADER_LENGTH]:
+                # Not a frame start, resynchronize on the next sync byte
+                self.crc_errors += 1
+                del buffer[0]
+                continue
+
+            data_length = (header[0] << 8) | header[1]
+            optional_length = header[2]
+            body_start = HEADER_LENGTH + 2
+            body_end = body_start + data_length + optional_length
+            if len(buffer) < body_end + 1:
+                break
+
+            body = bytes(buffer[body_start:body_end])
+            if crc8(body) != buffer[body_end]:
+                self.crc_errors += 1
+                del buffer[0]
+                continue
+
+            frames.append(Frame(header[3], body[:data_length], body[data_length:]))
+            del buffer[:body_end + 1]
+
+        return frames
+
+
+class AsyncSerialTransport:
+    """ESP3 over a non-blocking serial file descriptor, driven by an event loop"""
+
+    def __init__(self, port, baudrate=57600, queue_size=1000):
+        """
+        Initialize transport
+
+        Args:
+            port: Serial device path
+            baudrate: Line speed
+            queue_size: Radio frames buffered before the oldest are dropped
+        """
+        self.port = port
+        self.baudrate = baudrate
+        self.fd = None
+        self.loop = None
+        self.decoder = FrameDecoder()
+        self.frames = None
+        self.queue_size = queue_size
+        self.dropped = 0
+        self.closed_reason = None
+
+        self._write_buffer = bytearray()
+        self._command_lock = None
+        self._pending_response = None
+
+    @property
+    def is_open(self):
+        """True while the file descriptor is registered with the loop"""
+        return self.fd is not None
+
+    async def open(self):
+        """Open and configure the port, then start reading"""
+        self.loop = asyncio.get_running_loop()
+        self.frames = asyncio.Queue(maxsize=self.queue_size)
+        self._command_lock = asyncio.Lock()
+
+        self.fd = os.open(self.port, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        try:
+            self._configure()
+        except Exception:
+            os.close(self.fd)
+            self.fd = None
+            raise
+
+        self.closed_reason = None
+        self.loop.add_reader(self.fd, self._on_readable)
+        logger.info(f"Opened {self.port} at {self.baudrate} baud")
+
+    def _configure(self):
+        """Put the line in raw 8N1 mode at the configured speed"""
+        if termios is None:
+            raise RuntimeError("termios is not available on this platform")
+
+        speed = getattr(termios, f'B{self.baudrate}', None)
+        if speed is None:
+            raise ValueError(f"Unsupported baudrate {self.baudrate}")
+
+        attrs = termios.tcgetattr(self.fd)
+        attrs[0] = 0                                                  # iflag
+        attrs[1] = 0                                                  # oflag
+        attrs[2] = termios.CS8 | termios.CREAD | termios.CLOCAL       # cflag
+        attrs[3] = 0                                                  # lflag
+        attrs[4] = speed
+        attrs[5] = speed
+        attrs[6][termios.VMIN] = 0
+        attrs[6][termios.VTIME] = 0
+        termios.tcsetattr(self.fd, termios.TCSANOW, attrs)
+        termios.tcflush(self.fd, termios.TCIOFLUSH)
+
+    def close(self, reason=None):
+        """Unregister and close the port"""
+        if self.fd is None:
+            return
+
+        self.loop.remove_reader(self.fd)
+        if self._write_buffer:
+            self.loop.remove_writer(self.fd)
+            self._write_buffer.clear()
+        os.close(self.fd)
+        self.fd = None
+        self.closed_reason = reason
+
+        if self._pending_response and not self._pending_response.done():
+            self._pending_response.set_exception(ConnectionError(reason or 'Transport closed'))
+
+        # Wake up the consumer so it sees the transport is gone
+        if self.frames.full():
+            self.frames.get_nowait()
+        self.frames.put_nowait(None)
+
+    def _on_readable(self):
+        """Read what the port has and decode it"""
+        try:
+            chunk = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            logger.error(f"Serial read failed on {self.port}: {e}")
+            self.close(str(e))
+            return
+
+        if not chunk:
+            self.close('End of file on serial port')
+            return
+
+        for frame in self.decoder.feed(chunk):
+            if frame.packet_type == RESPONSE:
+                pending = self._pending_response
+                if pending and not pending.done():
+                    pending.set_result(frame)
+                continue
+
+            if self.frames.full():
+                self.frames.get_nowait()
+                self.dropped += 1
+            self.frames.put_nowait(frame)
+
+    def write(self, frame):
+        """Queue bytes for the port, flushed without blocking the loop"""
+        if self.fd is None:
+            raise ConnectionError('Transport closed')
+
+        pending = bool(self._write_buffer)
+        self._write_buffer.extend(frame)
+        if not pending:
+            self._on_writable()
+
+    def _on_writable(self):
+        """Write as much of the buffer as the port accepts"""
+        try:
+            written = os.write(self.fd, self._write_buffer)
+        except BlockingIOError:
+            written = 0
+        except OSError as e:
+            logger.error(f"Serial write failed on {self.port}: {e}")
+            self.close(str(e))
+            return
+
+        del self._write_buffer[:written]
+        if self._write_buffer:
+            self.loop.add_writer(self.fd, self._on_writable)
+        else:
+            self.loop.remove_writer(self.fd)
+
+    async def command(self, packet_type, data, optional=b'', timeout=1.0):
+        """
+        Send a frame and await the module's RESPONSE
+
+        ESP3 responses carry no request identifier, so commands are sent
+        one at a time and the next response belongs to the pending one.
+
+        Returns:
+            RESPONSE Frame
+
+        Raises:
+            asyncio.TimeoutError: If the module does not answer in time
+        """
+        async with self._command_lock:
+            self._pending_response = self.loop.create_future()
+            try:
+                self.write(encode_frame(packet_type, data, optional))
+                return await asyncio.wait_for(self._pending_response, timeout)
+            finally:
+                self._pending_response = None
+
+    async def read_base_id(self, timeout=1.0):
+        """
+        Ask the module for its base ID
+
+        Returns:
+            Base ID as 4 bytes
+
+        Raises:
+            asyncio.TimeoutError: If the module does not answer in time
+            ConnectionError: If the module answers with an error code
+        """
+        response = await self.command(COMMON_COMMAND, bytes((CO_RD_IDBASE,)), timeout=timeout)
+        if not response.data or response.data[0] != RET_OK or len(response.data) < 5:
+            raise ConnectionError(f"CO_RD_IDBASE failed: {response.data.hex()}")
+        return bytes(response.data[1:5])
+
+    async def frames_received(self):
+        """Yield radio frames until the transport is closed"""
+        while True:
+            frame = await self.frames.get()
+            if frame is None:
+                return
+            yield frame
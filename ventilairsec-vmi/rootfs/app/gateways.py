@@ -0,0 +1,295 @@
+"""
+Gateways - Several EnOcean transceivers feeding one pipeline
+
+Each configured gateway gets its own EnOceanHandler, with its own receive
+thread or event loop. Their telegrams meet in a TelegramDeduplicator: copies
+of a telegram heard by several gateways, or repeated by a repeater, are held
+for a short window and only the copy with the best signal goes on to the
+parser, so extra gateways widen radio coverage without adding writes.
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import instrumentation
+from enocean_handler import EnOceanHandler
+
+logger = logging.getLogger(__name__)
+
+
+class TelegramDeduplicator:
+    """Merge copies of the same telegram received within a time window"""
+
+    def __init__(self, callback, window_ms=150):
+        """
+        Initialize deduplicator
+
+        Args:
+            callback: Callable receiving each distinct telegram once
+            window_ms: How long the first copy of a telegram waits for
+                better ones, 0 forwards every telegram immediately
+        """
+        self.callback = callback
+        self.window = max(0, window_ms) / 1000.0
+
+        # key -> [deadline, best copy], in arrival order so deadlines are sorted
+        self._pending = OrderedDict()
+        # key -> expiry, telegrams already forwarded whose late copies are dropped
+        self._recent = OrderedDict()
+        self._condition = threading.Condition()
+        self._running = False
+        self._thread = None
+
+        self.forwarded = 0
+        self.duplicates = 0
+        self.forwarded_by = {}
+        self.duplicates_by = {}
+
+    @classmethod
+    def from_config(cls, config, callback):
+        """Build a deduplicator from the 'enocean' section of the configuration"""
+        options = config.get('enocean', {})
+        return cls(callback, window_ms=options.get('dedup_window_ms', 150))
+
+    @staticmethod
+    def key(telegram):
+        """
+        Identity of a telegram across gateways and repeaters
+
+        Repeaters only change the hop count in the status byte, the last
+        byte of the data, so it is left out.
+        """
+        return telegram.sender, bytes(telegram.data[:-1])
+
+    def start(self):
+        """Start the thread forwarding telegrams once their window is over"""
+        if self._running or not self.window:
+            return
+
+        self._running = True
+        self._thread = threading.Thread(target=self._forward_loop, name='enocean-dedup', daemon=True)
+        self._thread.start()
+        logger.info(f"Telegram deduplication started (window={self.window}s)")
+
+    def stop(self, timeout=5):
+        """Stop the thread, forwarding the telegrams still held"""
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+
+        if self._thread:
+            self._thread.join(timeout=timeout)
+            self._thread = None
+
+    def submit(self, telegram):
+        """Handle a telegram from one of the gateways"""
+        if not self.window:
+            # Gateways may call from several threads, the pipeline expects one at a time
+            with self._condition:
+                self._forward(telegram)
+            return
+
+        key = self.key(telegram)
+        now = time.monotonic()
+        with self._condition:
+            entry = self._pending.get(key)
+            if entry is not None:
+                if self._stronger(telegram, entry[1]):
+                    telegram, entry[1] = entry[1], telegram
+                self._count_duplicate(telegram)
+                return
+
+            expiry = self._recent.get(key)
+            if expiry is not None and expiry > now:
+                self._count_duplicate(telegram)
+                return
+
+            self._pending[key] = [now + self.window, telegram]
+            if len(self._pending) == 1:
+                self._condition.notify()
+
+    @staticmethod
+    def _stronger(telegram, other):
+        """Whether a copy was received with a better signal than another"""
+        if telegram.dbm is None:
+            return False
+        return other.dbm is None or telegram.dbm > other.dbm
+
+    def _count_duplicate(self, telegram):
+        self.duplicates += 1
+        self.duplicates_by[telegram.gateway] = self.duplicates_by.get(telegram.gateway, 0) + 1
+        instrumentation.TELEGRAMS_DUPLICATE.inc(gateway=telegram.gateway)
+
+    def _forward(self, telegram):
+        self.forwarded += 1
+        self.forwarded_by[telegram.gateway] = self.forwarded_by.get(telegram.gateway, 0) + 1
+        try:
+            self.callback(telegram)
+        except Exception as e:
+            instrumentation.ERRORS.inc(component='enocean')
+            logger.error(f"Error forwarding telegram: {e}")
+
+    def _forward_loop(self):
+        """Forward the best copy of each telegram when its window closes"""
+        while True:
+            with self._condition:
+                while self._running and not self._pending:
+                    self._condition.wait()
+                if not self._pending:
+                    return
+
+                key, (deadline, telegram) = next(iter(self._pending.items()))
+                now = time.monotonic()
+                if deadline > now and self._running:
+                    self._condition.wait(deadline - now)
+                    continue
+
+                del self._pending[key]
+                # Copies arriving within another window are late duplicates
+                self._recent[key] = deadline + self.window
+                while self._recent:
+                    oldest = next(iter(self._recent))
+                    if self._recent[oldest] > now:
+                        break
+                    del self._recent[oldest]
+
+            self._forward(telegram)
+
+    def pending(self):
+        """Number of telegrams waiting for their window to close"""
+        return len(self._pending)
+
+    def get_stats(self):
+        """Get deduplication statistics"""
+        with self._condition:
+            return {
+                'window_ms': round(self.window * 1000),
+                'pending': len(self._pending),
+                'forwarded': self.forwarded,
+                'duplicates': self.duplicates
+            }
+
+
+class GatewaySet:
+    """EnOcean handlers of every configured gateway"""
+
+    def __init__(self, handlers, deduplicator):
+        """
+        Initialize gateway set
+
+        Args:
+            handlers: EnOceanHandler per gateway, sending telegrams to the deduplicator
+            deduplicator: TelegramDeduplicator forwarding to the pipeline
+        """
+        self.handlers = handlers
+        self.deduplicator = deduplicator
+
+    @classmethod
+    def from_config(cls, config, callback):
+        """
+        Build the gateways from the configuration
+
+        'enocean.gateways' lists the gateways as {name, port} objects, which
+        may override any other 'enocean' option such as transport or
+        baudrate. Without it, the single gateway is on 'serial_port'.
+
+        Raises:
+            ValueError: If a gateway has no port or two share a name
+        """
+        options = config.get('enocean', {})
+        deduplicator = TelegramDeduplicator.from_config(config, callback)
+
+        entries = options.get('gateways') or [{'port': config.get('serial_port', '/dev/ttyAMA0')}]
+        defaults = {key: value for key, value in options.items() if key != 'gateways'}
+
+        handlers = []
+        for entry in entries:
+            port = entry.get('port')
+            if not port:
+                raise ValueError(f"EnOcean gateway without a port: {entry}")
+            name = entry.get('name') or os.path.basename(port)
+            if any(handler.name == name for handler in handlers):
+                raise ValueError(f"Duplicate EnOcean gateway name '{name}'")
+
+            handlers.append(EnOceanHandler(
+                port,
+                config,
+                callback=deduplicator.submit,
+                name=name,
+                options={**defaults, **entry}
+            ))
+        return cls(handlers, deduplicator)
+
+    def start(self):
+        """
+        Start every gateway concurrently
+
+        A gateway that fails to start is logged and left stopped, the
+        others keep receiving.
+        """
+        self.deduplicator.start()
+
+        def start_handler(handler):
+            try:
+                handler.start()
+            except Exception as e:
+                instrumentation.ERRORS.inc(component='enocean')
+                logger.error(f"Gateway {handler.name} on {handler.port} did not start: {e}")
+
+        threads = [
+            threading.Thread(target=start_handler, args=(handler,), daemon=True)
+            for handler in self.handlers
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        connected = sum(handler.is_connected() for handler in self.handlers)
+        logger.info(f"{connected} of {len(self.handlers)} EnOcean gateways started")
+
+    def stop(self):
+        """Stop every gateway, then forward the telegrams still held"""
+        for handler in self.handlers:
+            handler.stop()
+        self.deduplicator.stop()
+
+    def is_connected(self):
+        """Check if at least one gateway is connected"""
+        return any(handler.is_connected() for handler in self.handlers)
+
+    def queue_depth(self):
+        """Telegrams received by the gateways and not forwarded yet"""
+        return sum(handler.queue_depth() for handler in self.handlers) + self.deduplicator.pending()
+
+    def send_packet(self, receiver_id, data, rorg='F6'):
+        """Send a packet through the first connected gateway"""
+        for handler in self.handlers:
+            if handler.is_connected():
+                return handler.send_packet(receiver_id, data, rorg)
+        logger.error("No EnOcean gateway connected, cannot send packet")
+        return False
+
+    def get_stats(self):
+        """Status of each gateway and of the deduplication"""
+        deduplicator = self.deduplicator
+        return {
+            'connected': self.is_connected(),
+            'gateways': [
+                {
+                    'name': handler.name,
+                    'port': handler.port,
+                    'transport': handler.transport_mode,
+                    'connected': handler.is_connected(),
+                    'received': handler.received,
+                    # Telegrams this gateway had the best copy of
+                    'forwarded': deduplicator.forwarded_by.get(handler.name, 0),
+                    'duplicates': deduplicator.duplicates_by.get(handler.name, 0)
+                }
+                for handler in self.handlers
+            ],
+            'dedup': deduplicator.get_stats()
+        }
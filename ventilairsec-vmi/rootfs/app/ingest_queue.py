@@ -0,0 +1,246 @@
+"""
+Ingest Queue - Batched write-behind stage between EnOcean reception and SQLite
+"""
+
+import logging
+import queue
+import threading
+import time
+
+import instrumentation
+
+logger = logging.getLogger(__name__)
+
+
+class IngestQueue:
+    """Bounded queue of parsed readings flushed to the database in batches"""
+
+    # What to do when the queue is full
+    OVERFLOW_POLICIES = ('drop_oldest', 'drop_newest', 'block')
+
+    # Seconds between writes of the points a change filter holds back
+    HELD_POINTS_INTERVAL = 60.0
+
+    def __init__(self, db, batch_size=50, flush_interval_ms=1000,
+                 max_size=2000, overflow_policy='drop_oldest', block_timeout=1.0,
+                 on_written=None):
+        """
+        Initialize ingest queue
+
+        Args:
+            db: Database instance receiving the batches
+            batch_size: Flush as soon as this many readings are waiting
+            flush_interval_ms: Flush at the latest this long after the first waiting reading
+            max_size: Maximum number of readings held in memory
+            overflow_policy: One of OVERFLOW_POLICIES
+            block_timeout: Seconds the producer may wait with the 'block' policy
+            on_written: Callable receiving each batch once it is committed
+        """
+        if overflow_policy not in self.OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow_policy}")
+
+        self.db = db
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval = max(0, flush_interval_ms) / 1000.0
+        self.max_size = max(1, int(max_size))
+        self.overflow_policy = overflow_policy
+        self.block_timeout = block_timeout
+        self.on_written = on_written
+
+        self._queue = queue.Queue(maxsize=self.max_size)
+        self._running = False
+        self._writer_thread = None
+        self._stats_lock = threading.Lock()
+
+        self.enqueued = 0
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+        self.batches = 0
+        self.last_flush = None
+
+    @classmethod
+    def from_config(cls, db, config, on_written=None):
+        """Build an ingest queue from the 'ingest' section of the configuration"""
+        options = config.get('ingest', {})
+        return cls(
+            db,
+            batch_size=options.get('batch_size', 50),
+            flush_interval_ms=options.get('flush_interval_ms', 1000),
+            max_size=options.get('max_queue_size', 2000),
+            overflow_policy=options.get('overflow_policy', 'drop_oldest'),
+            block_timeout=options.get('block_timeout', 1.0),
+            on_written=on_written
+        )
+
+    def start(self):
+        """Start the writer thread"""
+        if self._running:
+            return
+
+        self._running = True
+        self._writer_thread = threading.Thread(target=self._writer_loop, daemon=True)
+        self._writer_thread.start()
+        logger.info(
+            f"Ingest queue started (batch_size={self.batch_size}, "
+            f"flush_interval={self.flush_interval}s, max_size={self.max_size}, "
+            f"policy={self.overflow_policy})"
+        )
+
+    def stop(self, timeout=5):
+        """Stop the writer thread and flush what is still queued"""
+        self._running = False
+
+        if self._writer_thread:
+            self._writer_thread.join(timeout=timeout)
+            self._writer_thread = None
+
+        # Drain anything that arrived after the writer exited
+        self._flush(self._drain(self._queue.qsize()))
+        logger.info("Ingest queue stopped")
+
+    def put(self, reading):
+        """
+        Queue a parsed reading for storage
+
+        Args:
+            reading: Parsed reading as returned by DataParser.parse
+
+        Returns:
+            True if the reading was queued, False if it was dropped
+        """
+        try:
+            self._queue.put_nowait(reading)
+            self._count('enqueued')
+            return True
+        except queue.Full:
+            pass
+
+        if self.overflow_policy == 'drop_newest':
+            self._count('dropped')
+            logger.debug("Ingest queue full, dropping newest reading")
+            return False
+
+        if self.overflow_policy == 'block':
+            try:
+                self._queue.put(reading, timeout=self.block_timeout)
+                self._count('enqueued')
+                return True
+            except queue.Full:
+                self._count('dropped')
+                logger.warning("Ingest queue still full after blocking, dropping reading")
+                return False
+
+        # drop_oldest: make room by discarding the oldest waiting reading
+        while True:
+            try:
+                self._queue.get_nowait()
+                self._count('dropped')
+            except queue.Empty:
+                pass
+            try:
+                self._queue.put_nowait(reading)
+                self._count('enqueued')
+                return True
+            except queue.Full:
+                continue
+
+    def depth(self):
+        """Number of readings waiting to be written"""
+        return self._queue.qsize()
+
+    def get_stats(self):
+        """
+        Get queue statistics
+
+        Returns:
+            Dictionary with depth, counters and policy
+        """
+        with self._stats_lock:
+            return {
+                'depth': self.depth(),
+                'max_size': self.max_size,
+                'overflow_policy': self.overflow_policy,
+                'enqueued': self.enqueued,
+                'dropped': self.dropped,
+                'written': self.written,
+                'failed': self.failed,
+                'batches': self.batches,
+                'last_flush': self.last_flush
+            }
+
+    def _count(self, counter, amount=1):
+        """Increment a statistics counter"""
+        with self._stats_lock:
+            setattr(self, counter, getattr(self, counter) + amount)
+        instrumentation.INGEST_READINGS.inc(amount, result=counter)
+
+    def _drain(self, limit):
+        """Take up to limit readings from the queue without waiting"""
+        items = []
+        while len(items) < limit:
+            try:
+                items.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return items
+
+    def _writer_loop(self):
+        """Collect readings into batches and write them"""
+        logger.info("Starting ingest writer loop")
+        next_held_flush = time.monotonic() + self.HELD_POINTS_INTERVAL
+
+        while self._running:
+            if time.monotonic() >= next_held_flush:
+                next_held_flush = time.monotonic() + self.HELD_POINTS_INTERVAL
+                try:
+                    self.db.flush_held_points()
+                except Exception as e:
+                    logger.error(f"Failed to write held points: {e}")
+
+            try:
+                first = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+
+            batch = [first]
+            deadline = time.monotonic() + self.flush_interval
+
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+                # Pick up whatever else is already waiting in one go
+                batch.extend(self._drain(self.batch_size - len(batch)))
+
+            self._flush(batch)
+
+        logger.info("Ingest writer loop stopped")
+
+    def _flush(self, batch):
+        """Write one batch to the database"""
+        if not batch:
+            return
+
+        if self.db.insert_readings(batch):
+            self._count('written', len(batch))
+            now = time.time()
+            for reading in batch:
+                timestamp = getattr(reading, 'timestamp', None)
+                if timestamp:
+                    instrumentation.PIPELINE_LATENCY.observe(now - timestamp, stage='commit')
+            if self.on_written:
+                try:
+                    self.on_written(batch)
+                except Exception as e:
+                    logger.error(f"Post-write callback failed: {e}")
+        else:
+            self._count('failed', len(batch))
+
+        with self._stats_lock:
+            self.batches += 1
+            self.last_flush = time.time()
@@ -0,0 +1,276 @@
+"""
+Instrumentation - Counters, gauges and latency histograms
+
+Metrics live in two registries: PIPELINE for reception, parsing and storage,
+which run once in the pipeline process, and HTTP for request handling, which
+runs in every web worker. Both are rendered at /metrics in the Prometheus
+text format and summarized in /api/health; with gunicorn, workers render the
+PIPELINE snapshot relayed by the pipeline process next to their own HTTP one.
+"""
+
+import bisect
+import threading
+
+# Histogram upper bounds in seconds, from sub-millisecond decoding to
+# multi-second commit stalls
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+
+class Metric:
+    """Named metric with optional labels"""
+
+    kind = None
+
+    def __init__(self, name, description, labels=()):
+        """
+        Initialize metric
+
+        Args:
+            name: Prometheus metric name
+            description: One-line help text
+            labels: Names of the labels, values are given when recording
+        """
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+    def snapshot(self):
+        """Serializable state"""
+        with self._lock:
+            samples = [[list(key), value] for key, value in self._values.items()]
+        return {'type': self.kind, 'help': self.description, 'labels': list(self.labels), 'samples': samples}
+
+
+class Counter(Metric):
+    """Monotonic count"""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Current value, set directly or read from a function when collected"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, description, labels=()):
+        super().__init__(name, description, labels)
+        self.function = None
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function):
+        """
+        Read the value when collected
+
+        Args:
+            function: Callable returning a number, or a dictionary of label
+                value tuples to numbers for a labelled gauge
+        """
+        self.function = function
+
+    def snapshot(self):
+        if self.function is not None:
+            values = self.function()
+            if not isinstance(values, dict):
+                values = {(): values}
+            with self._lock:
+                self._values = {tuple(key): value for key, value in values.items()}
+        return super().snapshot()
+
+
+class Histogram(Metric):
+    """Distribution of observations in fixed buckets"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket counts (last one is +Inf), sum, count
+                state = self._values[key] = {
+                    'counts': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0
+                }
+            state['counts'][index] += 1
+            state['sum'] += value
+            state['count'] += 1
+
+    def snapshot(self):
+        with self._lock:
+            samples = [
+                [list(key), {'counts': list(state['counts']), 'sum': state['sum'], 'count': state['count']}]
+                for key, state in self._values.items()
+            ]
+        return {
+            'type': self.kind, 'help': self.description, 'labels': list(self.labels),
+            'buckets': list(self.buckets), 'samples': samples
+        }
+
+
+class Registry:
+    """Set of metrics collected together"""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def _add(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, description, labels=()):
+        return self._add(Counter(name, description, labels))
+
+    def gauge(self, name, description, labels=()):
+        return self._add(Gauge(name, description, labels))
+
+    def histogram(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, description, labels, buckets))
+
+    def snapshot(self):
+        """Serializable state of every metric, by name"""
+        return {name: metric.snapshot() for name, metric in self._metrics.items()}
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _label_text(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_bound(bound):
+    return f'{bound:g}'
+
+
+def render(*snapshots):
+    """
+    Prometheus text exposition (format 0.0.4) of registry snapshots
+
+    Returns:
+        String ending with a newline
+    """
+    lines = []
+    for snapshot in snapshots:
+        for name, metric in (snapshot or {}).items():
+            help_text = metric['help'].replace('\\', '\\\\').replace('\n', '\\n')
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric["type"]}')
+            labels = metric['labels']
+            for values, sample in metric['samples']:
+                if metric['type'] != 'histogram':
+                    lines.append(f'{name}{_label_text(labels, values)} {sample}')
+                    continue
+                cumulative = 0
+                bounds = [_format_bound(bound) for bound in metric['buckets']] + ['+Inf']
+                for bound, count in zip(bounds, sample['counts']):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_label_text(labels, values, ("le", bound))} {cumulative}')
+                lines.append(f'{name}_sum{_label_text(labels, values)} {sample["sum"]}')
+                lines.append(f'{name}_count{_label_text(labels, values)} {sample["count"]}')
+    return '\n'.join(lines) + '\n'
+
+
+def _quantile(bounds, counts, total, q):
+    """Quantile estimated by interpolating inside the histogram bucket"""
+    rank = q * total
+    seen = 0
+    for index, count in enumerate(counts):
+        if count and seen + count >= rank:
+            lower = bounds[index - 1] if index > 0 else 0.0
+            if index == len(bounds):
+                # Beyond the last bound, all we know is the lower one
+                return lower
+            return lower + (bounds[index] - lower) * (rank - seen) / count
+        seen += count
+    return None
+
+
+def summarize(*snapshots):
+    """
+    Compact view of snapshots for /api/health
+
+    Counters and gauges map to their value, or to a dictionary keyed by
+    'label=value,...' when labelled; histograms to count, mean, p50 and p99.
+    """
+    summary = {}
+    for snapshot in snapshots:
+        for name, metric in (snapshot or {}).items():
+            values = {}
+            for label_values, sample in metric['samples']:
+                key = ','.join(
+                    f'{label}={value}' for label, value in zip(metric['labels'], label_values)
+                )
+                if metric['type'] == 'histogram':
+                    count = sample['count']
+                    sample = {
+                        'count': count,
+                        'mean': sample['sum'] / count if count else None,
+                        'p50': _quantile(metric['buckets'], sample['counts'], count, 0.5),
+                        'p99': _quantile(metric['buckets'], sample['counts'], count, 0.99)
+                    }
+                values[key] = sample
+            summary[name] = values.get('') if list(values) == [''] else values
+    return summary
+
+
+PIPELINE = Registry()
+HTTP = Registry()
+
+TELEGRAMS_RECEIVED = PIPELINE.counter(
+    'vmi_telegrams_received_total', 'Radio telegrams received from the transceivers', ('transport', 'gateway')
+)
+TELEGRAMS_DUPLICATE = PIPELINE.counter(
+    'vmi_telegrams_duplicate_total',
+    'Copies of a telegram dropped because another gateway or a repeater delivered it too', ('gateway',)
+)
+TELEGRAMS_PARSED = PIPELINE.counter(
+    'vmi_telegrams_parsed_total',
+    'Telegrams by parse outcome (parsed, unknown_device, unsupported_profile, teach_in, error)',
+    ('result',)
+)
+INGEST_READINGS = PIPELINE.counter(
+    'vmi_ingest_readings_total', 'Readings by ingest outcome (enqueued, dropped, written, failed)', ('result',)
+)
+ERRORS = PIPELINE.counter('vmi_errors_total', 'Errors by pipeline component', ('component',))
+PIPELINE_LATENCY = PIPELINE.histogram(
+    'vmi_pipeline_latency_seconds', 'Time from telegram reception to the end of a stage (parse, commit)', ('stage',)
+)
+STORED_VALUES = PIPELINE.counter(
+    'vmi_stored_values_total', 'Metric values by change filter decision (stored, skipped)', ('result',)
+)
+DB_COMMIT_SECONDS = PIPELINE.histogram(
+    'vmi_db_commit_seconds', 'Duration of SQLite write transactions of a reading batch'
+)
+QUEUE_DEPTH = PIPELINE.gauge('vmi_queue_depth', 'Items waiting in a pipeline queue', ('queue',))
+
+HTTP_REQUEST_SECONDS = HTTP.histogram(
+    'vmi_http_request_seconds', 'Duration of HTTP handlers', ('method', 'endpoint', 'status')
+)
@@ -8,17 +8,34 @@ import logging
 import os
 import sys
 import argparse
+import csv
+import io
+import itertools
+import re
 import threading
 import time
+import uuid
 from datetime import datetime
 from pathlib import Path
+from urllib.parse import urlencode
 
-from flask import Flask, jsonify, request, render_template, send_from_directory
+from flask import Flask, Response, g, jsonify, request, render_template, send_from_directory, stream_with_context
 from flask_cors import CORS
 
-from enocean_handler import EnOceanHandler
+try:
+    from flask_sock import Sock
+except ImportError:
+    Sock = None
+
+import instrumentation
+from gateways import GatewaySet
 from data_parser import DataParser
-from database import Database
+from database import Database, to_epoch
+from ingest_queue import IngestQueue
+from readiness import Readiness
+from records import Reading
+from response_cache import IngestSequence, ResponseCache
+from server import EventRelay, run_server
 
 # Configure logging
 logging.basicConfig(
@@ -34,8 +51,35 @@ CORS(app)
 # Global variables
 config = None
 db = None
-enocean_handler = None
+gateways = None
 data_parser = None
+ingest_queue = None
+retention_service = None
+broadcaster = None
+mqtt_publisher = None
+command_scheduler = None
+data_path = None
+ingest_sequence = IngestSequence()
+
+# Components start concurrently; API requests wait this long for the database
+readiness = Readiness()
+STARTUP_REQUEST_WAIT = 5.0
+STARTUP_ENDPOINTS = ('health', 'metrics', 'get_devices', 'commands', 'command', 'stream', 'stream_ws')
+
+# History pagination
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 10000
+EXPORT_FIELDS = ('timestamp', 'metric', 'unit', 'value', 'min', 'max', 'last', 'count')
+MAX_SERIES = 50
+response_cache = None
+# Seconds between checks for writes of other processes, such as redecode
+EXTERNAL_WRITES_INTERVAL = 5.0
+
+# Gunicorn mode: readings and status go from the pipeline process to the workers,
+# commands from the workers back through command_relay
+event_relay = None
+relay_status = None
+command_relay = None
 
 
 def load_config(config_path):
@@ -50,59 +94,424 @@ def load_config(config_path):
 
 
 def init_app(config_data, db_path, logs_path):
-    """Initialize the application"""
-    global config, db, enocean_handler, data_parser
+    """
+    Initialize the application
+    
+    Only builds the components; start_pipeline() starts the database,
+    MQTT and the EnOcean gateways concurrently. Optional components are
+    imported here rather than with the module, and only when enabled.
+    """
+    global config, db, gateways, data_parser, ingest_queue, retention_service, broadcaster, mqtt_publisher
+    global data_path, event_relay, response_cache, command_scheduler
+    from broadcaster import Broadcaster
+    from command_scheduler import CommandScheduler
+    from retention import RetentionService
     
     config = config_data
+    data_path = db_path
     
     # Set log level
     log_level = config.get('log_level', 'info').upper()
     logging.getLogger().setLevel(getattr(logging, log_level))
     
-    # Initialize database
-    db = Database(db_path)
-    db.initialize()
+    # Opened by start_database()
+    db = Database(db_path, config.get('database', {}))
+    
+    # Responses are reused until the ingest sequence of their device moves
+    response_cache = ResponseCache.from_config(ingest_sequence, config)
+    
+    # Write-behind ingestion and tiered retention, started once the database is open
+    ingest_queue = IngestQueue.from_config(db, config, on_written=on_readings_written)
+    retention_service = RetentionService.from_config(db, config, on_changed=on_data_changed)
+    
+    # Live stream fan-out, relayed to the HTTP workers in gunicorn mode
+    broadcaster = Broadcaster.from_config(config)
+    if config.get('server', {}).get('mode') == 'gunicorn':
+        event_relay = EventRelay()
+    
+    # MQTT output to Home Assistant, if enabled
+    if config.get('mqtt', {}).get('enabled'):
+        from mqtt_publisher import MqttPublisher
+        mqtt_publisher = MqttPublisher.from_config(config, db_path)
     
     # Initialize data parser
     data_parser = DataParser(config)
     
-    # Initialize EnOcean handler
-    enocean_handler = EnOceanHandler(
-        port=config.get('serial_port', '/dev/ttyAMA0'),
-        config=config,
-        callback=on_enocean_message
-    )
+    # Initialize the EnOcean gateways, merged into one stream of telegrams
+    gateways = GatewaySet.from_config(config, on_enocean_message)
+    
+    # Outbound commands, sent one at a time through the gateways
+    command_scheduler = CommandScheduler.from_config(gateways.send_packet, config)
+    command_scheduler.start()
+    if event_relay:
+        event_relay.listen_upstream(on_worker_message)
+    
+    instrumentation.QUEUE_DEPTH.set_function(queue_depths)
     
     logger.info("Application initialized successfully")
 
 
-def on_enocean_message(data):
+def start_pipeline():
+    """Start the database, MQTT and the EnOcean gateways, each in its own thread"""
+    readiness.run('database', start_database)
+    if mqtt_publisher:
+        readiness.run('mqtt', mqtt_publisher.start)
+    else:
+        readiness.set_disabled('mqtt')
+    readiness.run('enocean', start_gateways)
+
+
+def start_database():
+    """Open and migrate the database, then start the components writing to it"""
+    db.initialize()
+    attach_storage_tiers()
+    # Telegrams received meanwhile waited in the ingest queue
+    ingest_queue.start()
+    retention_service.start()
+    threading.Thread(target=watch_external_writes, name='external-writes', daemon=True).start()
+
+
+def attach_storage_tiers():
+    """Attach the archive and the change filter to the database, if enabled"""
+    if config.get('archive', {}).get('enabled'):
+        from archive import Archive
+        db.attach_archive(Archive.from_config(config, data_path))
+    if config.get('change_filter', {}).get('enabled'):
+        from change_filter import ChangeFilter
+        db.attach_change_filter(ChangeFilter.from_config(config))
+
+
+def watch_external_writes():
+    """Invalidate cached responses when another process wrote to the database"""
+    db.changed_elsewhere()
+    while True:
+        time.sleep(EXTERNAL_WRITES_INTERVAL)
+        try:
+            if db.changed_elsewhere():
+                on_data_changed()
+        except Exception as e:
+            logger.error(f"Failed to check for external writes: {e}")
+
+
+def start_gateways():
+    """
+    Start the EnOcean gateways
+    
+    Raises:
+        RuntimeError: If no gateway connected
+    """
+    logger.info("Starting EnOcean gateways")
+    gateways.start()
+    if not gateways.is_connected():
+        raise RuntimeError("No EnOcean gateway connected")
+
+
+def init_worker():
+    """
+    Initialize a gunicorn HTTP worker after fork
+    
+    The pipeline objects inherited from the master belong to its threads:
+    the worker drops them, opens its own database connections and gets
+    readings and pipeline status from the event relay.
+    
+    Returns:
+        Handler of relay messages
+    """
+    global db, gateways, data_parser, ingest_queue, retention_service, broadcaster, mqtt_publisher
+    global event_relay, response_cache, command_scheduler, command_relay
+    from broadcaster import Broadcaster
+    from retention import RetentionService
+    
+    gateways = None
+    data_parser = None
+    ingest_queue = None
+    mqtt_publisher = None
+    command_scheduler = None
+    # Commands go back to the pipeline process, the only one with a radio
+    command_relay = event_relay
+    event_relay = None
+    
+    db = Database(data_path, config.get('database', {}))
+    db.initialize()
+    attach_storage_tiers()
+    
+    # Not started: only serves POST /api/cleanup from this worker
+    retention_service = RetentionService.from_config(db, config, on_changed=on_data_changed)
+    broadcaster = Broadcaster.from_config(config)
+    response_cache = ResponseCache.from_config(ingest_sequence, config)
+    
+    def on_relay_message(kind, payload):
+        global relay_status
+        if kind == 'reading':
+            broadcaster.publish(Reading.from_dict(payload))
+        elif kind == 'ingest':
+            ingest_sequence.update(payload)
+        elif kind == 'status':
+            relay_status = payload
+    
+    logger.info(f"HTTP worker {os.getpid()} initialized")
+    return on_relay_message
+
+
+def pipeline_status():
+    """Status of the EnOcean pipeline components"""
+    return {
+        'enocean_connected': gateways.is_connected() if gateways else False,
+        'enocean': gateways.get_stats() if gateways else None,
+        'ingest': ingest_queue.get_stats() if ingest_queue else None,
+        'retention': retention_service.last_report if retention_service else None,
+        'change_filter': db.change_filter.get_stats() if db and db.change_filter else None,
+        'mqtt': mqtt_publisher.get_stats() if mqtt_publisher else None,
+        'commands': command_scheduler.get_stats() if command_scheduler else None,
+        'command_log': command_scheduler.recent() if command_scheduler else [],
+        'readiness': readiness.snapshot(),
+        'metrics': instrumentation.PIPELINE.snapshot()
+    }
+
+
+def queue_depths():
+    """Depth of every pipeline queue, for the vmi_queue_depth gauge"""
+    depths = {
+        ('radio',): gateways.queue_depth() if gateways else 0,
+        ('ingest',): ingest_queue.depth() if ingest_queue else 0,
+        ('commands',): command_scheduler.depth() if command_scheduler else 0,
+    }
+    if mqtt_publisher:
+        stats = mqtt_publisher.get_stats()
+        depths[('mqtt',)] = stats['pending']
+        depths[('mqtt_disk',)] = stats['disk_buffered']
+    return depths
+
+
+def on_enocean_message(telegram):
     """Callback for EnOcean message reception"""
     try:
+        # Any telegram from a device acknowledges the commands sent to it
+        command_scheduler.observe(telegram)
+        
         # Parse the message
-        parsed_data = data_parser.parse(data)
+        parsed_data = data_parser.parse(telegram)
         
         if parsed_data:
-            # Store in database
-            db.insert_reading(parsed_data)
+            # Queue for batched storage
+            ingest_queue.put(parsed_data)
+            
+            # Push to live stream clients
+            broadcaster.publish(parsed_data)
+            if event_relay:
+                event_relay.publish('reading', parsed_data.to_dict())
+            
+            if mqtt_publisher:
+                mqtt_publisher.submit(parsed_data)
             
             # Log for debugging
-            logger.debug(f"Received and stored: {parsed_data}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Received and queued: {parsed_data}")
     except Exception as e:
+        instrumentation.ERRORS.inc(component='pipeline')
         logger.error(f"Error processing message: {e}")
 
 
+def on_worker_message(kind, payload):
+    """Handle a message a gunicorn worker sent to the pipeline process"""
+    if kind == 'command':
+        command_scheduler.submit(**payload)
+    elif kind == 'cancel':
+        command_scheduler.cancel(payload['id'])
+    elif kind == 'changed':
+        on_data_changed()
+
+
+def on_readings_written(batch):
+    """Invalidate cached responses of the devices of a committed batch"""
+    ingest_sequence.bump(reading.device_id for reading in batch)
+    if event_relay:
+        event_relay.publish('ingest', ingest_sequence.snapshot())
+
+
+def on_data_changed():
+    """Invalidate every cached response after a write changing past results"""
+    if command_relay:
+        # Gunicorn worker: the pipeline process owns the ingest sequence
+        command_relay.send_upstream('changed', {})
+        return
+    ingest_sequence.invalidate()
+    if event_relay:
+        event_relay.publish('ingest', ingest_sequence.snapshot())
+
+
+def cached_response(build, device_id=None, windowed=True):
+    """
+    Serve build() through the response cache
+    
+    Args:
+        build: Callable returning the data to serialize
+        device_id: Device the data depends on, None for all devices
+        windowed: Whether the data depends on the current time
+    
+    Returns:
+        Response, 304 if the client's ETag or date is still current
+    """
+    key = (request.path, tuple(sorted(request.args.items(multi=True))))
+    entry = response_cache.get(key, device_id, windowed)
+    if entry is None:
+        state = ingest_sequence.get(device_id)
+        entry = response_cache.put(key, state, app.json.dumps(build()).encode(), windowed)
+    
+    headers = response_cache.headers(entry)
+    if response_cache.is_not_modified(
+        entry,
+        request.headers.get('If-None-Match'),
+        request.headers.get('If-Modified-Since')
+    ):
+        return Response(status=304, headers=headers)
+    
+    body, encoding = response_cache.encode(entry, request.headers.get('Accept-Encoding'))
+    if encoding:
+        headers['Content-Encoding'] = encoding
+    return Response(body, mimetype='application/json', headers=headers)
+
+
+def parse_cursor(value):
+    """
+    Read a keyset cursor from ?after=
+    
+    Args:
+        value: Epoch seconds, ISO date, or '<epoch>:<metric key>' as sent
+            in X-Next-Cursor
+    
+    Returns:
+        Tuple (epoch, metric key or None), None if no cursor was given
+    
+    Raises:
+        ValueError: If the cursor cannot be read
+    """
+    if not value:
+        return None
+    
+    match = re.fullmatch(r'(\d+)(?::(\d+))?', value)
+    if match:
+        return int(match.group(1)), int(match.group(2)) if match.group(2) else None
+    
+    epoch = to_epoch(value)
+    if epoch is None:
+        raise ValueError(f"Invalid cursor '{value}', expected epoch seconds or ISO date")
+    return epoch, None
+
+
+def paginated_history(device_id, metric_name, hours, resolution):
+    """
+    One page of history, oldest first
+    
+    Returns:
+        Response with X-Next-Cursor and Link headers when more points follow
+    """
+    after = parse_cursor(request.args.get('after'))
+    limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+    if limit < 1:
+        raise ValueError("limit must be positive")
+    limit = min(limit, MAX_PAGE_SIZE)
+    
+    points = []
+    cursor = None
+    for cursor, point in db.iter_history(
+        device_id, metric_name, hours, resolution, after=after, limit=limit
+    ):
+        points.append(point)
+    
+    response = jsonify(points)
+    if len(points) == limit:
+        token = f'{cursor[0]}:{cursor[1]}'
+        args = request.args.to_dict()
+        args.update(after=token, limit=limit)
+        response.headers['X-Next-Cursor'] = token
+        response.headers['Link'] = f'<{request.path}?{urlencode(args)}>; rel="next"'
+    return response
+
+
+def _is_paginated():
+    return 'after' in request.args or 'limit' in request.args
+
+
+@app.before_request
+def start_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.before_request
+def wait_for_database():
+    """Hold API requests while the database is still opening, 503 if it takes too long or failed"""
+    state = readiness.state('database')
+    if state in (None, 'ready'):
+        return None
+    if not request.path.startswith('/api/') or request.endpoint in STARTUP_ENDPOINTS:
+        return None
+    if state == 'starting' and readiness.wait('database', STARTUP_REQUEST_WAIT):
+        return None
+    response = jsonify({'error': 'Database not ready', 'readiness': readiness.snapshot()})
+    response.status_code = 503
+    response.headers['Retry-After'] = '1'
+    return response
+
+
+@app.after_request
+def record_timing(response):
+    """Time every handler, labelled by route rather than path"""
+    started = g.pop('request_started', None)
+    if started is not None:
+        instrumentation.HTTP_REQUEST_SECONDS.observe(
+            time.perf_counter() - started,
+            method=request.method,
+            endpoint=request.url_rule.rule if request.url_rule else 'unmatched',
+            status=response.status_code
+        )
+    return response
+
+
+def _pipeline_state():
+    """Pipeline status and metrics snapshot, relayed in gunicorn workers"""
+    # Gunicorn workers report the status last sent by the pipeline process
+    status = dict(relay_status if relay_status is not None else pipeline_status())
+    metrics = status.pop('metrics', None)
+    status.pop('command_log', None)
+    return status, metrics
+
+
+def _command_log():
+    """Recent outbound commands, newest first, relayed in gunicorn workers"""
+    if command_scheduler:
+        return command_scheduler.recent()
+    return (relay_status or {}).get('command_log', [])
+
+
 # REST API Endpoints
 @app.route('/api/health', methods=['GET'])
 def health():
     """Health check endpoint"""
+    status, metrics = _pipeline_state()
     return jsonify({
         'status': 'healthy',
+        'ready': status['readiness']['ready'],
         'timestamp': datetime.now().isoformat(),
-        'enocean_connected': enocean_handler.is_connected() if enocean_handler else False
+        'pid': os.getpid(),
+        **status,
+        'database': db.connections.get_stats() if db and db.connections else None,
+        'stream': broadcaster.get_stats() if broadcaster else None,
+        'cache': response_cache.get_stats() if response_cache else None,
+        'metrics': instrumentation.summarize(metrics, instrumentation.HTTP.snapshot())
     })
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus scrape endpoint"""
+    _, pipeline_metrics = _pipeline_state()
+    return Response(
+        instrumentation.render(pipeline_metrics, instrumentation.HTTP.snapshot()),
+        content_type='text/plain; version=0.0.4; charset=utf-8'
+    )
+
+
 @app.route('/api/devices', methods=['GET'])
 def get_devices():
     """Get list of configured devices"""
@@ -137,8 +546,7 @@ def get_devices():
 def get_current():
     """Get current readings for all devices"""
     try:
-        readings = db.get_latest_readings()
-        return jsonify(readings)
+        return cached_response(db.get_latest_readings, windowed=False)
     except Exception as e:
         logger.error(f"Error getting current readings: {e}")
         return jsonify({'error': str(e)}), 500
@@ -149,8 +557,15 @@ def get_history(device_id):
     """Get historical readings for a device"""
     try:
         hours = request.args.get('hours', 24, type=int)
-        readings = db.get_readings_history(device_id, hours)
-        return jsonify(readings)
+        resolution = request.args.get('resolution')
+        if _is_paginated():
+            return paginated_history(device_id, None, hours, resolution)
+        return cached_response(
+            lambda: db.get_readings_history(device_id, hours, resolution),
+            device_id
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         logger.error(f"Error getting history: {e}")
         return jsonify({'error': str(e)}), 500
@@ -161,13 +576,370 @@ def get_metric(device_id, metric):
     """Get specific metric for a device"""
     try:
         hours = request.args.get('hours', 24, type=int)
-        data = db.get_metric_history(device_id, metric, hours)
-        return jsonify(data)
+        resolution = request.args.get('resolution')
+        if _is_paginated():
+            return paginated_history(device_id, metric, hours, resolution)
+        return cached_response(
+            lambda: db.get_metric_history(device_id, metric, hours, resolution),
+            device_id
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         logger.error(f"Error getting metric: {e}")
         return jsonify({'error': str(e)}), 500
 
 
+def _time_arg(name):
+    """
+    Epoch seconds of a query argument given as epoch or ISO date, None if absent
+    
+    Raises:
+        ValueError: If the argument cannot be read
+    """
+    value = request.args.get(name)
+    if not value:
+        return None
+    epoch = int(value) if value.isdigit() else to_epoch(value)
+    if epoch is None:
+        raise ValueError(f"Invalid {name} '{value}', expected epoch seconds or ISO date")
+    return epoch
+
+
+@app.route('/api/stats/<device_id>/<metric>', methods=['GET'])
+def get_stats(device_id, metric):
+    """Aggregates and percentiles of a metric over a window"""
+    try:
+        hours = request.args.get('hours', 24, type=float)
+        start = _time_arg('start')
+        end = _time_arg('end')
+        percentiles = tuple(
+            float(value) for value in request.args.get('percentiles', '50,95').split(',') if value
+        )
+        if any(not 0 <= percentile <= 100 for percentile in percentiles):
+            raise ValueError("percentiles must be between 0 and 100")
+        
+        def build():
+            stats = db.get_statistics(device_id, metric, hours, start, end, percentiles)
+            if stats is None:
+                raise RuntimeError("Statistics unavailable")
+            return stats
+        
+        # A window ending now moves with time
+        return cached_response(build, device_id, windowed=end is None)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error getting statistics: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+# JSON types accepted for each field of a POST /api/series body
+SERIES_FIELDS = {
+    'series': (list,),
+    'hours': (int, float),
+    'resolution': (str,),
+    'fields': (list,)
+}
+
+
+def _json_field(body, name, types):
+    """
+    Field of a JSON body, None if absent or null
+    
+    Raises:
+        ValueError: If the field has another JSON type
+    """
+    value = body.get(name)
+    if value is None:
+        return None
+    # JSON true/false are bools, which are ints to Python
+    if not isinstance(value, types) or (isinstance(value, bool) and bool not in types):
+        expected = ' or '.join(
+            {str: 'string', int: 'integer', float: 'number', bool: 'boolean', list: 'array'}[t] for t in types
+        )
+        raise ValueError(f"'{name}' must be a {expected}")
+    return value
+
+
+def _series_request():
+    """
+    Pairs, window, resolution and fields of a series request
+    
+    GET takes repeatable or comma separated ?series=<device>:<metric>,
+    POST a JSON body {"series": [[device, metric], ...], "hours", "resolution", "fields"}.
+    
+    Raises:
+        ValueError: If no series, too many, or a malformed one is given, or a
+            field of the JSON body has the wrong type
+    """
+    if request.method == 'POST':
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            raise ValueError("JSON object body required")
+        values = {name: _json_field(body, name, types) for name, types in SERIES_FIELDS.items()}
+        items = values['series'] or []
+        hours = int(24 if values['hours'] is None else values['hours'])
+        resolution = values['resolution']
+        fields = values['fields'] or ['value']
+        if not all(isinstance(field, str) for field in fields):
+            raise ValueError("'fields' must be an array of strings")
+    else:
+        items = []
+        for value in request.args.getlist('series'):
+            items.extend(item.strip() for item in value.split(',') if item.strip())
+        hours = request.args.get('hours', 24, type=int)
+        resolution = request.args.get('resolution')
+        fields = request.args.get('fields', 'value').split(',')
+    
+    pairs = []
+    for item in items:
+        pair = item.split(':', 1) if isinstance(item, str) else item
+        if len(pair) != 2 or not all(isinstance(part, str) and part for part in pair):
+            raise ValueError(f"Invalid series {item!r}, expected <device>:<metric>")
+        pairs.append(tuple(pair))
+    if not pairs:
+        raise ValueError("At least one series is required")
+    if len(pairs) > MAX_SERIES:
+        raise ValueError(f"At most {MAX_SERIES} series per request")
+    
+    return pairs, hours, resolution, tuple(field.strip() for field in fields)
+
+
+@app.route('/api/series', methods=['GET', 'POST'])
+def get_series():
+    """Several device/metric series over one window, in columnar layout"""
+    try:
+        pairs, hours, resolution, fields = _series_request()
+        build = lambda: db.get_series(pairs, hours, resolution, fields)
+        # A POST body is not part of the cache key
+        if request.method == 'POST':
+            return jsonify(build())
+        devices = {device_id for device_id, _ in pairs}
+        return cached_response(build, devices.pop() if len(devices) == 1 else None)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error getting series: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+def _stream_filters():
+    """Device and metric filters of a stream request, repeatable or comma separated"""
+    def values(name):
+        items = []
+        for value in request.args.getlist(name):
+            items.extend(item.strip() for item in value.split(',') if item.strip())
+        return items or None
+    
+    return values('device'), values('metric')
+
+
+@app.route('/api/stream', methods=['GET'])
+def stream():
+    """Push new readings as Server-Sent Events"""
+    devices, metrics = _stream_filters()
+    try:
+        subscription = broadcaster.subscribe(devices, metrics)
+    except RuntimeError as e:
+        return jsonify({'error': str(e)}), 503
+    
+    def events():
+        try:
+            yield "retry: 3000\n\n"
+            while not subscription.closed:
+                pending = subscription.get(timeout=broadcaster.heartbeat)
+                dropped = subscription.take_dropped()
+                if dropped:
+                    yield f"event: dropped\ndata: {{\"count\": {dropped}}}\n\n"
+                if not pending:
+                    # Keep-alive, also how a closed connection gets noticed
+                    yield ": keepalive\n\n"
+                    continue
+                yield ''.join(
+                    f"id: {event_id}\nevent: reading\ndata: {data}\n\n"
+                    for event_id, data in pending
+                )
+        finally:
+            broadcaster.unsubscribe(subscription)
+    
+    return Response(
+        stream_with_context(events()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+if Sock is not None:
+    sock = Sock(app)
+    
+    @sock.route('/api/ws')
+    def stream_ws(ws):
+        """Push new readings over a WebSocket, same filters as /api/stream"""
+        devices, metrics = _stream_filters()
+        try:
+            subscription = broadcaster.subscribe(devices, metrics)
+        except RuntimeError as e:
+            ws.close(reason=1013, message=str(e))
+            return
+        
+        try:
+            while not subscription.closed:
+                for _, data in subscription.get(timeout=broadcaster.heartbeat):
+                    ws.send(data)
+        finally:
+            broadcaster.unsubscribe(subscription)
+
+
+@app.route('/api/export/<device_id>', methods=['GET'])
+def export_history(device_id):
+    """Stream a device's history as NDJSON or CSV, straight from the database cursor"""
+    try:
+        metric = request.args.get('metric')
+        hours = request.args.get('hours', 24, type=int)
+        resolution = request.args.get('resolution')
+        export_format = request.args.get('format', 'ndjson')
+        if export_format not in ('ndjson', 'csv'):
+            raise ValueError(f"Unknown format '{export_format}', expected ndjson or csv")
+        
+        points = db.iter_history(
+            device_id, metric, hours, resolution,
+            after=parse_cursor(request.args.get('after'))
+        )
+        # Fetch the first chunk now, so parameter errors still get a 400
+        first = next(points, None)
+        points = itertools.chain([first] if first else [], points)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error exporting history: {e}")
+        return jsonify({'error': str(e)}), 500
+    
+    def ndjson():
+        for chunk in _chunks(points):
+            yield ''.join(json.dumps(point) + '\n' for _, point in chunk)
+    
+    def csv_rows():
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, EXPORT_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        for chunk in _chunks(points):
+            writer.writerows(point for _, point in chunk)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+    
+    name = f"{device_id}{'_' + metric if metric else ''}.{export_format}"
+    return Response(
+        stream_with_context(ndjson() if export_format == 'ndjson' else csv_rows()),
+        mimetype='application/x-ndjson' if export_format == 'ndjson' else 'text/csv',
+        headers={'Content-Disposition': f'attachment; filename="{name}"'}
+    )
+
+
+def _chunks(points, size=500):
+    """Group points so the response is written in a few larger pieces"""
+    while True:
+        chunk = list(itertools.islice(points, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+@app.route('/api/cleanup', methods=['POST'])
+def run_cleanup():
+    """Start a retention pass in the background"""
+    try:
+        threading.Thread(target=retention_service.run_once, daemon=True).start()
+        return jsonify({'status': 'started'}), 202
+    except Exception as e:
+        logger.error(f"Error starting cleanup: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+# JSON types accepted for each command field, checked before any conversion
+COMMAND_FIELDS = {
+    'device_id': (str,),
+    'data': (str,),
+    'rorg': (str, int),
+    'ack_rorg': (str, int),
+    'priority': (str,),
+    'kind': (str,),
+    'ack': (bool,),
+    'retries': (int,),
+    'ttl': (int, float)
+}
+
+
+def _command_request():
+    """
+    Keyword arguments of CommandScheduler.submit from a JSON body
+    
+    Raises:
+        ValueError: If a field is missing, has the wrong JSON type or is negative
+    """
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        raise ValueError("JSON object body required")
+    if not body.get('device_id') or not body.get('data'):
+        raise ValueError("'device_id' and 'data' are required")
+    
+    arguments = {}
+    for name, types in COMMAND_FIELDS.items():
+        value = _json_field(body, name, types)
+        if value is None:
+            continue
+        if name in ('retries', 'ttl') and value < 0:
+            raise ValueError(f"'{name}' cannot be negative")
+        arguments['receiver_id' if name == 'device_id' else name] = value
+    return arguments
+
+
+@app.route('/api/commands', methods=['GET', 'POST'])
+def commands():
+    """List recent outbound commands, or queue one"""
+    if request.method == 'GET':
+        status, _ = _pipeline_state()
+        return jsonify({'stats': status.get('commands'), 'commands': _command_log()})
+    
+    try:
+        arguments = _command_request()
+        if command_scheduler:
+            command = command_scheduler.submit(**arguments)
+            return jsonify(command.to_dict()), 202
+        
+        # Gunicorn worker: the pipeline process validates and sends it
+        if command_relay:
+            arguments['command_id'] = uuid.uuid4().hex[:12]
+            if command_relay.send_upstream('command', arguments):
+                return jsonify({'id': arguments['command_id'], 'state': 'forwarded'}), 202
+        return jsonify({'error': 'Command scheduler unavailable'}), 503
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error queuing command: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/commands/<command_id>', methods=['GET', 'DELETE'])
+def command(command_id):
+    """Get the state of an outbound command, or cancel it"""
+    if request.method == 'DELETE':
+        if command_scheduler:
+            if not command_scheduler.cancel(command_id):
+                return jsonify({'error': 'Command not found or finished'}), 404
+            return jsonify({'id': command_id, 'state': 'cancelled'})
+        if command_relay and command_relay.send_upstream('cancel', {'id': command_id}):
+            return jsonify({'id': command_id, 'state': 'cancelling'}), 202
+        return jsonify({'error': 'Command scheduler unavailable'}), 503
+    
+    for entry in _command_log():
+        if entry['id'] == command_id:
+            return jsonify(entry)
+    return jsonify({'error': 'Command not found'}), 404
+
+
 # Web Interface Routes
 @app.route('/', methods=['GET'])
 def index():
@@ -187,21 +959,6 @@ def settings():
     return render_template('settings.html')
 
 
-def run_server(port):
-    """Run Flask server"""
-    logger.info(f"Starting web server on port {port}")
-    app.run(host='0.0.0.0', port=port, debug=False)
-
-
-def daemon_enocean():
-    """Run EnOcean handler in background"""
-    try:
-        logger.info("Starting EnOcean handler")
-        enocean_handler.start()
-    except Exception as e:
-        logger.error(f"EnOcean handler error: {e}")
-
-
 def main():
     """Main entry point"""
     parser = argparse.ArgumentParser(description='Ventilairsec VMI Monitor')
@@ -218,28 +975,51 @@ def main():
     # Load configuration
     config_data = load_config(args.config)
     
-    # Initialize application
+    # Initialize application, the web server binds while the pipeline starts
     init_app(config_data, args.db, args.logs)
+    start_pipeline()
     
-    # Start EnOcean handler in background thread
-    enocean_thread = threading.Thread(target=daemon_enocean, daemon=True)
-    enocean_thread.start()
-    
-    # Give EnOcean time to initialize
-    time.sleep(2)
+    # Forked workers open the database themselves, after migrations
+    if config.get('server', {}).get('mode') == 'gunicorn':
+        readiness.wait('database')
     
     # Start web server
     web_port = config.get('web_port', 5000)
-    run_server(web_port)
+    run_server(
+        app,
+        web_port,
+        config.get('server', {}),
+        relay=event_relay,
+        worker_init=init_worker,
+        status=pipeline_status,
+        on_exit=shutdown
+    )
+
+
+def shutdown():
+    """Stop the pipeline and close the database"""
+    logger.info("Shutdown requested")
+    if command_scheduler:
+        command_scheduler.stop()
+    if gateways:
+        gateways.stop()
+    if broadcaster:
+        broadcaster.close()
+    if mqtt_publisher:
+        mqtt_publisher.stop()
+    if retention_service:
+        retention_service.stop()
+    if ingest_queue:
+        ingest_queue.stop()
+    if db:
+        db.close()
 
 
 if __name__ == '__main__':
     try:
         main()
     except KeyboardInterrupt:
-        logger.info("Shutdown requested")
-        if enocean_handler:
-            enocean_handler.stop()
+        shutdown()
         sys.exit(0)
     except Exception as e:
         logger.error(f"Fatal error: {e}")
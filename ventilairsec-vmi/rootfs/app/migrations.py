@@ -0,0 +1,202 @@
+"""
+Schema Migrations - Move databases written by older versions to the current format
+"""
+
+import logging
+from datetime import datetime
+
+from records import format_device_id
+
+logger = logging.getLogger(__name__)
+
+# Tables of storage format v1, renamed out of the way during the migration
+V1_READINGS = 'readings_v1'
+V1_DEVICES = 'devices_v1'
+
+
+def _table_columns(connection, table):
+    """Get the column names of a table, empty if it does not exist"""
+    return {row[1] for row in connection.execute(f'PRAGMA table_info({table})')}
+
+
+def has_v1_schema(connection):
+    """Check whether the live tables still use storage format v1"""
+    return 'metric_name' in _table_columns(connection, 'readings')
+
+
+def has_v1_tables(connection):
+    """Check whether renamed v1 tables are waiting to be copied"""
+    return bool(_table_columns(connection, V1_READINGS))
+
+
+def rename_v1_tables(connection):
+    """Rename the v1 tables so the v2 tables can be created under the same names"""
+    with connection:
+        connection.execute(f'ALTER TABLE readings RENAME TO {V1_READINGS}')
+        if _table_columns(connection, 'devices'):
+            connection.execute(f'ALTER TABLE devices RENAME TO {V1_DEVICES}')
+        connection.execute('DROP INDEX IF EXISTS idx_device_timestamp')
+    logger.info("Storage format v1 detected, migrating to v2")
+
+
+def _parse_timestamp(value):
+    """Convert a v1 ISO timestamp (local time) to epoch seconds"""
+    if not value:
+        return None
+    try:
+        return int(datetime.fromisoformat(str(value)).timestamp())
+    except ValueError:
+        return None
+
+
+def _parse_address(value):
+    """Convert a v1 address (bare hex such as '0421574F') to the current device ID format"""
+    if value is None:
+        return None
+    try:
+        return format_device_id(str(value).strip())
+    except ValueError:
+        return None
+
+
+def migrate_v1_to_v2(connection, device_key, metric_key, chunk_size=5000, vacuum=True):
+    """
+    Copy v1 readings into the v2 tables, then drop the v1 tables
+
+    Rows are copied in chunks of chunk_size, one transaction per chunk, and
+    each copied chunk is deleted from the v1 table in the same transaction,
+    so an interrupted migration resumes where it stopped.
+
+    Args:
+        connection: Writer connection
+        device_key: Callable (cursor, address, name, type) returning a device key
+        metric_key: Callable (cursor, name, unit) returning a metric key
+        chunk_size: Number of v1 rows per transaction
+        vacuum: Run VACUUM afterwards to give the freed pages back to the filesystem
+    """
+    copied = 0
+    skipped = 0
+    invalid_addresses = set()
+
+    # Device names, types and last_seen from the v1 devices table
+    if _table_columns(connection, V1_DEVICES):
+        with connection:
+            cursor = connection.cursor()
+            for row in connection.execute(f'SELECT id, name, type, last_seen, status FROM {V1_DEVICES}').fetchall():
+                address = _parse_address(row[0])
+                if address is None:
+                    invalid_addresses.add(row[0])
+                    continue
+                key = device_key(cursor, address, row[1], row[2])
+                cursor.execute(
+                    'UPDATE devices SET name = ?, type = ?, last_seen = ?, status = ? WHERE id = ?',
+                    (row[1], row[2], _parse_timestamp(row[3]), row[4], key)
+                )
+            cursor.execute(f'DROP TABLE {V1_DEVICES}')
+
+    while True:
+        rows = connection.execute(f'''
+            SELECT id, device_id, device_type, device_name, metric_name,
+                   metric_value, metric_unit, raw_data, timestamp
+            FROM {V1_READINGS}
+            ORDER BY id
+            LIMIT ?
+        ''', (chunk_size,)).fetchall()
+
+        if not rows:
+            break
+
+        with connection:
+            cursor = connection.cursor()
+            telegrams = set()
+            readings = []
+
+            for (_, address, device_type, device_name, metric_name,
+                 value, unit, raw_data, timestamp) in rows:
+                epoch = _parse_timestamp(timestamp)
+                device_id = _parse_address(address)
+                if address is not None and device_id is None:
+                    invalid_addresses.add(address)
+                if device_id is None or metric_name is None or epoch is None:
+                    skipped += 1
+                    continue
+
+                key = device_key(cursor, device_id, device_name, device_type)
+                readings.append((key, epoch, metric_key(cursor, metric_name, unit), value))
+
+                # v1 repeated the payload on every metric row of a telegram
+                if raw_data:
+                    try:
+                        telegrams.add((key, epoch, bytes.fromhex(raw_data)))
+                    except ValueError:
+                        pass
+
+            cursor.executemany(
+                'INSERT OR REPLACE INTO readings (device_id, timestamp, metric_id, value) VALUES (?, ?, ?, ?)',
+                readings
+            )
+            # A telegram can straddle two chunks
+            cursor.executemany('''
+                INSERT INTO telegrams (device_id, timestamp, raw_data)
+                SELECT ?1, ?2, ?3
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM telegrams
+                    WHERE device_id = ?1 AND timestamp = ?2 AND raw_data = ?3
+                )
+            ''', sorted(telegrams))
+            cursor.execute(f'DELETE FROM {V1_READINGS} WHERE id <= ?', (rows[-1][0],))
+
+        copied += len(readings)
+        logger.info(f"Migrated {copied} readings to storage format v2")
+
+    with connection:
+        connection.execute(f'DROP TABLE {V1_READINGS}')
+
+    if invalid_addresses:
+        logger.warning(f"Skipped v1 devices with unparseable addresses: {sorted(map(str, invalid_addresses))}")
+    if skipped:
+        logger.warning(f"Skipped {skipped} v1 readings without device, metric or valid timestamp")
+
+    if vacuum:
+        logger.info("Compacting database after migration")
+        connection.execute('VACUUM')
+        connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    logger.info(f"Migration to storage format v2 complete ({copied} readings)")
+
+
+def has_rollup_sketches(connection):
+    """Check whether the rollups table has the sketch column of storage format v3"""
+    return 'sketch' in _table_columns(connection, 'rollups')
+
+
+def add_rollup_sketches(connection, resolutions):
+    """
+    Add the sketch column to the rollups and fill it from the readings still stored
+
+    Only buckets whose readings are all still in the readings table get a
+    sketch; older ones keep NULL and are left out of percentiles.
+
+    Args:
+        connection: Writer connection with the sketch SQL functions registered
+        resolutions: Bucket widths in seconds
+    """
+    with connection:
+        connection.execute('ALTER TABLE rollups ADD COLUMN sketch BLOB')
+        for seconds in resolutions:
+            cursor = connection.execute('''
+                UPDATE rollups SET sketch = s.sketch
+                FROM (
+                    SELECT device_id, metric_id, timestamp - timestamp % :resolution AS bucket,
+                           COUNT(*) AS count, sketch_build(value) AS sketch
+                    FROM readings
+                    WHERE value IS NOT NULL
+                    GROUP BY device_id, metric_id, bucket
+                ) s
+                WHERE rollups.resolution = :resolution
+                  AND rollups.device_id = s.device_id
+                  AND rollups.metric_id = s.metric_id
+                  AND rollups.bucket = s.bucket
+                  AND rollups.count = s.count
+            ''', {'resolution': seconds})
+            logger.info(f"Built quantile sketches for {cursor.rowcount} buckets of {seconds}s")
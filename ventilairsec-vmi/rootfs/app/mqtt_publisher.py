@@ -0,0 +1,387 @@
+"""
+MQTT Publisher - Push readings to Home Assistant over MQTT
+
+Readings are coalesced per device/metric, unchanged values are only
+republished every min_interval seconds, and messages that cannot be sent
+while the broker is unreachable are kept in a bounded file until the
+connection comes back.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Home Assistant device classes by metric name prefix
+DEVICE_CLASSES = {
+    'temperature': 'temperature',
+    'humidity': 'humidity',
+    'co2': 'carbon_dioxide'
+}
+
+
+def _default_client_factory(client_id):
+    """Build a paho client, imported here so the addon runs without paho"""
+    import paho.mqtt.client as mqtt
+
+    if hasattr(mqtt, 'CallbackAPIVersion'):
+        # paho-mqtt 2.x keeps the 1.x callback signatures with VERSION1
+        return mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id=client_id)
+    return mqtt.Client(client_id=client_id)
+
+
+class DiskBuffer:
+    """Bounded append-only file of messages waiting for the broker"""
+
+    def __init__(self, path, max_messages=10000):
+        """
+        Initialize buffer
+
+        Args:
+            path: File holding one JSON message per line, None to keep nothing
+            max_messages: Oldest messages are discarded beyond this count
+        """
+        self.path = path
+        self.max_messages = max_messages
+        self.count = 0
+        self.discarded = 0
+        self._lock = threading.Lock()
+
+        if path and os.path.exists(path):
+            with open(path, 'r') as f:
+                self.count = sum(1 for _ in f)
+            if self.count:
+                logger.info(f"{self.count} MQTT messages buffered from a previous run")
+
+    def append(self, messages):
+        """Store (topic, payload, retain) messages"""
+        if not self.path or not messages:
+            return
+
+        with self._lock:
+            with open(self.path, 'a') as f:
+                for topic, payload, retain in messages:
+                    f.write(json.dumps([topic, payload, retain]) + '\n')
+            self.count += len(messages)
+
+            if self.count > self.max_messages:
+                self._compact()
+
+    def _compact(self):
+        """Keep only the newest max_messages"""
+        with open(self.path, 'r') as f:
+            lines = f.readlines()
+        keep = lines[-self.max_messages:]
+        self.discarded += len(lines) - len(keep)
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.writelines(keep)
+        os.replace(tmp_path, self.path)
+        self.count = len(keep)
+
+    def drain(self):
+        """Remove and return every stored message, oldest first"""
+        if not self.path or not self.count:
+            return []
+
+        with self._lock:
+            try:
+                with open(self.path, 'r') as f:
+                    messages = [tuple(json.loads(line)) for line in f if line.strip()]
+            except (OSError, ValueError) as e:
+                logger.error(f"Unreadable MQTT buffer {self.path}, discarding it: {e}")
+                messages = []
+            os.remove(self.path)
+            self.count = 0
+            return messages
+
+
+class MqttPublisher:
+    """One persistent MQTT connection publishing readings and HA discovery"""
+
+    def __init__(self, host='localhost', port=1883, username=None, password=None,
+                 client_id='ventilairsec-vmi', base_topic='ventilairsec',
+                 discovery_prefix='homeassistant', qos=1, keepalive=60,
+                 coalesce_ms=500, min_interval=60, buffer_path=None,
+                 buffer_max_messages=10000, client_factory=None):
+        """
+        Initialize publisher
+
+        Args:
+            host: Broker host
+            port: Broker port
+            username: Broker user, None for anonymous
+            password: Broker password
+            client_id: MQTT client identifier
+            base_topic: Prefix of state and availability topics
+            discovery_prefix: Home Assistant discovery prefix
+            qos: QoS of state messages
+            keepalive: MQTT keepalive in seconds
+            coalesce_ms: Readings of the same metric within this window
+                are published once, with the latest value
+            min_interval: Seconds before an unchanged value is republished
+            buffer_path: File for messages produced while disconnected
+            buffer_max_messages: Bound of that file
+            client_factory: Callable(client_id) returning a paho-compatible
+                client, lets tests use a stub broker
+        """
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.client_id = client_id
+        self.base_topic = base_topic.rstrip('/')
+        self.discovery_prefix = discovery_prefix.rstrip('/')
+        self.qos = qos
+        self.keepalive = keepalive
+        self.coalesce = coalesce_ms / 1000.0
+        self.min_interval = min_interval
+        self.client_factory = client_factory or _default_client_factory
+        self.buffer = DiskBuffer(buffer_path, buffer_max_messages)
+
+        self.availability_topic = f'{self.base_topic}/status'
+        self.client = None
+        self.connected = False
+
+        # (device_id, metric) -> (value, reading) waiting for the next flush
+        self._pending = {}
+        # (device_id, metric) -> (value, monotonic time) last published
+        self._published = {}
+        self._announced = set()
+        self._reannounce = False
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+        self.stats = {
+            'published': 0,
+            'skipped_unchanged': 0,
+            'coalesced': 0,
+            'buffered': 0,
+            'replayed': 0,
+            'errors': 0
+        }
+
+    @classmethod
+    def from_config(cls, config, data_path=None, client_factory=None):
+        """
+        Build a publisher from the 'mqtt' configuration section
+
+        Returns:
+            MqttPublisher, or None if MQTT is not enabled
+        """
+        options = config.get('mqtt', {})
+        if not options.get('enabled'):
+            return None
+
+        return cls(
+            host=options.get('host', 'localhost'),
+            port=options.get('port', 1883),
+            username=options.get('username') or None,
+            password=options.get('password') or None,
+            client_id=options.get('client_id', 'ventilairsec-vmi'),
+            base_topic=options.get('base_topic', 'ventilairsec'),
+            discovery_prefix=options.get('discovery_prefix', 'homeassistant'),
+            qos=options.get('qos', 1),
+            keepalive=options.get('keepalive', 60),
+            coalesce_ms=options.get('coalesce_ms', 500),
+            min_interval=options.get('min_interval', 60),
+            buffer_path=os.path.join(data_path, 'mqtt_buffer.jsonl') if data_path else None,
+            buffer_max_messages=options.get('buffer_max_messages', 10000),
+            client_factory=client_factory
+        )
+
+    def start(self):
+        """Connect in the background and start the publishing thread"""
+        if self._thread:
+            return
+
+        client = self.client_factory(self.client_id)
+        if self.username:
+            client.username_pw_set(self.username, self.password)
+        client.will_set(self.availability_topic, 'offline', qos=1, retain=True)
+        client.on_connect = self._on_connect
+        client.on_disconnect = self._on_disconnect
+        client.on_message = self._on_message
+        self.client = client
+
+        # connect_async + loop_start: paho retries in its own network thread
+        client.connect_async(self.host, self.port, keepalive=self.keepalive)
+        client.loop_start()
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+        logger.info(f"MQTT publisher started for {self.host}:{self.port}")
+
+    def stop(self, timeout=5):
+        """Publish what is pending, mark offline and disconnect"""
+        self._stop_event.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(timeout=timeout)
+            self._thread = None
+
+        if self.client:
+            if self.connected:
+                self.client.publish(self.availability_topic, 'offline', qos=1, retain=True)
+            self.client.disconnect()
+            self.client.loop_stop()
+            self.client = None
+        logger.info("MQTT publisher stopped")
+
+    def submit(self, reading):
+        """
+        Queue a reading for publication, never blocks on the network
+
+        Args:
+            reading: Reading
+        """
+        with self._lock:
+            for name, value in reading.values:
+                key = (reading.device_id, name)
+                if key in self._pending:
+                    self.stats['coalesced'] += 1
+                self._pending[key] = (value, reading)
+        self._wakeup.set()
+
+    def _on_connect(self, client, userdata, flags, rc):
+        """Announce availability and replay what was buffered"""
+        if rc != 0:
+            logger.error(f"MQTT connection refused (rc={rc})")
+            return
+
+        logger.info(f"Connected to MQTT broker {self.host}:{self.port}")
+        self.connected = True
+        client.publish(self.availability_topic, 'online', qos=1, retain=True)
+        # Home Assistant asks for discovery again when it restarts
+        client.subscribe(f'{self.discovery_prefix}/status')
+        self._wakeup.set()
+
+    def _on_disconnect(self, client, userdata, rc):
+        """Switch to buffering until paho reconnects"""
+        self.connected = False
+        if rc != 0:
+            logger.warning(f"Lost connection to MQTT broker (rc={rc}), buffering")
+
+    def _on_message(self, client, userdata, message):
+        """Re-announce every entity when Home Assistant comes online"""
+        if message.topic == f'{self.discovery_prefix}/status' and message.payload == b'online':
+            self._reannounce = True
+
+    def _loop(self):
+        """Flush coalesced readings every coalesce window"""
+        while not self._stop_event.is_set():
+            self._wakeup.wait()
+            self._wakeup.clear()
+            # Let a burst of telegrams accumulate before publishing
+            self._stop_event.wait(self.coalesce)
+            try:
+                self.flush()
+            except Exception as e:
+                self.stats['errors'] += 1
+                logger.error(f"MQTT publish failed: {e}")
+
+        try:
+            self.flush()
+        except Exception as e:
+            logger.error(f"MQTT publish failed: {e}")
+
+    def flush(self):
+        """Publish pending readings, buffering them if disconnected"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+
+        if self._reannounce:
+            self._reannounce = False
+            self._announced.clear()
+            self._published.clear()
+
+        messages = []
+        now = time.monotonic()
+        for (device_id, name), (value, reading) in pending.items():
+            key = (device_id, name)
+            if key not in self._announced:
+                messages.append(self._discovery_message(reading, name))
+                self._announced.add(key)
+
+            last = self._published.get(key)
+            if last and last[0] == value and now - last[1] < self.min_interval:
+                self.stats['skipped_unchanged'] += 1
+                continue
+            self._published[key] = (value, now)
+            messages.append((self._state_topic(device_id, name), str(value), True))
+
+        if self.connected and self.buffer.count:
+            replay = self.buffer.drain()
+            self.stats['replayed'] += len(replay)
+            messages = replay + messages
+
+        if messages:
+            self._send(messages)
+
+    def _send(self, messages):
+        """Publish messages, the ones that cannot be sent go to the disk buffer"""
+        failed = []
+        for index, (topic, payload, retain) in enumerate(messages):
+            if not self.connected:
+                failed = messages[index:]
+                break
+            info = self.client.publish(topic, payload, qos=self.qos, retain=retain)
+            if info.rc != 0:
+                failed = messages[index:]
+                break
+            self.stats['published'] += 1
+
+        if failed:
+            self.buffer.append(failed)
+            self.stats['buffered'] += len(failed)
+
+    def _node_id(self, device_id):
+        """Stable identifier of a device in topics"""
+        return 'vmi_' + device_id.lower().replace('0x', '').replace(':', '')
+
+    def _state_topic(self, device_id, name):
+        return f'{self.base_topic}/{self._node_id(device_id)}/{name}'
+
+    def _discovery_message(self, reading, name):
+        """Retained Home Assistant discovery config of one metric"""
+        node_id = self._node_id(reading.device_id)
+        unit = reading.units.get(name)
+        config = {
+            'name': name.replace('_', ' ').capitalize(),
+            'unique_id': f'{node_id}_{name}',
+            'state_topic': self._state_topic(reading.device_id, name),
+            'availability_topic': self.availability_topic,
+            'state_class': 'measurement',
+            'device': {
+                'identifiers': [node_id],
+                'name': reading.device_name or reading.device_id,
+                'model': reading.device_type,
+                'manufacturer': 'Ventilairsec'
+            }
+        }
+        if unit:
+            config['unit_of_measurement'] = unit
+        for prefix, device_class in DEVICE_CLASSES.items():
+            if name.startswith(prefix):
+                config['device_class'] = device_class
+                break
+
+        topic = f'{self.discovery_prefix}/sensor/{node_id}/{name}/config'
+        return topic, json.dumps(config), True
+
+    def get_stats(self):
+        """Get publisher statistics"""
+        return {
+            'connected': self.connected,
+            'pending': len(self._pending),
+            'disk_buffered': self.buffer.count,
+            'disk_discarded': self.buffer.discarded,
+            **self.stats
+        }
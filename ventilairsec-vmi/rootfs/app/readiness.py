@@ -0,0 +1,125 @@
+"""
+Readiness - Startup state of the application components
+
+Components start concurrently, each in its own thread, and signal an event
+when ready instead of the startup sequence sleeping for them. Requests that
+need a component wait on its event; /api/health reports the state of every
+component.
+"""
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+STATES = ('starting', 'ready', 'failed', 'disabled')
+
+
+class Readiness:
+    """Startup state and ready events of named components"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self._components = {}
+        self._lock = threading.Lock()
+
+    def _component(self, name):
+        with self._lock:
+            component = self._components.get(name)
+            if component is None:
+                component = self._components[name] = {
+                    'state': 'starting',
+                    'event': threading.Event(),
+                    'began': time.monotonic(),
+                    'seconds': None,
+                    'error': None
+                }
+            return component
+
+    def begin(self, name):
+        """Register a component as starting"""
+        self._component(name)
+
+    def set_ready(self, name):
+        """Mark a component ready and wake its waiters"""
+        self._finish(name, 'ready')
+
+    def set_failed(self, name, error):
+        """Mark a component failed, its waiters are woken and see it is not ready"""
+        self._finish(name, 'failed', str(error))
+
+    def set_disabled(self, name):
+        """Record a component that is not configured"""
+        self._finish(name, 'disabled')
+
+    def _finish(self, name, state, error=None):
+        component = self._component(name)
+        component['state'] = state
+        component['error'] = error
+        component['seconds'] = round(time.monotonic() - component['began'], 3)
+        component['event'].set()
+        if state == 'ready':
+            logger.info(f"{name} ready after {component['seconds']}s")
+        elif state == 'failed':
+            logger.error(f"{name} failed to start: {error}")
+
+    def run(self, name, start):
+        """
+        Start a component in a background thread
+
+        Args:
+            name: Component name
+            start: Callable starting it, ready when it returns, failed if it raises
+
+        Returns:
+            The thread
+        """
+        self.begin(name)
+
+        def target():
+            try:
+                start()
+            except Exception as e:
+                self.set_failed(name, e)
+            else:
+                self.set_ready(name)
+
+        thread = threading.Thread(target=target, name=f'start-{name}', daemon=True)
+        thread.start()
+        return thread
+
+    def wait(self, name, timeout=None):
+        """
+        Wait until a component has started or failed
+
+        Returns:
+            True if it is ready, False if it failed, is disabled or the timeout expired
+        """
+        component = self._component(name)
+        component['event'].wait(timeout)
+        return component['state'] == 'ready'
+
+    def state(self, name):
+        """State of a component, None if it was never registered"""
+        component = self._components.get(name)
+        return component['state'] if component else None
+
+    def snapshot(self):
+        """
+        State of every component
+
+        Returns:
+            Dictionary with 'ready' (no component starting or failed),
+            'uptime' and 'components' {name: {state, seconds, error}}
+        """
+        with self._lock:
+            components = {
+                name: {key: component[key] for key in ('state', 'seconds', 'error')}
+                for name, component in self._components.items()
+            }
+        return {
+            'ready': all(component['state'] in ('ready', 'disabled') for component in components.values()),
+            'uptime': round(time.monotonic() - self.started, 3),
+            'components': components
+        }
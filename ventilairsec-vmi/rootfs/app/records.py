@@ -0,0 +1,197 @@
+"""
+Records - Lightweight telegram and reading types for the receive path
+
+Both types use __slots__ and keep the values as received; hex strings and
+ISO timestamps are only built when someone asks for them.
+"""
+
+from datetime import datetime
+
+
+def format_device_id(value):
+    """
+    Format an EnOcean address the way device IDs appear in the configuration
+
+    Args:
+        value: Address as int, bytes/list of 4 bytes, or string with or
+            without 0x prefix and colons
+
+    Returns:
+        String such as '0x0421574F'
+    """
+    if isinstance(value, int):
+        number = value
+    elif isinstance(value, str):
+        number = int(value.replace(':', ''), 16)
+    else:
+        number = int.from_bytes(bytes(value), 'big')
+    return f'0x{number:08X}'
+
+
+class RawTelegram:
+    """One received radio telegram"""
+
+    __slots__ = ('sender', 'rorg', 'data', 'status', 'repeater_level', 'timestamp',
+                 'dbm', 'gateway', '_sender_id')
+
+    def __init__(self, sender, rorg, data, status=0, repeater_level=0, timestamp=0.0, dbm=None,
+                 gateway=None):
+        """
+        Initialize telegram
+
+        Args:
+            sender: Sender address as int
+            rorg: Radio organization byte
+            data: Packet data (RORG byte first), bytes or list of ints
+            status: Status byte
+            repeater_level: Number of repeater hops
+            timestamp: Reception time, epoch seconds
+            dbm: Received signal strength, if known
+            gateway: Name of the gateway that received it
+        """
+        self.sender = sender
+        self.rorg = rorg
+        self.data = data
+        self.status = status
+        self.repeater_level = repeater_level
+        self.timestamp = timestamp
+        self.dbm = dbm
+        self.gateway = gateway
+        self._sender_id = None
+
+    @classmethod
+    def from_dict(cls, packet):
+        """Build a telegram from the dictionary format used before these records"""
+        sender = packet.get('sender_id_int')
+        if sender is None:
+            sender = int(str(packet.get('sender_id', '0')).replace(':', ''), 16)
+        return cls(
+            sender,
+            packet.get('rorg'),
+            packet.get('data', []),
+            status=packet.get('status', 0),
+            repeater_level=packet.get('repeater_level', 0),
+            timestamp=packet.get('timestamp', 0.0),
+            dbm=packet.get('dbm'),
+            gateway=packet.get('gateway')
+        )
+
+    @property
+    def sender_id(self):
+        """Sender address formatted like configured device IDs"""
+        if self._sender_id is None:
+            self._sender_id = f'0x{self.sender:08X}'
+        return self._sender_id
+
+    @property
+    def data_hex(self):
+        """Packet data as a hex string"""
+        return bytes(self.data).hex()
+
+    def to_dict(self):
+        """Dictionary view, for logging and debugging"""
+        return {
+            'sender_id': self.sender_id,
+            'sender_id_int': self.sender,
+            'rorg': self.rorg,
+            'data': self.data_hex,
+            'status': self.status,
+            'repeater_level': self.repeater_level,
+            'dbm': self.dbm,
+            'gateway': self.gateway,
+            'timestamp': self.timestamp
+        }
+
+    def __repr__(self):
+        return f'RawTelegram({self.sender_id}, rorg=0x{self.rorg or 0:02X}, data={self.data_hex})'
+
+
+class Reading:
+    """Decoded metrics of one telegram"""
+
+    __slots__ = ('device_id', 'device_type', 'device_name', 'timestamp', 'values',
+                 'units', 'raw')
+
+    # Keys of the dictionary view that are not metrics
+    NON_METRIC_KEYS = ('device_id', 'device_type', 'device_name', 'timestamp', 'raw_data', 'units')
+
+    def __init__(self, device_id, device_type, device_name, timestamp, values, units=None, raw=None):
+        """
+        Initialize reading
+
+        Args:
+            device_id: Device identifier
+            device_type: EEP key of the device
+            device_name: Device name
+            timestamp: Epoch seconds
+            values: Sequence of (metric_name, value) pairs
+            units: Dictionary of metric name to unit, shared per profile
+            raw: Packet data the values were decoded from
+        """
+        self.device_id = device_id
+        self.device_type = device_type
+        self.device_name = device_name
+        self.timestamp = timestamp
+        self.values = values
+        self.units = units or {}
+        self.raw = raw
+
+    @classmethod
+    def from_dict(cls, parsed_data):
+        """Build a reading from the parsed dictionary format used before these records"""
+        timestamp = parsed_data.get('timestamp')
+        if isinstance(timestamp, str):
+            timestamp = datetime.fromisoformat(timestamp).timestamp()
+        elif isinstance(timestamp, datetime):
+            timestamp = timestamp.timestamp()
+
+        raw = parsed_data.get('raw_data')
+        return cls(
+            parsed_data.get('device_id'),
+            parsed_data.get('device_type'),
+            parsed_data.get('device_name'),
+            timestamp,
+            [
+                (key, value) for key, value in parsed_data.items()
+                if key not in cls.NON_METRIC_KEYS and isinstance(value, (int, float))
+            ],
+            units=parsed_data.get('units'),
+            raw=bytes.fromhex(raw) if raw else None
+        )
+
+    @property
+    def iso_timestamp(self):
+        """Timestamp as a local ISO string"""
+        if self.timestamp is None:
+            return None
+        return datetime.fromtimestamp(self.timestamp).isoformat()
+
+    @property
+    def raw_bytes(self):
+        """Packet data as bytes, None if unknown"""
+        if self.raw is None:
+            return None
+        return bytes(self.raw)
+
+    @property
+    def raw_hex(self):
+        """Packet data as a hex string"""
+        if self.raw is None:
+            return ''
+        return bytes(self.raw).hex()
+
+    def to_dict(self):
+        """Dictionary view in the format DataParser.parse used to return"""
+        parsed = {
+            'device_id': self.device_id,
+            'device_type': self.device_type,
+            'device_name': self.device_name,
+            'timestamp': self.iso_timestamp,
+            'raw_data': self.raw_hex,
+            'units': self.units
+        }
+        parsed.update(self.values)
+        return parsed
+
+    def __repr__(self):
+        return f'Reading({self.device_id}, {self.iso_timestamp}, {dict(self.values)})'
@@ -0,0 +1,228 @@
+"""
+Re-decode - Rebuild metrics from the stored raw telegrams after a parser fix
+
+Usage:
+    python3 redecode.py --config /config/ventilairsec/config.json \\
+        --db /config/ventilairsec/db [--device 0x81003227] [--since 2024-01-01]
+
+Payloads are streamed out of the telegrams table in chunks and every chunk is
+decoded at once with NumPy array arithmetic from the same field specs the
+live parser uses (eep_profiles). Without NumPy the compiled per-telegram
+decoder is used instead, which gives the same values more slowly.
+"""
+
+import argparse
+import json
+import logging
+import sys
+import time
+from datetime import datetime
+
+from database import Database
+from data_parser import DataParser
+from eep_profiles import PROFILES
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+
+def vectorize(profile):
+    """
+    Build a batch decoder for a profile
+
+    Args:
+        profile: eep_profiles.Profile
+
+    Returns:
+        Callable taking a list of payloads and returning a list of
+        (index, metric_name, value) for every decoded value
+    """
+    fields = profile.fields
+    teach_in = profile.teach_in
+
+    def decode_batch(payloads):
+        count = len(payloads)
+        lengths = np.fromiter((len(p) for p in payloads), dtype=np.int64, count=count)
+        width = int(lengths.max()) if count else 0
+
+        # One row per telegram, zero padded to the longest payload
+        matrix = np.zeros((count, width), dtype=np.uint8)
+        for row, payload in enumerate(payloads):
+            matrix[row, :len(payload)] = np.frombuffer(payload, dtype=np.uint8)
+
+        keep = np.ones(count, dtype=bool)
+        if teach_in and teach_in[0] < width:
+            offset, flag = teach_in
+            keep &= ~((lengths > offset) & ((matrix[:, offset] & flag) == 0))
+
+        results = []
+        for field in fields:
+            end = field.offset + field.length
+            if end > width:
+                continue
+
+            valid = keep & (lengths >= end)
+            if field.requires:
+                offset, flag = field.requires
+                if offset >= width:
+                    continue
+                valid &= (lengths > offset) & ((matrix[:, offset] & flag) != 0)
+
+            raw = np.zeros(count, dtype=np.int64)
+            for position in range(field.offset, end):
+                raw = (raw << 8) | matrix[:, position]
+            values = ((raw >> field.shift) & ((1 << field.width) - 1)) * field.scale + field.add
+
+            if field.digits == 0:
+                values = np.rint(values)
+            elif field.digits is not None:
+                values = np.round(values, field.digits)
+
+            indexes = np.flatnonzero(valid)
+            results.extend(
+                (index, field.name, value)
+                for index, value in zip(indexes.tolist(), values[indexes].tolist())
+            )
+
+        return results
+
+    return decode_batch
+
+
+def scalar(profile):
+    """Batch decoder built on the live per-telegram decoder, used without NumPy"""
+    decode = profile.compile()
+
+    def decode_batch(payloads):
+        results = []
+        for index, payload in enumerate(payloads):
+            values = decode(payload)
+            if values:
+                results.extend((index, name, value) for name, value in values)
+        return results
+
+    return decode_batch
+
+
+def redecode_device(db, device_id, device_type, start=None, chunk_size=5000, dry_run=False):
+    """
+    Re-decode every stored telegram of one device
+
+    Args:
+        db: Initialized Database
+        device_id: Device identifier
+        device_type: EEP key of the device
+        start: Only telegrams at or after this epoch second
+        chunk_size: Telegrams per chunk and per write transaction
+        dry_run: Decode without writing
+
+    Returns:
+        Tuple (telegrams decoded, values written)
+    """
+    profile = PROFILES.get(device_type)
+    if profile is None or not profile.fields:
+        logger.info(f"Skipping {device_id}: no decodable profile for type {device_type}")
+        return 0, 0
+
+    decode_batch = vectorize(profile) if np is not None else scalar(profile)
+    telegrams = 0
+    written = 0
+    first = None
+    last = None
+
+    for chunk in db.iter_telegrams(device_id, start=start, chunk_size=chunk_size):
+        if not chunk:
+            continue
+
+        timestamps = [timestamp for timestamp, _ in chunk]
+        payloads = [bytes(payload) for _, payload in chunk]
+        rows = [
+            (timestamps[index], name, value)
+            for index, name, value in decode_batch(payloads)
+        ]
+
+        telegrams += len(chunk)
+        first = min(timestamps) if first is None else min(first, min(timestamps))
+        last = max(timestamps) if last is None else max(last, max(timestamps))
+
+        if not dry_run and rows:
+            written += db.replace_metric_values(device_id, rows, profile.units)
+        else:
+            written += len(rows)
+
+    if not dry_run and telegrams:
+        db.rebuild_aggregates(device_id, first, last)
+
+    return telegrams, written
+
+
+def main():
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description='Re-decode stored EnOcean telegrams')
+    parser.add_argument('--config', required=True, help='Path to config.json')
+    parser.add_argument('--db', required=True, help='Path to database directory')
+    parser.add_argument('--device', action='append', help='Device ID to re-decode (repeatable, default all)')
+    parser.add_argument('--since', help='Only telegrams at or after this ISO date')
+    parser.add_argument('--chunk-size', type=int, default=5000, help='Telegrams per batch')
+    parser.add_argument('--dry-run', action='store_true', help='Decode without writing')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+
+    with open(args.config, 'r') as f:
+        config = json.load(f)
+
+    # Readings stored through the filter only hold the changes, rewriting
+    # them with every decoded value would undo the filter
+    if config.get('change_filter', {}).get('enabled') and not args.dry_run:
+        logger.error("The change filter is enabled, disable it to re-decode history (or use --dry-run)")
+        return 1
+
+    db = Database(args.db, config.get('database', {}))
+    db.initialize()
+
+    # Configured types win over what was stored with the readings
+    device_types = db.get_device_types()
+    device_types.update(DataParser(config).devices)
+    devices = args.device or sorted(device_types)
+    start = int(datetime.fromisoformat(args.since).timestamp()) if args.since else None
+
+    if np is None:
+        logger.warning("NumPy is not installed, decoding one telegram at a time")
+
+    started = time.monotonic()
+    total_telegrams = 0
+    total_values = 0
+
+    try:
+        for device_id in devices:
+            device_type = device_types.get(device_id)
+            telegrams, values = redecode_device(
+                db, device_id, device_type, start=start,
+                chunk_size=args.chunk_size, dry_run=args.dry_run
+            )
+            total_telegrams += telegrams
+            total_values += values
+            if telegrams:
+                logger.info(f"{device_id} ({device_type}): {telegrams} telegrams, {values} values")
+    finally:
+        db.close()
+
+    elapsed = time.monotonic() - started
+    rate = total_telegrams / elapsed if elapsed > 0 else 0
+    logger.info(
+        f"Re-decoded {total_telegrams} telegrams into {total_values} values "
+        f"in {elapsed:.1f}s ({rate:.0f} telegrams/s){' (dry run)' if args.dry_run else ''}"
+    )
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
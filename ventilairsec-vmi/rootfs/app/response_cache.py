@@ -0,0 +1,270 @@
+"""
+Response Cache - Serialized API responses reused until new data is ingested
+
+Every written batch bumps a per-device ingest sequence number, and writes
+changing past results of every device (retention, archiving, redecode) bump
+a generation shared by all. A cached response remembers the sequence
+numbers it was built from and is reused as long as they have not moved, so
+a poll without new telegrams costs a dictionary lookup and, with
+If-None-Match, an empty 304.
+"""
+
+import gzip
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+
+class IngestSequence:
+    """Monotonic per-device counters of written batches"""
+
+    def __init__(self):
+        self._sequences = {}
+        self._updated = {}
+        self._lock = threading.Lock()
+        self.total = 0
+        # Moved by invalidate(), part of the sequence of every device
+        self.generation = 0
+        self._invalidated = None
+
+    def bump(self, device_ids):
+        """Record that readings of these devices were committed"""
+        now = time.time()
+        with self._lock:
+            self.total += 1
+            for device_id in set(device_ids):
+                self._sequences[device_id] = self._sequences.get(device_id, 0) + 1
+                self._updated[device_id] = now
+
+    def invalidate(self):
+        """Record a write that changed the data of every device, such as a purge"""
+        now = time.time()
+        with self._lock:
+            self.generation += 1
+            self.total += 1
+            self._invalidated = now
+
+    def get(self, device_id=None):
+        """
+        Current sequence and time of the last write
+
+        Args:
+            device_id: Device, None for all devices
+
+        Returns:
+            Tuple (sequence, epoch of the last write or None), the sequence
+            being a (generation, counter) pair
+        """
+        with self._lock:
+            if device_id is None:
+                sequence = self.total
+                updated = max(self._updated.values(), default=None)
+            else:
+                sequence = self._sequences.get(device_id, 0)
+                updated = self._updated.get(device_id)
+            if self._invalidated is not None and (updated is None or updated < self._invalidated):
+                updated = self._invalidated
+            return (self.generation, sequence), updated
+
+    def snapshot(self):
+        """Serializable state, to hand to other processes"""
+        with self._lock:
+            return {
+                'total': self.total,
+                'generation': self.generation,
+                'invalidated': self._invalidated,
+                'devices': {
+                    device_id: [sequence, self._updated.get(device_id)]
+                    for device_id, sequence in self._sequences.items()
+                }
+            }
+
+    def update(self, snapshot):
+        """Adopt the state of the process that writes"""
+        with self._lock:
+            self.total = snapshot['total']
+            self.generation = snapshot['generation']
+            self._invalidated = snapshot['invalidated']
+            for device_id, (sequence, updated) in snapshot['devices'].items():
+                self._sequences[device_id] = sequence
+                self._updated[device_id] = updated
+
+
+class CachedResponse:
+    """One serialized response and its compressed variants"""
+
+    __slots__ = ('sequence', 'created', 'body', 'etag', 'last_modified', 'encoded')
+
+    def __init__(self, sequence, body, last_modified):
+        self.sequence = sequence
+        self.created = time.monotonic()
+        self.body = body
+        self.etag = '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+        self.last_modified = last_modified
+        self.encoded = {}
+
+
+class ResponseCache:
+    """LRU of serialized responses with conditional GET and compression"""
+
+    def __init__(self, sequences, max_entries=256, ttl=60, min_compress_size=1024,
+                 gzip_level=6, brotli_quality=5):
+        """
+        Initialize cache
+
+        Args:
+            sequences: IngestSequence the entries are validated against
+            max_entries: Responses kept, least recently used evicted first
+            ttl: Seconds a windowed response (e.g. last 24 h) stays valid
+                without new data, as its window moves with time
+            min_compress_size: Smaller bodies are sent uncompressed
+            gzip_level: gzip compression level
+            brotli_quality: brotli quality, used when the brotli module exists
+        """
+        self.sequences = sequences
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.min_compress_size = min_compress_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    @classmethod
+    def from_config(cls, sequences, config):
+        """Build a cache from the 'cache' configuration section"""
+        options = config.get('cache', {})
+        return cls(
+            sequences,
+            max_entries=options.get('max_entries', 256),
+            ttl=options.get('ttl', 60),
+            min_compress_size=options.get('min_compress_size', 1024)
+        )
+
+    def get(self, key, device_id=None, windowed=True):
+        """
+        Valid cached response of a key
+
+        Args:
+            key: Hashable identifying endpoint and parameters
+            device_id: Device the response depends on, None for all devices
+            windowed: Whether the response also expires after ttl
+
+        Returns:
+            CachedResponse or None
+        """
+        sequence, _ = self.sequences.get(device_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expired = windowed and time.monotonic() - entry.created > self.ttl
+                if entry.sequence == sequence and not expired:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, state, body, windowed=True):
+        """
+        Store a freshly built response
+
+        Args:
+            key: Key given to get()
+            state: sequences.get(device_id), read before querying the
+                database so a batch landing during the query invalidates it
+            body: Serialized response
+            windowed: Whether the response depends on the current time; its
+                Last-Modified is then the time it was built, not of the last
+                write, as the window moves without any write
+
+        Returns:
+            CachedResponse
+        """
+        sequence, updated = state
+        entry = CachedResponse(sequence, body, time.time() if windowed else updated)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def is_not_modified(self, entry, if_none_match, if_modified_since):
+        """Whether the client's copy is current"""
+        if if_none_match:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            matched = '*' in tags or entry.etag in tags or f'W/{entry.etag}' in tags
+        elif if_modified_since and entry.last_modified:
+            try:
+                since = parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+            matched = int(entry.last_modified) <= since
+        else:
+            return False
+
+        if matched:
+            self.not_modified += 1
+        return matched
+
+    def encode(self, entry, accept_encoding):
+        """
+        Body in the best encoding the client accepts
+
+        Returns:
+            Tuple (body bytes, Content-Encoding or None)
+        """
+        if len(entry.body) < self.min_compress_size or not accept_encoding:
+            return entry.body, None
+
+        accepted = {
+            part.split(';')[0].strip().lower() for part in accept_encoding.split(',')
+        }
+        if brotli is not None and 'br' in accepted:
+            encoding = 'br'
+        elif 'gzip' in accepted:
+            encoding = 'gzip'
+        else:
+            return entry.body, None
+
+        body = entry.encoded.get(encoding)
+        if body is None:
+            if encoding == 'br':
+                body = brotli.compress(entry.body, quality=self.brotli_quality)
+            else:
+                body = gzip.compress(entry.body, compresslevel=self.gzip_level)
+            entry.encoded[encoding] = body
+        return body, encoding
+
+    def headers(self, entry):
+        """Validator headers of a response"""
+        headers = {'ETag': entry.etag, 'Vary': 'Accept-Encoding', 'Cache-Control': 'no-cache'}
+        if entry.last_modified:
+            headers['Last-Modified'] = formatdate(entry.last_modified, usegmt=True)
+        return headers
+
+    def get_stats(self):
+        """Get cache statistics"""
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'not_modified': self.not_modified,
+            'brotli': brotli is not None
+        }
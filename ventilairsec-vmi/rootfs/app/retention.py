@@ -0,0 +1,165 @@
+"""
+Retention Service - Background purge of old readings and rollups per tier
+"""
+
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+
+class RetentionService:
+    """Periodically delete data past its tier's retention, in small chunks"""
+
+    # Days to keep per tier, None keeps forever
+    DEFAULT_POLICIES = {
+        'raw': 30,
+        '1m': 90,
+        '15m': 365,
+        '1h': None,
+        '1d': None
+    }
+
+    def __init__(self, db, policies=None, interval_hours=6, initial_delay=60,
+                 chunk_size=2000, chunk_pause_ms=50, vacuum_pages=256, on_changed=None):
+        """
+        Initialize retention service
+
+        Args:
+            db: Database instance
+            policies: Dictionary overriding DEFAULT_POLICIES
+            interval_hours: Hours between two retention passes
+            initial_delay: Seconds to wait after start before the first pass
+            chunk_size: Rows deleted per transaction
+            chunk_pause_ms: Pause between transactions, lets ingestion in
+            vacuum_pages: Pages released per incremental vacuum step
+            on_changed: Callable run after a pass that deleted or archived rows
+        """
+        self.db = db
+        self.policies = {**self.DEFAULT_POLICIES, **(policies or {})}
+        self.interval = interval_hours * 3600
+        self.initial_delay = initial_delay
+        self.chunk_size = max(1, int(chunk_size))
+        self.pause = chunk_pause_ms / 1000.0
+        self.vacuum_pages = vacuum_pages
+        self.on_changed = on_changed
+
+        unknown = set(self.policies) - set(db.RETENTION_TIERS)
+        if unknown:
+            raise ValueError(f"Unknown retention tiers: {', '.join(sorted(unknown))}")
+
+        self.last_report = None
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._run_lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, db, config, on_changed=None):
+        """Build a retention service from the 'retention' configuration section"""
+        options = config.get('retention', {})
+        return cls(
+            db,
+            policies=options.get('policies'),
+            interval_hours=options.get('interval_hours', 6),
+            initial_delay=options.get('initial_delay', 60),
+            chunk_size=options.get('chunk_size', 2000),
+            chunk_pause_ms=options.get('chunk_pause_ms', 50),
+            vacuum_pages=options.get('vacuum_pages', 256),
+            on_changed=on_changed
+        )
+
+    def start(self):
+        """Start the background thread"""
+        if self._thread:
+            return
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+        logger.info(f"Retention service started with policies {self.policies}")
+
+    def stop(self, timeout=5):
+        """Stop the background thread after the current chunk"""
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout=timeout)
+            self._thread = None
+
+    def _loop(self):
+        """Run a retention pass every interval"""
+        if self._stop_event.wait(self.initial_delay):
+            return
+
+        while not self._stop_event.is_set():
+            self.run_once()
+            self._stop_event.wait(self.interval)
+
+    def run_once(self):
+        """
+        Apply every policy once, then release free pages
+
+        Returns:
+            Report dictionary with rows deleted per tier and bytes reclaimed
+        """
+        with self._run_lock:
+            started = time.monotonic()
+            now = datetime.now()
+            report = {
+                'started_at': now.isoformat(),
+                'rows_deleted': {},
+                'rows_archived': 0,
+                'bytes_reclaimed': 0,
+                'errors': []
+            }
+
+            for tier, days in self.policies.items():
+                if days is None or self._stop_event.is_set():
+                    continue
+                try:
+                    cutoff = int((now - timedelta(days=days)).timestamp())
+                    if tier == 'raw' and self.db.archive is not None:
+                        # Readings go to the archive, telegrams are still purged
+                        report['rows_archived'] = self.db.archive_readings(
+                            cutoff, chunk_size=self.chunk_size, pause=self.pause
+                        )
+                    report['rows_deleted'][tier] = self.db.purge(
+                        tier, cutoff, chunk_size=self.chunk_size, pause=self.pause
+                    )
+                except Exception as e:
+                    logger.error(f"Retention of tier {tier} failed: {e}")
+                    report['errors'].append(f"{tier}: {e}")
+
+            if self.on_changed and (report['rows_archived'] or any(report['rows_deleted'].values())):
+                try:
+                    self.on_changed()
+                except Exception as e:
+                    logger.error(f"Retention change callback failed: {e}")
+
+            try:
+                report['bytes_reclaimed'] = self.db.incremental_vacuum(
+                    pages_per_step=self.vacuum_pages, pause=self.pause
+                )
+                storage = self.db.get_storage_stats()
+                report['size_bytes'] = storage['size_bytes']
+                if not storage['incremental_vacuum'] and storage['free_bytes']:
+                    logger.info(
+                        f"{storage['free_bytes']} bytes free inside the database will be "
+                        "reused but not returned to the filesystem: auto_vacuum is not "
+                        "incremental on this file (run VACUUM once to convert it)"
+                    )
+            except Exception as e:
+                logger.error(f"Incremental vacuum failed: {e}")
+                report['errors'].append(f"vacuum: {e}")
+
+            report['duration'] = round(time.monotonic() - started, 3)
+            self.last_report = report
+
+            logger.info(
+                f"Retention pass done in {report['duration']}s: deleted "
+                f"{sum(report['rows_deleted'].values())} rows "
+                f"{report['rows_deleted']}, archived {report['rows_archived']} readings, "
+                f"reclaimed {report['bytes_reclaimed']} bytes"
+            )
+            return report
@@ -0,0 +1,310 @@
+"""
+Rollups - Downsampled min/max/avg/count/last buckets for history queries
+
+Every bucket also holds a quantile sketch of its values (sketches.py), so
+percentiles of any window are merged from buckets like the other aggregates.
+"""
+
+import logging
+
+from sketches import QuantileSketch
+
+logger = logging.getLogger(__name__)
+
+# Bucket width in seconds, finest first
+RESOLUTIONS = {
+    '1m': 60,
+    '15m': 15 * 60,
+    '1h': 60 * 60,
+    '1d': 24 * 60 * 60
+}
+
+# Name of the resolution that reads the readings table directly
+RAW = 'raw'
+
+# Windows up to this many hours are served from raw readings when
+# the caller lets us choose
+RAW_MAX_HOURS = 6
+
+# Automatic choice keeps a series under this many points
+MAX_POINTS = 1500
+
+# Merge a batch of buckets into the stored ones
+UPSERT_SQL = '''
+    INSERT INTO rollups
+    (resolution, device_id, metric_id, bucket, count, sum, min, max, last, last_timestamp, sketch)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (resolution, device_id, metric_id, bucket) DO UPDATE SET
+        count = count + excluded.count,
+        sum = sum + excluded.sum,
+        min = MIN(min, excluded.min),
+        max = MAX(max, excluded.max),
+        last = CASE WHEN excluded.last_timestamp >= last_timestamp
+                    THEN excluded.last ELSE last END,
+        last_timestamp = MAX(last_timestamp, excluded.last_timestamp),
+        sketch = sketch_merge(sketch, excluded.sketch)
+'''
+
+
+def create_table(cursor):
+    """Create the rollups table"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS rollups (
+            resolution INTEGER NOT NULL,
+            device_id INTEGER NOT NULL,
+            metric_id INTEGER NOT NULL,
+            bucket INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            sum REAL NOT NULL,
+            min REAL,
+            max REAL,
+            last REAL,
+            last_timestamp INTEGER,
+            sketch BLOB,
+            PRIMARY KEY (resolution, device_id, metric_id, bucket)
+        ) WITHOUT ROWID
+    ''')
+
+
+def choose_resolution(hours, requested=None):
+    """
+    Pick the resolution for a history window
+
+    Args:
+        hours: Length of the requested window
+        requested: Explicit resolution name, None or 'auto' to choose
+
+    Returns:
+        'raw' or a key of RESOLUTIONS
+
+    Raises:
+        ValueError: If the requested resolution is unknown
+    """
+    if requested and requested != 'auto':
+        if requested != RAW and requested not in RESOLUTIONS:
+            raise ValueError(
+                f"Unknown resolution '{requested}', expected auto, {RAW} or "
+                + ', '.join(RESOLUTIONS)
+            )
+        return requested
+
+    if hours <= RAW_MAX_HOURS:
+        return RAW
+
+    window = hours * 3600
+    for name, seconds in RESOLUTIONS.items():
+        if window / seconds <= MAX_POINTS:
+            return name
+    return name
+
+
+def aggregate(rows):
+    """
+    Fold reading rows into buckets of every resolution
+
+    Args:
+        rows: Iterable of (device_id, timestamp, metric_id, value)
+
+    Returns:
+        List of parameter tuples for UPSERT_SQL
+    """
+    buckets = {}
+    sketches = {}
+    for device_id, timestamp, metric_id, value in rows:
+        if value is None:
+            continue
+        for seconds in RESOLUTIONS.values():
+            key = (seconds, device_id, metric_id, timestamp - timestamp % seconds)
+            bucket = buckets.get(key)
+            if bucket is None:
+                buckets[key] = [1, value, value, value, value, timestamp]
+                sketches[key] = QuantileSketch()
+            else:
+                bucket[0] += 1
+                bucket[1] += value
+                if value < bucket[2]:
+                    bucket[2] = value
+                if value > bucket[3]:
+                    bucket[3] = value
+                if timestamp >= bucket[5]:
+                    bucket[4] = value
+                    bucket[5] = timestamp
+            sketches[key].add(value)
+
+    return [
+        key + tuple(bucket) + (sketches[key].to_bytes(),)
+        for key, bucket in buckets.items()
+    ]
+
+
+def backfill(connection):
+    """Build every resolution from the readings table, for databases created before rollups"""
+    rebuild(connection)
+
+
+def rebuild(connection, device_id=None, start=None, end=None):
+    """
+    Recompute buckets from the readings table
+
+    Args:
+        connection: Writer connection
+        device_id: Only rebuild this device key, all devices if None
+        start: First epoch second whose buckets are rebuilt, None for all
+        end: Last epoch second whose buckets are rebuilt, None for all
+    """
+    with connection:
+        for name, seconds in RESOLUTIONS.items():
+            conditions = ['value IS NOT NULL']
+            params = {'resolution': seconds}
+
+            if device_id is not None:
+                conditions.append('device_id = :device_id')
+                params['device_id'] = device_id
+            if start is not None:
+                conditions.append('timestamp >= :start')
+                params['start'] = start - start % seconds
+            if end is not None:
+                conditions.append('timestamp < :end')
+                params['end'] = end - end % seconds + seconds
+
+            bucket_conditions = [
+                condition.replace('timestamp', 'bucket')
+                for condition in conditions[1:]
+            ]
+            if bucket_conditions:
+                connection.execute(
+                    'DELETE FROM rollups WHERE resolution = :resolution AND '
+                    + ' AND '.join(bucket_conditions),
+                    params
+                )
+
+            connection.execute(f'''
+                INSERT OR REPLACE INTO rollups
+                (resolution, device_id, metric_id, bucket, count, sum, min, max, last, last_timestamp, sketch)
+                SELECT :resolution, g.device_id, g.metric_id, g.bucket, g.count, g.sum,
+                       g.min, g.max, r.value, g.last_timestamp, g.sketch
+                FROM (
+                    SELECT device_id, metric_id, timestamp - timestamp % :resolution AS bucket,
+                           COUNT(*) AS count, SUM(value) AS sum, MIN(value) AS min,
+                           MAX(value) AS max, MAX(timestamp) AS last_timestamp,
+                           sketch_build(value) AS sketch
+                    FROM readings
+                    WHERE {' AND '.join(conditions)}
+                    GROUP BY device_id, metric_id, bucket
+                ) g
+                JOIN readings r
+                  ON r.device_id = g.device_id
+                 AND r.timestamp = g.last_timestamp
+                 AND r.metric_id = g.metric_id
+            ''', params)
+            logger.info(f"Built {name} rollups from readings")
+
+
+def cover(start, end):
+    """
+    Split a window into whole buckets, coarsest first
+
+    Args:
+        start: First epoch second, a multiple of the finest resolution
+        end: Epoch second to stop before, a multiple of the finest resolution
+
+    Returns:
+        List of (resolution seconds, first bucket, bucket to stop before)
+        covering [start, end) exactly once
+    """
+    ranges = []
+
+    def split(start, end, widths):
+        if start >= end or not widths:
+            return
+        seconds = widths[0]
+        first = -(-start // seconds) * seconds
+        last = end - end % seconds
+        if first < last:
+            ranges.append((seconds, first, last))
+            split(start, first, widths[1:])
+            split(last, end, widths[1:])
+        else:
+            split(start, end, widths[1:])
+
+    split(start, end, sorted(RESOLUTIONS.values(), reverse=True))
+    return ranges
+
+
+def horizons(connection, device_id, metric_id):
+    """
+    First bucket kept at each resolution retention has already purged
+
+    Finer resolutions are kept for less time: one whose oldest bucket is
+    newer than the oldest bucket of another resolution lost the buckets
+    before it, one without buckets lost them all.
+
+    Args:
+        connection: Reader connection
+        device_id: Device key
+        metric_id: Metric key
+
+    Returns:
+        Dictionary of resolution seconds to first kept bucket (infinity if
+        none is left), for the purged resolutions only
+    """
+    seconds = list(RESOLUTIONS.values())
+    query = ' UNION ALL '.join(
+        'SELECT ?, MIN(bucket) FROM rollups WHERE resolution = ? AND device_id = ? AND metric_id = ?'
+        for _ in seconds
+    )
+    params = [value for width in seconds for value in (width, width, device_id, metric_id)]
+    oldest = {row[0]: row[1] for row in connection.execute(query, params) if row[1] is not None}
+    if not oldest:
+        return {}
+    first = min(oldest.values())
+    return {
+        width: oldest.get(width, float('inf'))
+        for width in seconds if oldest.get(width, float('inf')) > first
+    }
+
+
+def widen(start, end, kept):
+    """
+    Round the edges of a window out to buckets that still exist
+
+    The edges of a window are covered by the finest buckets. Where retention
+    purged them, the edge moves out to the boundary of the finest
+    resolution kept there, so the window is answered for the range the
+    remaining buckets cover instead of silently missing its edges.
+
+    Args:
+        start: First epoch second, a multiple of the finest resolution
+        end: Epoch second to stop before, a multiple of the finest resolution
+        kept: First kept bucket of purged resolutions, see horizons()
+
+    Returns:
+        Tuple (start, end) of the window cover() can answer exactly
+    """
+    widths = sorted(RESOLUTIONS.values())
+    coarsest = widths[-1]
+
+    def finest(epoch):
+        # Edge buckets all lie within the coarsest bucket around the edge
+        bound = epoch - epoch % coarsest
+        for seconds in widths:
+            if kept.get(seconds, bound) <= bound:
+                return seconds
+        return coarsest
+
+    seconds = finest(start)
+    start -= start % seconds
+    seconds = finest(end)
+    end = -(-end // seconds) * seconds
+    return start, end
+
+
+def row_to_point(row):
+    """Format a rollups row for the API"""
+    return {
+        'value': row['sum'] / row['count'] if row['count'] else None,
+        'min': row['min'],
+        'max': row['max'],
+        'last': row['last'],
+        'count': row['count']
+    }
@@ -0,0 +1,270 @@
+"""
+Server - Serving modes for the web application
+
+'werkzeug' is Flask's development server, 'waitress' a multi-threaded
+production server in the same process, 'gunicorn' forks HTTP worker
+processes. In every mode the EnOcean pipeline (handler, ingest, retention,
+MQTT) runs once, in the process that called run_server; with gunicorn that
+is the master, and each worker gets readings and pipeline status through an
+EventRelay pipe. Workers send back what only the pipeline can act on, such as
+outbound commands, through a single upstream pipe they share.
+"""
+
+import json
+import logging
+import os
+import select
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+MODES = ('werkzeug', 'waitress', 'gunicorn')
+
+# Bytes a worker pipe may hold back before new messages for it are dropped
+MAX_BACKLOG = 1024 * 1024
+
+
+class EventRelay:
+    """Pipes from the pipeline process to every HTTP worker, and one back"""
+
+    def __init__(self):
+        self._pipes = {}
+        # Unwritten tail of a partial write per worker, so lines are never cut
+        self._backlog = {}
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+        # Shared by every worker; writes up to PIPE_BUF bytes never interleave
+        self._upstream = os.pipe()
+        os.set_blocking(self._upstream[1], False)
+
+    def open(self, key):
+        """Create the pipe of a worker about to be forked, returns its read end"""
+        read_fd, write_fd = os.pipe()
+        os.set_blocking(write_fd, False)
+        with self._lock:
+            self._pipes[key] = (read_fd, write_fd)
+            self._backlog[key] = bytearray()
+        return read_fd
+
+    def close(self, key):
+        """Forget a worker that exited"""
+        with self._lock:
+            fds = self._pipes.pop(key, None)
+            self._backlog.pop(key, None)
+        if fds:
+            for fd in fds:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+
+    def detach(self, key):
+        """In a forked worker: keep the own read end and the upstream write end, close every other descriptor"""
+        own_fd = self._pipes[key][0]
+        for read_fd, write_fd in self._pipes.values():
+            os.close(write_fd)
+            if read_fd != own_fd:
+                os.close(read_fd)
+        self._pipes = {}
+        self._backlog = {}
+        os.close(self._upstream[0])
+        return own_fd
+
+    def publish(self, kind, payload):
+        """
+        Send a message to every worker, never blocks
+
+        Messages are often larger than PIPE_BUF, so a write to a nearly full
+        pipe can be partial: the rest is kept and written before the next
+        message, the worker always reads whole lines. A worker that falls
+        MAX_BACKLOG bytes behind misses new messages, like a slow stream
+        client misses events.
+        """
+        line = (json.dumps({'type': kind, 'data': payload}) + '\n').encode()
+        with self._lock:
+            for key, (_, write_fd) in self._pipes.items():
+                backlog = self._backlog[key]
+                if len(backlog) + len(line) > MAX_BACKLOG:
+                    self.dropped += 1
+                else:
+                    backlog += line
+                self._flush(write_fd, backlog)
+
+    def _flush(self, write_fd, backlog):
+        """Write as much of a backlog as the pipe takes, called with the lock held"""
+        try:
+            while backlog:
+                written = os.write(write_fd, backlog)
+                del backlog[:written]
+        except BlockingIOError:
+            pass
+        except BrokenPipeError:
+            # The worker exited, child_exit closes the pipe
+            self.dropped += 1
+            backlog.clear()
+
+    def send_upstream(self, kind, payload):
+        """
+        In a worker: send a message to the pipeline process, never blocks
+
+        Returns:
+            True if sent, False if the pipe is full
+
+        Raises:
+            ValueError: If the message is too large to be written at once
+        """
+        line = (json.dumps({'type': kind, 'data': payload}) + '\n').encode()
+        if len(line) > select.PIPE_BUF:
+            raise ValueError(f"Relay message of {len(line)} bytes exceeds {select.PIPE_BUF}")
+        try:
+            os.write(self._upstream[1], line)
+            return True
+        except BlockingIOError:
+            self.dropped += 1
+            return False
+
+    def listen_upstream(self, handler):
+        """In the pipeline process: call handler(kind, payload) for every message from the workers"""
+        return self.listen(self._upstream[0], handler)
+
+    @staticmethod
+    def listen(read_fd, handler):
+        """Call handler(kind, payload) for every message of a pipe, in a thread"""
+        def loop():
+            with os.fdopen(read_fd, 'rb') as pipe:
+                for line in pipe:
+                    try:
+                        message = json.loads(line)
+                        handler(message['type'], message['data'])
+                    except Exception as e:
+                        logger.error(f"Relay message failed: {e}")
+
+        thread = threading.Thread(target=loop, name='event-relay', daemon=True)
+        thread.start()
+        return thread
+
+
+def run_server(app, port, options=None, relay=None, worker_init=None, status=None, on_exit=None):
+    """
+    Serve the application until shutdown
+
+    Args:
+        app: WSGI application
+        port: TCP port
+        options: 'server' configuration section
+        relay: EventRelay the pipeline publishes to, gunicorn mode only
+        worker_init: Callable run in each gunicorn worker after fork,
+            returns the handler of relay messages
+        status: Callable returning the pipeline status sent to workers
+        on_exit: Callable run when gunicorn shuts down
+    """
+    options = options or {}
+    mode = options.get('mode', 'werkzeug')
+    if mode not in MODES:
+        raise ValueError(f"Unknown server mode '{mode}', expected {', '.join(MODES)}")
+
+    if mode == 'gunicorn':
+        try:
+            return _run_gunicorn(app, port, options, relay or EventRelay(), worker_init, status, on_exit)
+        except ImportError:
+            logger.warning("gunicorn is not installed, falling back to waitress")
+            mode = 'waitress'
+
+    if mode == 'waitress':
+        try:
+            return _run_waitress(app, port, options)
+        except ImportError:
+            logger.warning("waitress is not installed, falling back to the development server")
+
+    logger.info(f"Starting development web server on port {port}")
+    app.run(host='0.0.0.0', port=port, debug=False, threaded=True)
+
+
+def _run_waitress(app, port, options):
+    """Multi-threaded production server in this process"""
+    from waitress import serve
+
+    threads = options.get('threads', 8)
+    logger.info(f"Starting waitress on port {port} with {threads} threads")
+    serve(
+        app,
+        host='0.0.0.0',
+        port=port,
+        threads=threads,
+        connection_limit=options.get('connection_limit', 100),
+        channel_timeout=options.get('timeout', 120),
+        ident='ventilairsec-vmi'
+    )
+
+
+def _run_gunicorn(app, port, options, relay, worker_init, status, on_exit):
+    """Pre-fork server, the pipeline stays in the master process"""
+    from gunicorn.app.base import BaseApplication
+
+    settings = {
+        'bind': f"0.0.0.0:{port}",
+        'workers': options.get('workers', 2),
+        'threads': options.get('threads', 8),
+        'worker_class': 'gthread',
+        'keepalive': options.get('keepalive', 5),
+        'timeout': options.get('timeout', 120),
+        'graceful_timeout': options.get('graceful_timeout', 10),
+        'accesslog': None,
+    }
+
+    def pre_fork(server, worker):
+        worker.relay_key = id(worker)
+        relay.open(worker.relay_key)
+
+    def post_fork(server, worker):
+        read_fd = relay.detach(worker.relay_key)
+        handler = worker_init() if worker_init else None
+        if handler:
+            EventRelay.listen(read_fd, handler)
+        else:
+            os.close(read_fd)
+
+    def child_exit(server, worker):
+        relay.close(getattr(worker, 'relay_key', None))
+
+    def when_ready(server):
+        if status:
+            _start_status_publisher(relay, status)
+
+    def gunicorn_on_exit(server):
+        if on_exit:
+            on_exit()
+
+    class Application(BaseApplication):
+        def load_config(self):
+            for key, value in settings.items():
+                self.cfg.set(key, value)
+            self.cfg.set('pre_fork', pre_fork)
+            self.cfg.set('post_fork', post_fork)
+            self.cfg.set('child_exit', child_exit)
+            self.cfg.set('when_ready', when_ready)
+            self.cfg.set('on_exit', gunicorn_on_exit)
+
+        def load(self):
+            return app
+
+    logger.info(
+        f"Starting gunicorn on port {port} with {settings['workers']} workers "
+        f"x {settings['threads']} threads"
+    )
+    Application().run()
+
+
+def _start_status_publisher(relay, status, interval=2.0):
+    """Send the pipeline status to the workers every interval"""
+    def loop():
+        while True:
+            try:
+                relay.publish('status', status())
+            except Exception as e:
+                logger.error(f"Failed to publish pipeline status: {e}")
+            time.sleep(interval)
+
+    threading.Thread(target=loop, name='relay-status', daemon=True).start()
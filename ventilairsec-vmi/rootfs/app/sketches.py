@@ -0,0 +1,182 @@
+"""
+Sketches - Mergeable quantile sketches stored with the rollups
+
+A sketch is a histogram with logarithmic bins (DDSketch): a value v > 0 goes
+to bin ceil(log(v) / log(gamma)), so any quantile is returned within
+RELATIVE_ACCURACY of a true value, and two sketches merge by adding their
+bin counts. Buckets of any width can therefore be combined into the
+percentiles of an arbitrary window without reading raw rows.
+"""
+
+import math
+
+# Quantiles are within 1% of a value of the data
+RELATIVE_ACCURACY = 0.01
+
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+LOG_GAMMA = math.log(GAMMA)
+
+# Smaller magnitudes are counted as zero
+MIN_VALUE = 1e-9
+
+# First byte of the serialized form
+FORMAT_VERSION = 1
+
+
+def _write_varint(out, number):
+    while number > 0x7F:
+        out.append((number & 0x7F) | 0x80)
+        number >>= 7
+    out.append(number)
+
+
+def _read_varint(data, position):
+    number = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        number |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return number, position
+        shift += 7
+
+
+class QuantileSketch:
+    """Log-binned histogram with relative-error quantiles"""
+
+    __slots__ = ('positive', 'negative', 'zero', 'count')
+
+    def __init__(self):
+        # bin index -> count, negative values binned by magnitude
+        self.positive = {}
+        self.negative = {}
+        self.zero = 0
+        self.count = 0
+
+    def add(self, value, count=1):
+        """Add a value"""
+        if value > MIN_VALUE:
+            index = math.ceil(math.log(value) / LOG_GAMMA)
+            self.positive[index] = self.positive.get(index, 0) + count
+        elif value < -MIN_VALUE:
+            index = math.ceil(math.log(-value) / LOG_GAMMA)
+            self.negative[index] = self.negative.get(index, 0) + count
+        else:
+            self.zero += count
+        self.count += count
+
+    def merge(self, other):
+        """Add the values of another sketch to this one"""
+        for index, count in other.positive.items():
+            self.positive[index] = self.positive.get(index, 0) + count
+        for index, count in other.negative.items():
+            self.negative[index] = self.negative.get(index, 0) + count
+        self.zero += other.zero
+        self.count += other.count
+        return self
+
+    def quantile(self, q):
+        """
+        Value at quantile q
+
+        Args:
+            q: Quantile between 0 and 1
+
+        Returns:
+            Estimated value, None if the sketch is empty
+        """
+        if not self.count:
+            return None
+
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self.negative, reverse=True):
+            seen += self.negative[index]
+            if seen > rank:
+                return -self._bin_value(index)
+        seen += self.zero
+        if seen > rank:
+            return 0.0
+        for index in sorted(self.positive):
+            seen += self.positive[index]
+            if seen > rank:
+                return self._bin_value(index)
+        return self._bin_value(max(self.positive))
+
+    @staticmethod
+    def _bin_value(index):
+        """Value within RELATIVE_ACCURACY of everything in a bin"""
+        return 2 * GAMMA ** index / (GAMMA + 1)
+
+    def to_bytes(self):
+        """Compact serialized form, for the rollups table"""
+        out = bytearray((FORMAT_VERSION,))
+        _write_varint(out, self.zero)
+        for bins in (self.positive, self.negative):
+            _write_varint(out, len(bins))
+            previous = 0
+            for index in sorted(bins):
+                delta = index - previous
+                # Zigzag, bin indexes are negative below 1
+                _write_varint(out, delta * 2 if delta >= 0 else -delta * 2 - 1)
+                _write_varint(out, bins[index])
+                previous = index
+        return bytes(out)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Read a serialized sketch
+
+        Raises:
+            ValueError: If the data is not a sketch of a known format
+        """
+        if not data or data[0] != FORMAT_VERSION:
+            raise ValueError("Not a quantile sketch")
+
+        sketch = cls()
+        sketch.zero, position = _read_varint(data, 1)
+        sketch.count = sketch.zero
+        for bins in (sketch.positive, sketch.negative):
+            size, position = _read_varint(data, position)
+            index = 0
+            for _ in range(size):
+                delta, position = _read_varint(data, position)
+                index += delta // 2 if delta % 2 == 0 else -(delta + 1) // 2
+                count, position = _read_varint(data, position)
+                bins[index] = count
+                sketch.count += count
+        return sketch
+
+
+def merge_bytes(left, right):
+    """
+    SQL function sketch_merge(a, b) used when buckets are upserted
+
+    A bucket without a sketch was written before sketches existed and only
+    partially rebuilt, so it stays without one rather than under-counting.
+    """
+    if left is None or right is None:
+        return None
+    return QuantileSketch.from_bytes(left).merge(QuantileSketch.from_bytes(right)).to_bytes()
+
+
+class SketchAggregate:
+    """SQL aggregate sketch_build(value), builds a sketch from readings"""
+
+    def __init__(self):
+        self.sketch = QuantileSketch()
+
+    def step(self, value):
+        if value is not None:
+            self.sketch.add(value)
+
+    def finalize(self):
+        return self.sketch.to_bytes()
+
+
+def register(connection):
+    """Make sketch_merge and sketch_build available to a SQLite connection"""
+    connection.create_function('sketch_merge', 2, merge_bytes, deterministic=True)
+    connection.create_aggregate('sketch_build', 1, SketchAggregate)
@@ -0,0 +1,7 @@
+"""Make the addon modules importable, as they are when run from rootfs/app"""
+
+import os
+import sys
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'rootfs', 'app')
+sys.path.insert(0, os.path.normpath(APP_PATH))
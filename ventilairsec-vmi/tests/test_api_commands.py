@@ -0,0 +1,42 @@
+"""POST /api/commands request validation"""
+
+import pytest
+
+main = pytest.importorskip('main')
+
+from command_scheduler import CommandScheduler  # noqa: E402
+
+
+@pytest.fixture
+def client(monkeypatch):
+    scheduler = CommandScheduler(lambda *args: True, min_interval_ms=0)
+    monkeypatch.setattr(main, 'command_scheduler', scheduler)
+    return main.app.test_client()
+
+
+@pytest.mark.parametrize('field, value', [
+    ('ack', 'false'),
+    ('ack', 0),
+    ('retries', '2'),
+    ('retries', True),
+    ('retries', -1),
+    ('ttl', 'soon'),
+    ('priority', 1),
+    ('device_id', 12345),
+])
+def test_rejects_wrong_types(client, field, value):
+    body = {'device_id': '0x0421574F', 'data': '01', field: value}
+    response = client.post('/api/commands', json=body)
+    assert response.status_code == 400
+    assert field in response.json['error']
+
+
+def test_queues_valid_command(client):
+    response = client.post('/api/commands', json={
+        'device_id': '0x0421574F', 'data': '0102', 'rorg': 'A5', 'ack': False,
+        'retries': 0, 'ttl': 5, 'priority': 'boost', 'ack_rorg': 0xD1
+    })
+    assert response.status_code == 202
+    assert response.json['ack'] is False
+    assert response.json['ack_rorg'] == 'D1'
+    assert response.json['priority'] == 'boost'
@@ -0,0 +1,49 @@
+"""POST /api/series request validation"""
+
+import time
+
+import pytest
+
+from database import Database
+from records import Reading
+
+main = pytest.importorskip('main')
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    db = Database(tmp_path)
+    db.initialize()
+    assert db.insert_readings([Reading('0x01', 'D1-07-9F', 'VMI', int(time.time()) - 60, [('co2', 450.0)])])
+    monkeypatch.setattr(main, 'db', db)
+    yield main.app.test_client()
+    db.close()
+
+
+@pytest.mark.parametrize('field, value', [
+    ('hours', [24]),
+    ('hours', '24'),
+    ('hours', True),
+    ('series', '0x01:co2'),
+    ('resolution', 60),
+    ('fields', 'value'),
+    ('fields', [1]),
+])
+def test_rejects_wrong_types(client, field, value):
+    body = {'series': [['0x01', 'co2']], field: value}
+    response = client.post('/api/series', json=body)
+    assert response.status_code == 400
+    assert field in response.json['error']
+
+
+def test_rejects_non_object_body(client):
+    response = client.post('/api/series', json=[['0x01', 'co2']])
+    assert response.status_code == 400
+
+
+def test_null_fields_take_defaults(client):
+    response = client.post('/api/series', json={
+        'series': [['0x01', 'co2']], 'hours': None, 'resolution': None, 'fields': None
+    })
+    assert response.status_code == 200
+    assert response.json['series'][0]['value'] == [450.0]
@@ -0,0 +1,30 @@
+"""Parquet archive shared between processes"""
+
+import pytest
+
+import archive
+
+pytest.importorskip('pyarrow')
+
+from archive import Archive  # noqa: E402
+
+
+def test_index_written_by_another_process_is_reloaded(tmp_path):
+    pipeline = Archive(str(tmp_path))
+    worker = Archive(str(tmp_path))
+    assert worker.archived_until('0x01') is None
+
+    pipeline.set_archived_until('0x01', 1000)
+    assert worker.archived_until('0x01') == 1000
+
+    # Boundaries set by both processes are merged, not overwritten
+    worker.set_archived_until('0x02', 2000)
+    assert pipeline.archived_until('0x01') == 1000
+    assert pipeline.archived_until('0x02') == 2000
+
+
+def test_enabled_archive_requires_pyarrow(tmp_path, monkeypatch):
+    monkeypatch.setattr(archive, 'PYARROW_AVAILABLE', False)
+    assert Archive.from_config({}, str(tmp_path)) is None
+    with pytest.raises(RuntimeError):
+        Archive.from_config({'archive': {'enabled': True}}, str(tmp_path))
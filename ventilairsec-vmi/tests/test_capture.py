@@ -0,0 +1,71 @@
+"""Capture files and the pseudo-terminal stand-in"""
+
+import os
+import select
+
+import pytest
+
+import capture
+import esp3
+
+
+def write_capture(path, frames):
+    writer = capture.CaptureWriter(str(path))
+    for index, frame in enumerate(frames):
+        writer.write(frame, writer.started + index * 0.25)
+    writer.close()
+    return writer.started
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 64 * 1024])
+def test_read_capture_in_chunks(tmp_path, chunk_size):
+    frames = [esp3.encode_frame(esp3.RADIO_ERP1, bytes([0xA5, index, 2, 3, 4]) + bytes(4) + b'\x00')
+              for index in range(50)]
+    # Longer than a chunk, and a length needing a two-byte varint
+    frames.append(esp3.encode_frame(esp3.RADIO_ERP1, bytes(300)))
+    started = write_capture(tmp_path / 'capture.esp3', frames)
+
+    records = list(capture.read_capture(str(tmp_path / 'capture.esp3'), chunk_size=chunk_size))
+    assert [frame for _, frame in records] == frames
+    assert records[4][0] == pytest.approx(started + 1.0)
+
+
+def test_truncated_record_ends_the_capture(tmp_path):
+    frames = [esp3.encode_frame(esp3.RADIO_ERP1, bytes([0xF6, index])) for index in range(3)]
+    path = tmp_path / 'capture.esp3'
+    write_capture(path, frames)
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - 3)
+
+    assert [frame for _, frame in capture.read_capture(str(path), chunk_size=5)] == frames[:2]
+
+
+def test_rejects_other_files(tmp_path):
+    path = tmp_path / 'other.bin'
+    path.write_bytes(b'not a capture at all')
+    with pytest.raises(ValueError):
+        list(capture.read_capture(str(path)))
+
+
+@pytest.mark.skipif(capture.pty is None, reason="no pseudo-terminals")
+def test_stand_in_answers_base_id(tmp_path):
+    path = tmp_path / 'empty.esp3'
+    write_capture(path, [])
+    stand_in = capture.PtyStandIn(str(path), speed=0)
+    stand_in.start()
+    port = os.open(stand_in.port, os.O_RDWR | os.O_NOCTTY)
+    try:
+        os.write(port, esp3.encode_frame(esp3.COMMON_COMMAND, bytes((esp3.CO_RD_IDBASE,))))
+        decoder = esp3.FrameDecoder()
+        frames = []
+        while not frames:
+            assert select.select([port], [], [], 2)[0]
+            frames = list(decoder.feed(os.read(port, 256)))
+    finally:
+        os.close(port)
+        stand_in.stop()
+
+    # As python-enocean expects it: exactly return code and base ID, write cycles as optional data
+    assert frames[0].packet_type == esp3.RESPONSE
+    assert bytes(frames[0].data) == bytes((esp3.RET_OK,)) + capture.STAND_IN_BASE_ID
+    assert bytes(frames[0].optional) == b'\x0a'
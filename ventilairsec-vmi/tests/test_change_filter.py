@@ -0,0 +1,71 @@
+"""Change-only storage and reconstruction of the stored series"""
+
+import math
+
+import pytest
+
+from change_filter import ChangeFilter
+
+
+def store(change_filter, series, name='temp'):
+    """Run a series through the filter, returns the stored {timestamp: value}"""
+    stored = {}
+    for timestamp, value in series:
+        for _, point_timestamp, _, point_value in change_filter.filter(1, 1, name, timestamp, value):
+            stored[point_timestamp] = point_value
+    for _, point_timestamp, _, point_value in change_filter.pending_rows():
+        stored[point_timestamp] = point_value
+    return stored
+
+
+def reconstruct(change_filter, series, stored):
+    timestamps = [timestamp for timestamp, _ in series]
+    return change_filter.reconstruct(timestamps, [stored.get(timestamp) for timestamp in timestamps])
+
+
+def test_deadband_zero_reconstructs_exactly():
+    series = [(t, float(t // 300)) for t in range(0, 3600, 60)]
+    change_filter = ChangeFilter(heartbeat=900)
+    stored = store(change_filter, series)
+
+    assert len(stored) < len(series)
+    assert reconstruct(change_filter, series, stored) == [value for _, value in series]
+
+
+def test_deadband_holds_within_band():
+    series = [(t, 20 + 0.3 * math.sin(t / 500)) for t in range(0, 7200, 30)]
+    change_filter = ChangeFilter(deadband=0.1, heartbeat=900)
+    stored = store(change_filter, series)
+
+    filled = reconstruct(change_filter, series, stored)
+    assert len(stored) < len(series) / 3
+    assert max(abs(a - b) for a, b in zip(filled, (value for _, value in series))) <= 0.1
+
+
+def test_swinging_door_interpolates_within_band():
+    series = [(t, 20 + 2 * math.sin(t / 900)) for t in range(0, 7200, 30)]
+    change_filter = ChangeFilter(mode='swinging_door', deadband=0.05, heartbeat=900)
+    stored = store(change_filter, series)
+
+    filled = reconstruct(change_filter, series, stored)
+    assert len(stored) < len(series) / 3
+    assert max(abs(a - b) for a, b in zip(filled, (value for _, value in series))) <= 0.05 + 1e-9
+
+
+def test_gaps_longer_than_heartbeats_stay_empty():
+    change_filter = ChangeFilter(heartbeat=60)
+    assert change_filter.reconstruct([0, 100, 500], [1.0, None, None]) == [1.0, 1.0, None]
+    assert change_filter.reconstruct([100], [None], carry=(50, 2.0)) == [2.0]
+
+
+def test_repeated_telegrams_are_skipped_until_heartbeat():
+    change_filter = ChangeFilter(heartbeat=900)
+    assert change_filter.keep_telegram(1, 0, b'\x01')
+    assert not change_filter.keep_telegram(1, 60, b'\x01')
+    assert change_filter.keep_telegram(1, 120, b'\x02')
+    assert change_filter.keep_telegram(1, 1100, b'\x02')
+
+
+def test_rejects_unknown_mode():
+    with pytest.raises(ValueError):
+        ChangeFilter(mode='average')
@@ -0,0 +1,172 @@
+"""CommandScheduler ordering, coalescing and retry/acknowledgement state machine"""
+
+import threading
+import time
+
+import pytest
+
+from command_scheduler import CommandScheduler, airtime
+from records import RawTelegram
+
+DEVICE = 0x0421574F
+
+
+def telegram(rorg=0xD1, timestamp=None, sender=DEVICE):
+    return RawTelegram(sender, rorg, bytes((rorg, 0x00, 0x00)), timestamp=time.time() if timestamp is None else timestamp)
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.005)
+    return False
+
+
+class Radio:
+    """send() callable recording calls, failing while offline"""
+
+    def __init__(self, online=True):
+        self.online = online
+        self.sent = []
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def __call__(self, receiver_id, data, rorg):
+        self.gate.wait()
+        if not self.online:
+            return False
+        self.sent.append((receiver_id, bytes(data), rorg))
+        return True
+
+
+@pytest.fixture
+def radio():
+    return Radio()
+
+
+@pytest.fixture
+def scheduler(radio):
+    scheduler = CommandScheduler(radio, min_interval_ms=0, ack_timeout=0.1, retries=1)
+    scheduler.start()
+    yield scheduler
+    scheduler.stop()
+
+
+def test_priority_order_and_coalescing(scheduler, radio):
+    radio.gate.clear()
+    first = scheduler.submit(DEVICE, '01', ack=False, priority='poll')
+    assert wait_for(lambda: first.state == 'sending')
+
+    poll = scheduler.submit(DEVICE, '02', ack=False, priority='poll')
+    replaced = scheduler.submit(DEVICE, '03', ack=False, kind='speed')
+    boost = scheduler.submit(DEVICE, '04', ack=False, kind='speed', priority='boost')
+    radio.gate.set()
+
+    assert wait_for(lambda: poll.state == 'done')
+    assert replaced.state == 'superseded'
+    assert boost.state == 'done'
+    assert [data for _, data, _ in radio.sent] == [b'\x01', b'\x04', b'\x02']
+
+
+def test_acknowledged_by_telegram_after_transmission(scheduler, radio):
+    before = time.time()
+    command = scheduler.submit(DEVICE, '01')
+    assert wait_for(lambda: command.state == 'sent')
+
+    # Received before the command went on air: not an answer
+    scheduler.observe(telegram(timestamp=before - 1))
+    # From another device
+    scheduler.observe(telegram(sender=0x01020304))
+    assert command.state == 'sent'
+
+    scheduler.observe(telegram())
+    assert command.state == 'done'
+    assert scheduler.get_stats()['awaiting_ack'] == 0
+
+
+def test_ack_rorg_must_match(scheduler, radio):
+    command = scheduler.submit(DEVICE, '01', ack_rorg='D1')
+    assert wait_for(lambda: command.state == 'sent')
+
+    scheduler.observe(telegram(rorg=0xA5))
+    assert command.state == 'sent'
+    scheduler.observe(telegram(rorg=0xD1))
+    assert command.state == 'done'
+
+
+def test_resent_without_acknowledgement_then_failed(scheduler, radio):
+    command = scheduler.submit(DEVICE, '01')
+
+    assert wait_for(lambda: command.state == 'failed')
+    assert command.attempts == 2
+    assert len(radio.sent) == 2
+    assert command.error == 'No acknowledgement'
+
+
+def test_failed_send_is_never_acknowledged():
+    radio = Radio(online=False)
+    scheduler = CommandScheduler(radio, min_interval_ms=0, ack_timeout=0.1, retries=1)
+    scheduler.start()
+    try:
+        command = scheduler.submit(DEVICE, '01')
+        assert wait_for(lambda: command.state == 'retrying')
+        assert scheduler.get_stats()['awaiting_ack'] == 0
+
+        # Telemetry from the device while nothing was transmitted
+        scheduler.observe(telegram())
+        assert command.state == 'retrying'
+        assert command.sent is None
+
+        assert wait_for(lambda: command.state == 'failed')
+        assert command.attempts == 2
+        assert command.error == 'No gateway could send'
+    finally:
+        scheduler.stop()
+
+
+def test_retry_after_backoff_once_a_gateway_is_back():
+    radio = Radio(online=False)
+    scheduler = CommandScheduler(radio, min_interval_ms=0, ack_timeout=0.2, retries=2)
+    scheduler.start()
+    try:
+        command = scheduler.submit(DEVICE, '01', ack=False)
+        assert wait_for(lambda: command.state == 'retrying')
+        radio.online = True
+        assert wait_for(lambda: command.state == 'done')
+        assert command.attempts == 2
+    finally:
+        scheduler.stop()
+
+
+def test_cancel_and_invalid_input(scheduler, radio):
+    radio.gate.clear()
+    scheduler.submit(DEVICE, '01', ack=False)
+    queued = scheduler.submit(DEVICE, '02', ack=False)
+    assert scheduler.cancel(queued.id)
+    assert not scheduler.cancel(queued.id)
+    radio.gate.set()
+
+    with pytest.raises(ValueError):
+        scheduler.submit(DEVICE, '01', priority='urgent')
+    with pytest.raises(ValueError):
+        scheduler.submit(DEVICE, '')
+    with pytest.raises(ValueError):
+        scheduler.submit(DEVICE, '01', rorg=0x1FF)
+
+
+def test_duty_cycle_budget_holds_sends():
+    radio = Radio()
+    # Room for two telegrams of one payload byte per window
+    scheduler = CommandScheduler(radio, duty_cycle=airtime(7) * 2.5 / 60, duty_window=60, min_interval_ms=0)
+    scheduler.start()
+    try:
+        for _ in range(4):
+            scheduler.submit(DEVICE, '01', ack=False)
+        assert wait_for(lambda: len(radio.sent) == 2)
+        time.sleep(0.1)
+        assert len(radio.sent) == 2
+        assert scheduler.depth() == 2
+    finally:
+        scheduler.stop()
@@ -0,0 +1,187 @@
+"""Database queries against a temporary SQLite file"""
+
+import time
+
+import pytest
+
+from database import Database, to_iso
+from records import Reading
+
+
+def reading(device_id, timestamp, **values):
+    return Reading(device_id, 'D1-07-9F', 'VMI', timestamp, list(values.items()), units={'temp': '°C'})
+
+
+@pytest.fixture
+def db(tmp_path):
+    database = Database(tmp_path)
+    database.initialize()
+    yield database
+    database.close()
+
+
+def test_other_process_sees_new_keys(tmp_path, db):
+    # A gunicorn worker opens the database before the pipeline sees any device
+    worker = Database(tmp_path)
+    worker.initialize()
+    try:
+        now = int(time.time())
+        assert db.insert_readings([reading('0x01', now - 60, temp=20.0), reading('0x01', now - 30, temp=22.0)])
+
+        stats = worker.get_statistics('0x01', 'temp', hours=1)
+        assert stats['count'] == 2
+        series = worker.get_series([('0x01', 'temp')], hours=1, resolution='raw')
+        assert series['series'][0]['value'] == [20.0, 22.0]
+        assert series['series'][0]['unit'] == '°C'
+        assert worker.purge('raw', now) == 2
+    finally:
+        worker.close()
+
+
+def test_series_are_reconstructed_from_changes(db):
+    from change_filter import ChangeFilter
+
+    db.attach_change_filter(ChangeFilter(heartbeat=900))
+    now = int(time.time()) - 3600
+    values = [20.0, 20.0, 20.0, 21.0, 21.0, 20.0]
+    # A second metric changing every time gives the shared time axis
+    assert db.insert_readings([
+        reading('0x01', now + index * 60, temp=value, co2=400 + index)
+        for index, value in enumerate(values)
+    ])
+
+    stored = [point['value'] for _, point in db.iter_history('0x01', 'temp', hours=2, resolution='raw')]
+    assert stored == [20.0, 21.0, 20.0]
+
+    series = db.get_series([('0x01', 'temp'), ('0x01', 'co2')], hours=2, resolution='raw')
+    assert series['series'][0]['value'] == values
+    assert db.get_statistics('0x01', 'temp', hours=2)['count'] == len(values)
+
+
+def rollup_rows(db):
+    with db.connections.reader() as connection:
+        return [
+            tuple(row) for row in connection.execute(
+                'SELECT resolution, device_id, metric_id, bucket, count, sum, min, max, last '
+                'FROM rollups ORDER BY 1, 2, 3, 4'
+            )
+        ]
+
+
+def test_rebuild_matches_ingested_rollups(db):
+    now = int(time.time()) - 7200
+    assert db.insert_readings([
+        reading('0x01', now + index * 50, temp=20 + index % 7, co2=400 + index * 3)
+        for index in range(120)
+    ])
+    ingested = rollup_rows(db)
+    assert ingested
+
+    db.rebuild_aggregates('0x01')
+    assert rollup_rows(db) == ingested
+
+    # A partial rebuild leaves the same buckets
+    db.rebuild_aggregates('0x01', now + 1000, now + 3000)
+    assert rollup_rows(db) == ingested
+
+
+def test_telegrams_within_one_second_count_once(db):
+    now = int(time.time()) - 600
+    assert db.insert_readings([reading('0x01', now, temp=20.0), reading('0x01', now, temp=21.0)])
+
+    stored = [point['value'] for _, point in db.iter_history('0x01', 'temp', hours=1, resolution='raw')]
+    assert stored == [21.0]
+    stats = db.get_statistics('0x01', 'temp', hours=1)
+    assert (stats['count'], stats['min'], stats['max']) == (1, 21.0, 21.0)
+
+    ingested = rollup_rows(db)
+    db.rebuild_aggregates('0x01')
+    assert rollup_rows(db) == ingested
+
+
+def test_rebuild_refused_with_change_filter(db):
+    from change_filter import ChangeFilter
+
+    now = int(time.time()) - 600
+    assert db.insert_readings([reading('0x01', now, temp=20.0)])
+    db.attach_change_filter(ChangeFilter())
+    with pytest.raises(RuntimeError):
+        db.rebuild_aggregates('0x01')
+    # Re-decoding would store every value again
+    with pytest.raises(RuntimeError):
+        db.replace_metric_values('0x01', [(now, 'temp', 21.0)])
+
+
+def test_failed_batch_leaves_change_filter_unchanged(db, monkeypatch):
+    import rollups
+    from change_filter import ChangeFilter
+
+    change_filter = ChangeFilter(heartbeat=900)
+    db.attach_change_filter(change_filter)
+    now = int(time.time()) - 600
+
+    def fail(rows):
+        raise RuntimeError("disk full")
+
+    monkeypatch.setattr(rollups, 'aggregate', fail)
+    assert not db.insert_readings([reading('0x01', now, temp=20.0)])
+    assert change_filter.get_stats()['values_stored'] == 0
+    monkeypatch.undo()
+
+    # The retried value is still new to the filter, so it is stored
+    assert db.insert_readings([reading('0x01', now, temp=20.0)])
+    assert [point['value'] for _, point in db.iter_history('0x01', 'temp', hours=1, resolution='raw')] == [20.0]
+
+
+def test_held_points_are_written_after_a_heartbeat(db):
+    from change_filter import ChangeFilter
+
+    db.attach_change_filter(ChangeFilter(mode='swinging_door', deadband=1.0, heartbeat=300))
+    now = int(time.time())
+    # A straight line: the door keeps holding its latest point
+    assert db.insert_readings([reading('0x01', now - 400 + index * 10, temp=20.0 + index * 0.01) for index in range(5)])
+
+    def stored():
+        return [point['timestamp'] for _, point in db.iter_history('0x01', 'temp', hours=1, resolution='raw')]
+
+    assert len(stored()) == 1
+    assert db.flush_held_points() == 1
+    assert len(stored()) == 2
+    assert db.flush_held_points() == 0
+
+
+def test_statistics_widen_edges_purged_by_retention(db):
+    day = 86400
+    base = (int(time.time()) // day - 100) * day
+    # A value every minute for three hours, 100 days ago
+    assert db.insert_readings([reading('0x01', base + minute * 60, temp=float(minute)) for minute in range(180)])
+    db.purge('1m', base + day)
+
+    start, end = base + 3600 + 7 * 60, base + 2 * 3600 + 3 * 60
+    stats = db.get_statistics('0x01', 'temp', start=start, end=end)
+
+    # Widened to the 15 minute buckets still kept
+    assert stats['start'] == to_iso(base + 3600)
+    assert stats['end'] == to_iso(base + 2 * 3600 + 15 * 60)
+    assert stats['count'] == 75
+    assert stats['min'] == 60.0 and stats['max'] == 134.0
+
+
+def test_writes_of_other_connections_are_noticed(tmp_path, db):
+    from retention import RetentionService
+
+    assert not db.changed_elsewhere()
+    assert db.insert_readings([reading('0x01', int(time.time()) - 40 * 86400, temp=20.0)])
+    # Our own commits do not count
+    assert not db.changed_elsewhere()
+
+    other = Database(tmp_path)
+    other.initialize()
+    try:
+        changes = []
+        RetentionService(other, initial_delay=0, on_changed=lambda: changes.append(True)).run_once()
+        assert changes == [True]
+    finally:
+        other.close()
+    assert db.changed_elsewhere()
+    assert not db.changed_elsewhere()
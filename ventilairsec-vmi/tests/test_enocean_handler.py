@@ -0,0 +1,101 @@
+"""EnOceanHandler transports against a stubbed serial port and a pseudo-terminal"""
+
+import threading
+import time
+
+import pytest
+
+import capture
+import esp3
+from enocean_handler import EnOceanHandler
+
+serial = pytest.importorskip('serial')
+pytest.importorskip('enocean')
+
+BASE_ID = b'\xff\x80\x00\x00'
+
+
+class FakeSerial:
+    """Serial port answering CO_RD_IDBASE and recording what is written"""
+
+    def __init__(self, port, baudrate=57600, timeout=None):
+        self.timeout = timeout or 0.1
+        self.written = bytearray()
+        self._incoming = bytearray()
+        self._decoder = esp3.FrameDecoder()
+        self._condition = threading.Condition()
+        FakeSerial.instance = self
+
+    def write(self, data):
+        with self._condition:
+            self.written += data
+            for frame in self._decoder.feed(bytes(data)):
+                if frame.packet_type == esp3.COMMON_COMMAND and frame.data[:1] == bytes((esp3.CO_RD_IDBASE,)):
+                    self._incoming += esp3.encode_frame(esp3.RESPONSE, bytes((esp3.RET_OK,)) + BASE_ID, b'\x0a')
+            self._condition.notify_all()
+
+    def read(self, size):
+        with self._condition:
+            if not self._incoming:
+                self._condition.wait(self.timeout)
+            data = bytes(self._incoming[:size])
+            del self._incoming[:size]
+            return data
+
+    def frames(self):
+        with self._condition:
+            return list(esp3.FrameDecoder().feed(bytes(self.written)))
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def handler(monkeypatch):
+    monkeypatch.setattr(serial, 'Serial', FakeSerial)
+    handler = EnOceanHandler('/dev/fake', {}, options={'transport': 'thread'})
+    handler.start()
+    yield handler
+    handler.stop()
+
+
+def test_thread_transport_reads_base_id(handler):
+    assert handler.is_connected()
+    assert bytes(handler.base_id) == BASE_ID
+
+
+def test_thread_transport_sends_radio_frame(handler):
+    assert handler.send_packet('0x0421574F', b'\x01\x02\x03\x08', 'A5')
+
+    deadline = time.monotonic() + 2
+    radio = []
+    while not radio and time.monotonic() < deadline:
+        radio = [frame for frame in FakeSerial.instance.frames() if frame.packet_type == esp3.RADIO_ERP1]
+        time.sleep(0.01)
+
+    assert len(radio) == 1
+    frame = radio[0]
+    assert frame.data == b'\xa5\x01\x02\x03\x08' + BASE_ID + b'\x00'
+    # Subtelegram count, then the destination
+    assert frame.optional[1:5] == b'\x04\x21\x57\x4f'
+
+
+@pytest.mark.skipif(capture.pty is None, reason="no pseudo-terminals")
+def test_asyncio_transport_reports_failed_write(tmp_path, monkeypatch):
+    path = tmp_path / 'empty.esp3'
+    capture.CaptureWriter(str(path)).close()
+    stand_in = capture.PtyStandIn(str(path), speed=0)
+    stand_in.start()
+    handler = EnOceanHandler(stand_in.port, {}, options={'transport': 'asyncio'})
+    try:
+        handler.start()
+        assert bytes(handler.base_id) == capture.STAND_IN_BASE_ID
+        assert handler.send_packet('0x0421574F', b'\x01\x02\x03\x08', 'A5')
+
+        # A write error closes the transport, as _on_writable does on OSError
+        monkeypatch.setattr(handler.transport, 'write', lambda frame: handler.transport.close('Write failed'))
+        assert not handler.send_packet('0x0421574F', b'\x01\x02\x03\x08', 'A5')
+        assert not handler.is_connected()
+    finally:
+        handler.stop()
+        stand_in.stop()
@@ -0,0 +1,61 @@
+"""ESP3 framing"""
+
+import pytest
+
+import esp3
+
+# 4BS telegram of a VMI: sender 0x0421574F, status 0x00, optional data
+DATA = bytes.fromhex('a5081a0c0f0421574f00')
+OPTIONAL = bytes.fromhex('01ffffffff2d00')
+
+
+def test_frame_layout():
+    frame = esp3.encode_frame(esp3.RADIO_ERP1, DATA, OPTIONAL)
+    assert frame[0] == esp3.SYNC_BYTE
+    assert frame[1:5] == bytes((0, len(DATA), len(OPTIONAL), esp3.RADIO_ERP1))
+    assert frame[5] == esp3.crc8(frame[1:5])
+    assert frame[6:-1] == DATA + OPTIONAL
+    assert frame[-1] == esp3.crc8(DATA + OPTIONAL)
+
+
+def test_matches_python_enocean():
+    packet = pytest.importorskip('enocean.protocol.packet')
+    crc8 = pytest.importorskip('enocean.protocol.crc8')
+
+    built = packet.Packet(esp3.RADIO_ERP1, list(DATA), list(OPTIONAL)).build()
+    assert esp3.encode_frame(esp3.RADIO_ERP1, DATA, OPTIONAL) == bytes(built)
+    for sample in (b'', b'\x00', bytes(range(256))):
+        assert esp3.crc8(sample) == crc8.calc(list(sample))
+
+
+def test_decodes_frames_split_anywhere():
+    frames = [
+        esp3.encode_frame(esp3.RADIO_ERP1, DATA, OPTIONAL),
+        esp3.encode_frame(esp3.RESPONSE, b'\x00\xff\x80\x00\x00', b'\x0a'),
+        esp3.encode_frame(esp3.RADIO_ERP1, bytes(300))
+    ]
+    stream = b''.join(frames)
+    decoder = esp3.FrameDecoder()
+
+    decoded = []
+    for index in range(len(stream)):
+        decoded.extend(decoder.feed(stream[index:index + 1]))
+
+    assert [(frame.packet_type, frame.data, frame.optional) for frame in decoded] == [
+        (esp3.RADIO_ERP1, DATA, OPTIONAL),
+        (esp3.RESPONSE, b'\x00\xff\x80\x00\x00', b'\x0a'),
+        (esp3.RADIO_ERP1, bytes(300), b'')
+    ]
+    assert not decoder.buffer
+
+
+def test_resynchronizes_after_noise_and_corruption():
+    good = esp3.encode_frame(esp3.RADIO_ERP1, DATA, OPTIONAL)
+    corrupt = bytearray(good)
+    corrupt[8] ^= 0xFF
+    decoder = esp3.FrameDecoder()
+
+    # Garbage with a stray sync byte, a frame with a bad data CRC, then a good frame
+    frames = decoder.feed(b'\x00\x55\x12' + bytes(corrupt) + good)
+    assert [frame.data for frame in frames] == [DATA]
+    assert decoder.crc_errors >= 2
@@ -0,0 +1,65 @@
+"""EventRelay framing when worker pipes fill up"""
+
+import json
+import os
+
+import server
+from server import EventRelay
+
+
+def drain(read_fd):
+    """Everything currently in a pipe"""
+    os.set_blocking(read_fd, False)
+    data = b''
+    while True:
+        try:
+            chunk = os.read(read_fd, 65536)
+        except BlockingIOError:
+            return data
+        if not chunk:
+            return data
+        data += chunk
+
+
+def test_partial_writes_keep_whole_lines():
+    relay = EventRelay()
+    read_fd = relay.open('worker')
+    payload = {'values': 'x' * 10000}
+
+    # Fill the pipe without a reader so some writes are partial
+    for index in range(20):
+        relay.publish('reading', dict(payload, index=index))
+    assert relay._backlog['worker']
+
+    received = b''
+    for _ in range(40):
+        received += drain(read_fd)
+        relay.publish('status', {})
+
+    lines = received.split(b'\n')
+    assert lines[-1] == b''
+    messages = [json.loads(line) for line in lines[:-1]]
+    indexes = [message['data']['index'] for message in messages if message['type'] == 'reading']
+    assert indexes == list(range(20))
+    relay.close('worker')
+
+
+def test_backlog_is_bounded(monkeypatch):
+    monkeypatch.setattr(server, 'MAX_BACKLOG', 200000)
+    relay = EventRelay()
+    read_fd = relay.open('worker')
+
+    for index in range(100):
+        relay.publish('reading', {'index': index, 'values': 'x' * 10000})
+    assert len(relay._backlog['worker']) <= server.MAX_BACKLOG
+    assert relay.dropped > 0
+
+    # Whatever was kept is still a sequence of whole messages
+    received = b''
+    for _ in range(20):
+        received += drain(read_fd)
+        relay.publish('status', {})
+    lines = received.split(b'\n')
+    assert lines[-1] == b''
+    assert all(json.loads(line) for line in lines[:-1])
+    relay.close('worker')
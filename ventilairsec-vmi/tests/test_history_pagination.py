@@ -0,0 +1,80 @@
+"""Keyset pagination of history"""
+
+import time
+
+import pytest
+
+from database import Database
+from records import Reading
+
+main = pytest.importorskip('main')
+
+
+@pytest.fixture
+def db(tmp_path):
+    database = Database(tmp_path)
+    database.initialize()
+    now = int(time.time()) - 3000
+    # Three metrics sharing every timestamp, so pages split inside a second
+    assert database.insert_readings([
+        Reading('0x01', 'D1-07-9F', 'VMI', now + index * 10, [('co2', 400.0 + index), ('temp', 20.0), ('rh', 50.0)])
+        for index in range(100)
+    ])
+    yield database
+    database.close()
+
+
+def pages(db, descending=False, limit=7):
+    after = None
+    while True:
+        page = list(db.iter_history('0x01', hours=1, resolution='raw', after=after, limit=limit,
+                                    descending=descending, chunk_size=5))
+        yield page
+        if len(page) < limit:
+            return
+        after = page[-1][0]
+
+
+@pytest.mark.parametrize('descending', [False, True])
+def test_pages_cover_every_point_once(db, descending):
+    everything = [cursor for cursor, _ in db.iter_history('0x01', hours=1, resolution='raw',
+                                                          descending=descending)]
+    assert len(everything) == 300
+    assert everything == sorted(everything, reverse=descending)
+
+    paged = [cursor for page in pages(db, descending) for cursor, _ in page]
+    assert paged == everything
+
+
+def test_timestamp_cursor_skips_the_whole_second(db):
+    first, _ = next(db.iter_history('0x01', hours=1, resolution='raw'))
+    after = list(db.iter_history('0x01', hours=1, resolution='raw', after=(first[0], None)))
+    assert len(after) == 297
+    assert all(cursor[0] > first[0] for cursor, _ in after)
+
+
+def test_parse_cursor():
+    assert main.parse_cursor(None) is None
+    assert main.parse_cursor('1700000000') == (1700000000, None)
+    assert main.parse_cursor('1700000000:3') == (1700000000, 3)
+    with pytest.raises(ValueError):
+        main.parse_cursor('yesterday')
+
+
+def test_api_follows_next_cursor(db, monkeypatch):
+    monkeypatch.setattr(main, 'db', db)
+    client = main.app.test_client()
+
+    points = []
+    url = '/api/history/0x01?hours=1&resolution=raw&limit=40'
+    while url:
+        response = client.get(url)
+        assert response.status_code == 200
+        points.extend(response.json)
+        url = None
+        if 'X-Next-Cursor' in response.headers:
+            url = f"/api/history/0x01?hours=1&resolution=raw&limit=40&after={response.headers['X-Next-Cursor']}"
+            assert 'rel="next"' in response.headers['Link']
+
+    assert len(points) == 300
+    assert len({(point['timestamp'], point['metric']) for point in points}) == 300
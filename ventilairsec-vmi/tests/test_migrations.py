@@ -0,0 +1,65 @@
+"""Migration of databases written by older versions"""
+
+import sqlite3
+import time
+from datetime import datetime
+
+import pytest
+
+from database import Database
+from records import Reading
+
+main = pytest.importorskip('main')
+
+
+def seed_v1(path, address):
+    """Create a storage format v1 database holding two readings of one device"""
+    connection = sqlite3.connect(path / 'ventilairsec.db')
+    connection.executescript('''
+        CREATE TABLE readings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            device_id TEXT NOT NULL,
+            device_type TEXT,
+            device_name TEXT,
+            metric_name TEXT,
+            metric_value REAL,
+            metric_unit TEXT,
+            raw_data TEXT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            recorded_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE INDEX idx_device_timestamp ON readings(device_id, timestamp DESC);
+        CREATE TABLE devices (id TEXT PRIMARY KEY, name TEXT, type TEXT, last_seen DATETIME, status TEXT);
+    ''')
+    old = int(time.time()) - 1200
+    connection.executemany(
+        'INSERT INTO readings (device_id, device_type, device_name, metric_name, metric_value, timestamp, raw_data)'
+        ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+        [(address, 'D1-07-9F', 'VMI', 'co2', 600.0 + index, datetime.fromtimestamp(old + index * 60).isoformat(), '')
+         for index in range(2)]
+        + [('not-an-address', 'D1-07-9F', 'VMI', 'co2', 1.0, datetime.fromtimestamp(old).isoformat(), '')]
+    )
+    connection.executemany(
+        'INSERT INTO devices (id, name, type, last_seen, status) VALUES (?, ?, ?, ?, ?)',
+        [(address, 'VMI', 'D1-07-9F', datetime.fromtimestamp(old).isoformat(), 'online'),
+         ('not-an-address', 'Broken', 'D1-07-9F', None, 'online')]
+    )
+    connection.commit()
+    connection.close()
+
+
+def test_v1_history_continues_under_the_current_device_id(tmp_path, monkeypatch):
+    seed_v1(tmp_path, '0421574F')
+    db = Database(tmp_path, {'vacuum_after_migration': False})
+    db.initialize()
+    try:
+        assert db.insert_readings([Reading('0x0421574F', 'D1-07-9F', 'VMI', int(time.time()) - 60, [('co2', 700.0)])])
+        with db.connections.reader() as connection:
+            assert [row[0] for row in connection.execute('SELECT address FROM devices')] == ['0x0421574F']
+
+        monkeypatch.setattr(main, 'db', db)
+        response = main.app.test_client().get('/api/history/0x0421574F?hours=1&resolution=raw&limit=10')
+        assert response.status_code == 200
+        assert sorted(point['value'] for point in response.json) == [600.0, 601.0, 700.0]
+    finally:
+        db.close()
@@ -0,0 +1,50 @@
+"""Cached responses are invalidated by every write that changes results"""
+
+import time
+from email.utils import formatdate
+
+from response_cache import IngestSequence, ResponseCache
+
+
+def test_invalidate_moves_every_device():
+    sequences = IngestSequence()
+    cache = ResponseCache(sequences)
+    sequences.bump(['0x01'])
+
+    for device_id in ('0x01', '0x02', None):
+        cache.put(('key', device_id), sequences.get(device_id), b'{}')
+        assert cache.get(('key', device_id), device_id, windowed=False) is not None
+
+    sequences.invalidate()
+    for device_id in ('0x01', '0x02', None):
+        assert cache.get(('key', device_id), device_id, windowed=False) is None
+    assert sequences.get('0x02')[1] is not None
+
+
+def test_workers_adopt_the_generation():
+    pipeline = IngestSequence()
+    worker = IngestSequence()
+    pipeline.bump(['0x01'])
+    pipeline.invalidate()
+
+    worker.update(pipeline.snapshot())
+    assert worker.get('0x01') == pipeline.get('0x01')
+    assert worker.get('0x02') == pipeline.get('0x02')
+
+
+def test_windowed_responses_are_dated_when_built(monkeypatch):
+    sequences = IngestSequence()
+    cache = ResponseCache(sequences)
+    monkeypatch.setattr(time, 'time', lambda: 1_700_000_000.0)
+    sequences.bump(['0x01'])
+    # The client's copy dates from an hour after the last write
+    since = formatdate(1_700_003_600, usegmt=True)
+
+    monkeypatch.setattr(time, 'time', lambda: 1_700_007_200.0)
+    latest = cache.put('latest', sequences.get('0x01'), b'{}', windowed=False)
+    assert cache.is_not_modified(latest, None, since)
+
+    # The window moved since, without any write
+    history = cache.put('history', sequences.get('0x01'), b'[]')
+    assert not cache.is_not_modified(history, None, since)
+    assert cache.is_not_modified(history, None, cache.headers(history)['Last-Modified'])
@@ -0,0 +1,39 @@
+"""Covering statistics windows with rollup buckets"""
+
+import rollups
+
+
+def covered(ranges):
+    """Sorted (first, last) second ranges of a cover"""
+    return sorted((first, last) for _, first, last in ranges)
+
+
+def test_cover_splits_coarsest_first():
+    day = 86400
+    start, end = 10 * day + 3 * 3600 + 17 * 60, 12 * day + 5 * 3600 + 46 * 60
+    ranges = rollups.cover(start, end)
+
+    assert (day, 11 * day, 12 * day) in ranges
+    assert {seconds for seconds, _, _ in ranges} == {60, 900, 3600, day}
+    # Contiguous and exactly once
+    spans = covered(ranges)
+    assert spans[0][0] == start and spans[-1][1] == end
+    assert all(a[1] == b[0] for a, b in zip(spans, spans[1:]))
+
+
+def test_widen_keeps_edges_with_every_resolution():
+    assert rollups.widen(86400 + 60, 2 * 86400 + 120, {}) == (86400 + 60, 2 * 86400 + 120)
+
+
+def test_widen_moves_purged_edges_to_coarser_buckets():
+    day = 86400
+    # 1m buckets kept from day 100, 15m from day 50
+    kept = {60: 100 * day, 900: 50 * day}
+
+    start, end = rollups.widen(80 * day + 3600 + 17 * 60, 120 * day + 600 + 60, kept)
+    assert (start, end) == (80 * day + 3600 + 15 * 60, 120 * day + 660)
+
+    start, end = rollups.widen(10 * day + 3600 + 17 * 60, 10 * day + 7200 + 60, kept)
+    assert (start, end) == (10 * day + 3600, 10 * day + 3 * 3600)
+    # Only hours are needed to cover it
+    assert {seconds for seconds, _, _ in rollups.cover(start, end)} == {3600}
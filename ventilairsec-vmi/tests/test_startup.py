@@ -0,0 +1,34 @@
+"""Requests served while the database is still starting"""
+
+import pytest
+
+main = pytest.importorskip('main')
+
+from broadcaster import Broadcaster  # noqa: E402
+from readiness import Readiness  # noqa: E402
+
+
+@pytest.fixture
+def client(monkeypatch):
+    readiness = Readiness()
+    readiness.begin('database')
+    monkeypatch.setattr(main, 'readiness', readiness)
+    monkeypatch.setattr(main, 'STARTUP_REQUEST_WAIT', 0.01)
+    monkeypatch.setattr(main, 'broadcaster', Broadcaster.from_config({}))
+    return main.app.test_client()
+
+
+def test_database_endpoints_wait_then_answer_503(client):
+    response = client.get('/api/history/0x01')
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+    assert response.json['readiness']['components']['database']['state'] == 'starting'
+
+
+def test_stream_is_served_immediately(client):
+    response = client.get('/api/stream', buffered=False)
+    try:
+        assert response.status_code == 200
+        assert response.mimetype == 'text/event-stream'
+    finally:
+        response.close()